@@ -0,0 +1,221 @@
+import argparse
+import contextlib
+import importlib
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from benchmarks.replay_server import DEFAULT_FIXTURES_DIR
+from common.recording import FixtureStore
+from common.storage import is_article
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# where the sample pages of every source come from - its hosts in the recorded fixtures and the page snapshot kept in the repo
+SOURCE_SAMPLES: Dict[str, Dict[str, Any]] = {
+    'darkreading': {'hosts': ('www.darkreading.com', 'darkreading.com'), 'snapshot': None},
+    'thehackernews': {'hosts': ('thehackernews.com',), 'snapshot': None},
+    'thecyberwire': {'hosts': ('thecyberwire.com', 'www.thecyberwire.com'), 'snapshot': 'thecyberwire/test.html'},
+    'sekurak': {'hosts': ('sekurak.pl', 'www.sekurak.pl'), 'snapshot': 'sekurak/test.html'},
+    'nask': {'hosts': ('nask.pl', 'www.nask.pl'), 'snapshot': 'nask/test.html'},
+    'enisa-europa': {'hosts': ('www.enisa.europa.eu', 'enisa.europa.eu'), 'snapshot': 'enisa-europa/test.html'},
+}
+
+
+def _article_parser(source: str) -> Callable[[str, str], Any]:
+    """The same extraction function the pipeline runs for the source"""
+    processor = importlib.import_module(f"{source}.async_individual_link_processor")
+    if hasattr(processor, 'AsyncLinkProcessor'):
+        return processor.AsyncLinkProcessor().parse_html
+    return processor.parse_article
+
+
+def _index_parser(source: str) -> Optional[Callable[[str, str], Any]]:
+    """Link extraction of the source's index page, None for the sources that read an rss feed"""
+    collector = importlib.import_module(f"{source}.all_links_collector")
+    extract = getattr(collector, 'extract_article_links', None)
+    return (lambda url, html: extract(html)) if extract is not None else None
+
+
+def _quiet(parse: Callable[[str, str], Any]) -> Callable[[str, str], Any]:
+    """Some parsers still print every article, that shouldn't end up in the report"""
+    def quiet_parse(url, html):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            return parse(url, html)
+    return quiet_parse
+
+
+def _produces_articles(result: Any) -> bool:
+    results = result if isinstance(result, list) else [result]
+    return bool(results) and all(is_article(r) for r in results)
+
+
+def _extracts_links(parse: Callable[[str, str], Any], url: str, html: str) -> bool:
+    try:
+        return bool(parse(url, html))
+    except Exception:
+        return False
+
+
+def collect_cases(source: str, fixtures: Optional[FixtureStore]) -> Dict[str, List[Tuple[str, str]]]:
+    """Sample pages of the source sorted into 'article' and 'index' cases, by whichever parser actually accepts them"""
+    samples = SOURCE_SAMPLES[source]
+    pages: List[Tuple[str, str]] = []
+    if fixtures is not None:
+        for url in fixtures.urls():
+            if urlsplit(url).hostname in samples['hosts']:
+                recorded = fixtures.load(url)
+                if recorded['status'] == 200:
+                    pages.append((url, recorded['body'].decode('utf-8', errors='replace')))
+    if samples['snapshot'] and (ROOT_DIR / samples['snapshot']).exists():
+        url = f"https://{samples['hosts'][0]}/{samples['snapshot']}"
+        pages.append((url, (ROOT_DIR / samples['snapshot']).read_text(encoding='utf-8', errors='replace')))
+
+    article_parse = _quiet(_article_parser(source))
+    index_parse = _index_parser(source)
+    cases: Dict[str, List[Tuple[str, str]]] = {'article': [], 'index': []}
+    # trying the wrong parser on a page is expected here, its error logs would only be noise
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.CRITICAL)
+    try:
+        for url, html in pages:
+            if _produces_articles(article_parse(url, html)):
+                cases['article'].append((url, html))
+            elif index_parse is not None and _extracts_links(index_parse, url, html):
+                cases['index'].append((url, html))
+    finally:
+        logging.disable(previous_disable)
+    return cases
+
+
+def time_parser(parse: Callable[[str, str], Any],
+                pages: List[Tuple[str, str]],
+                min_time: float = 1.0,
+                repeat: int = 5) -> Dict[str, Any]:
+    """ops/sec of parsing the pages (one op = one page), the python memory one op peaks at and the allocations it makes"""
+    # warm up and find how many passes over the pages fill `min_time`
+    passes = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(passes):
+            for url, html in pages:
+                parse(url, html)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / repeat or passes >= 1_000_000:
+            break
+        passes *= 2
+
+    rates = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(passes):
+            for url, html in pages:
+                parse(url, html)
+        rates.append(passes * len(pages) / (time.perf_counter() - started))
+
+    # tracemalloc slows everything down, so it gets its own pass; only python allocations are visible to it, not lxml's own (C) ones
+    tracemalloc.start()
+    # the snapshots themselves are allocations too, they're left out of the counts
+    own_allocations = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    peaks, allocations = [], []
+    for url, html in pages:
+        tracemalloc.reset_peak()
+        before_size, _ = tracemalloc.get_traced_memory()
+        snapshot_before = tracemalloc.take_snapshot().filter_traces(own_allocations)
+        result = parse(url, html)
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot_after = tracemalloc.take_snapshot().filter_traces(own_allocations)
+        peaks.append(peak - before_size)
+        # allocations (memory blocks) the op made per line of code, counted from the traces still alive after it -
+        # the result and whatever it keeps; the temporaries freed before the op ended only show in the peak
+        allocations.append(sum(stat.count_diff for stat in snapshot_after.compare_to(snapshot_before, 'lineno') if stat.count_diff > 0))
+        del result
+    tracemalloc.stop()
+
+    return {
+        'pages': len(pages),
+        'ops_per_sec': statistics.median(rates),
+        'best_ops_per_sec': max(rates),
+        'us_per_op': 1_000_000 / statistics.median(rates),
+        'peak_alloc_kb': statistics.mean(peaks) / 1024,
+        'allocations_per_op': statistics.mean(allocations),
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sources: List[str], fixtures_dir: Optional[Path], min_time: float, repeat: int) -> Dict[str, Any]:
+    fixtures = FixtureStore(fixtures_dir) if fixtures_dir is not None and fixtures_dir.exists() else None
+    results = []
+    for source in sources:
+        cases = collect_cases(source, fixtures)
+        parsers = {'article': _quiet(_article_parser(source)), 'index': _index_parser(source)}
+        for kind, pages in cases.items():
+            if not pages:
+                continue
+            results.append({'source': source, 'case': kind, **time_parser(parsers[kind], pages, min_time, repeat)})
+        if not any(cases.values()):
+            results.append({'source': source, 'case': None, 'pages': 0})
+    return {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    previous = {(r['source'], r['case']): r for r in baseline['results']} if baseline else {}
+    print(f"revision {report['revision']}" + (f" vs {baseline['revision']}" if baseline else ''))
+    print(f"{'source':<15}{'case':<9}{'pages':>6}{'ops/s':>10}{'us/op':>10}{'peak KB':>9}{'allocs':>8}{'vs base':>9}")
+    for r in report['results']:
+        if not r['pages']:
+            print(f"{r['source']:<15}{'-':<9}{0:>6}  no sample pages (record some fixtures with benchmarks.record)")
+            continue
+        base = previous.get((r['source'], r['case']))
+        change = f"{r['ops_per_sec'] / base['ops_per_sec']:.2f}x" if base and base.get('ops_per_sec') else '-'
+        print(f"{r['source']:<15}{r['case']:<9}{r['pages']:>6}{r['ops_per_sec']:>10.1f}{r['us_per_op']:>10.0f}"
+              f"{r['peak_alloc_kb']:>9.0f}{r['allocations_per_op']:>8.0f}{change:>9}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time every source's extraction logic on saved pages, without any network")
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCE_SAMPLES), default=list(SOURCE_SAMPLES))
+    parser.add_argument('--fixtures', type=Path, default=DEFAULT_FIXTURES_DIR, help="recorded fixtures to take sample pages from (besides the test.html snapshots)")
+    parser.add_argument('--min-time', type=float, default=1.0, help="seconds of timing per case")
+    parser.add_argument('--repeat', type=int, default=5, help="timing rounds per case, the median is reported")
+    parser.add_argument('--json', type=Path, default=None, help="write the results into this file")
+    parser.add_argument('--compare', type=Path, default=None, help="results of an earlier run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # what's measured is the extraction itself, the info logs of the parsers would mostly time the log handlers
+    previous_disable = logging.root.manager.disable
+    logging.disable(logging.INFO)
+    try:
+        report = run(args.sources, args.fixtures, args.min_time, args.repeat)
+    finally:
+        logging.disable(previous_disable)
+    baseline = json.loads(args.compare.read_text(encoding='utf-8')) if args.compare is not None else None
+    print_report(report, baseline)
+    if args.json is not None:
+        args.json.write_text(json.dumps(report, indent=1), encoding='utf-8')
+
+
+if __name__ == "__main__":
+    main()
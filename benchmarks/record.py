@@ -0,0 +1,32 @@
+import argparse
+import asyncio
+from pathlib import Path
+
+import orchestrator
+from benchmarks.replay_server import DEFAULT_FIXTURES_DIR
+from benchmarks.throughput import run_source_process
+from common.recording import FixtureStore
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sweep the real sites once and save every response as a fixture for the replay server")
+    parser.add_argument('--out', type=Path, default=DEFAULT_FIXTURES_DIR, help="fixtures directory (added to if it exists)")
+    parser.add_argument('--sources', nargs='+', choices=list(orchestrator.SOURCES), default=list(orchestrator.SOURCES))
+    return parser.parse_args()
+
+
+async def record(args):
+    for name in args.sources:
+        # a fresh data dir, so every article of the feed is fetched (and recorded) rather than only the new ones
+        result = await run_source_process(name, {'CRONSCRAPERS_RECORD_DIR': str(args.out.resolve())})
+        print(f"{name}: {result['status']}, {result['articles']} articles" + (f" - {result['error']}" if result['error'] else ''))
+
+
+def main():
+    args = parse_args()
+    asyncio.run(record(args))
+    print(f"{len(FixtureStore(args.out).urls())} fixtures in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import logging
+import random
+from pathlib import Path
+from typing import Optional, Tuple
+
+from aiohttp import web
+
+from common.recording import REPLAY_PATH, FixtureStore
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+
+
+def create_app(fixtures: FixtureStore,
+               latency: float = 0.0,
+               jitter: float = 0.0,
+               error_rate: float = 0.0,
+               seed: Optional[int] = None) -> web.Application:
+    """Stand-in for the real sites, answering with the recorded responses after a simulated network delay"""
+    rng = random.Random(seed)
+    stats = {'served': 0, 'missing': 0, 'errors': 0}
+
+    async def replay(request: web.Request) -> web.Response:
+        url = request.query.get('url', '')
+        delay = max(0.0, rng.gauss(latency, jitter)) if jitter else latency
+        if delay:
+            await asyncio.sleep(delay)
+
+        if rng.random() < error_rate:
+            stats['errors'] += 1
+            return web.Response(status=503, text='injected error')
+
+        recorded = fixtures.load(url) or fixtures.load(url.rstrip('/'))
+        if recorded is None:
+            stats['missing'] += 1
+            logger.warning(f"No fixture recorded for {url}")
+            return web.Response(status=404, text=f'no fixture for {url}')
+
+        stats['served'] += 1
+        headers = {'Content-Type': recorded['content_type']} if recorded['content_type'] else None
+        return web.Response(status=recorded['status'], body=recorded['body'], headers=headers)
+
+    app = web.Application()
+    app['stats'] = stats
+    app.router.add_get(REPLAY_PATH, replay)
+    return app
+
+
+async def start_replay_server(app: web.Application, host: str = '127.0.0.1', port: int = 0) -> Tuple[web.AppRunner, str]:
+    """Start serving the app and return its runner and base url (port 0 picks a free one)"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_host, bound_port = runner.addresses[0][:2]
+    return runner, f"http://{bound_host}:{bound_port}"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve recorded fixtures in place of the real sites (point CRONSCRAPERS_REPLAY_URL at it)")
+    parser.add_argument('--fixtures', type=Path, default=DEFAULT_FIXTURES_DIR, help="directory written by benchmarks.record")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--latency', type=float, default=0.0, help="mean delay of every response in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="standard deviation of the delay in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args()
+
+
+async def _serve(args):
+    fixtures = FixtureStore(args.fixtures)
+    app = create_app(fixtures, args.latency, args.jitter, args.error_rate, args.seed)
+    runner, url = await start_replay_server(app, args.host, args.port)
+    print(f"Replaying {len(fixtures.urls())} fixtures on {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(_serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import asyncio
+import functools
+import importlib
+import json
+import resource
+import sys
+import time
+from typing import Any, Dict, List
+
+import orchestrator
+from common.logging_setup import setup_logging
+from common.storage import get_article_store
+from common.seen_store import get_seen_store
+
+
+# the runner prints its result as the last line of its output, prefixed with this
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+def _timed(fetch, latencies: List[float]):
+    @functools.wraps(fetch)
+    async def timed_fetch(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fetch(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    return timed_fetch
+
+
+def _instrument(name: str, latencies: List[float]):
+    """Time every article fetch of the source, whether it goes through aiohttp, the tiered fetcher or the browser"""
+    package = orchestrator.SOURCES[name]['module'].rsplit('.', 1)[0]
+    processor = importlib.import_module(f"{package}.async_individual_link_processor")
+    if hasattr(processor, 'AsyncLinkProcessor'):
+        processor.AsyncLinkProcessor.fetch_url = _timed(processor.AsyncLinkProcessor.fetch_url, latencies)
+    elif hasattr(processor, 'TIERED_FETCHER'):
+        processor.TIERED_FETCHER.fetch = _timed(processor.TIERED_FETCHER.fetch, latencies)
+    else:
+        processor.render_article = _timed(processor.render_article, latencies)
+
+
+async def run(name: str) -> Dict[str, Any]:
+    """One sweep of the source exactly as production runs it, against whatever CRONSCRAPERS_* points at"""
+    # the data dir is a fresh one, a placeholder link keeps the legacy lastsaved file from hiding most of the feed
+    get_seen_store().mark_seen(name, [f"benchmark://{name}"])
+    latencies: List[float] = []
+    _instrument(name, latencies)
+
+    result, = await orchestrator.run_all([name])
+    articles = len(get_article_store().get_articles(source=name))
+    return {
+        'source': name,
+        'status': result['status'],
+        'error': result['error'],
+        'elapsed': result['elapsed'],
+        'articles': articles,
+        'latencies': latencies,
+        # ru_maxrss is in kilobytes on linux, the browser processes show up as children
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def main():
+    setup_logging()
+    result = asyncio.run(run(sys.argv[1]))
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
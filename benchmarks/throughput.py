@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import orchestrator
+from benchmarks.replay_server import DEFAULT_FIXTURES_DIR, create_app, start_replay_server
+from benchmarks.runner import RESULT_PREFIX
+from common.recording import FixtureStore
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[round(share * 100) - 1]
+
+
+async def run_source_process(name: str, env_overrides: Dict[str, str]) -> Dict[str, Any]:
+    """Run one source in a fresh process with its own empty data dir, so its memory and state don't mix with the others"""
+    with tempfile.TemporaryDirectory(prefix=f'bench-{name}-') as workdir:
+        env = {
+            **os.environ,
+            'PYTHONPATH': os.pathsep.join(filter(None, [str(ROOT_DIR), os.environ.get('PYTHONPATH')])),
+            'CRONSCRAPERS_DATA_DIR': str(Path(workdir) / 'data'),
+            **env_overrides,
+        }
+        # the sources write their logs and the csv export into the working directory, so that's a throwaway one too
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'benchmarks.runner', name,
+            cwd=workdir, env=env, stdout=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await process.communicate()
+
+    for line in reversed(stdout.decode('utf-8', errors='replace').splitlines()):
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {'source': name, 'status': 'crashed', 'error': f"runner exited with {process.returncode}", 'elapsed': 0.0,
+            'articles': 0, 'latencies': [], 'peak_rss_kb': 0, 'children_peak_rss_kb': 0}
+
+
+def summarize(result: Dict[str, Any]) -> Dict[str, Any]:
+    latencies = result.pop('latencies')
+    p50 = percentile(latencies, 0.5)
+    p95 = percentile(latencies, 0.95)
+    return {
+        **result,
+        'fetches': len(latencies),
+        'articles_per_sec': result['articles'] / result['elapsed'] if result['elapsed'] else 0.0,
+        'p50_ms': p50 * 1000 if p50 is not None else None,
+        'p95_ms': p95 * 1000 if p95 is not None else None,
+        'peak_rss_mb': result['peak_rss_kb'] / 1024,
+        'children_peak_rss_mb': result['children_peak_rss_kb'] / 1024,
+    }
+
+
+def print_report(summaries: List[Dict[str, Any]]):
+    print(f"{'source':<15}{'status':<9}{'articles':>9}{'art/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'rss MB':>9}{'browser MB':>12}")
+    for s in summaries:
+        p50 = f"{s['p50_ms']:.1f}" if s['p50_ms'] is not None else '-'
+        p95 = f"{s['p95_ms']:.1f}" if s['p95_ms'] is not None else '-'
+        print(f"{s['source']:<15}{s['status']:<9}{s['articles']:>9}{s['articles_per_sec']:>9.2f}{p50:>9}{p95:>9}"
+              f"{s['peak_rss_mb']:>9.1f}{s['children_peak_rss_mb']:>12.1f}")
+        if s['error']:
+            print(f"  {s['error']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the sources against the replay server and report their throughput")
+    parser.add_argument('--fixtures', type=Path, default=DEFAULT_FIXTURES_DIR, help="directory written by benchmarks.record")
+    parser.add_argument('--sources', nargs='+', choices=list(orchestrator.SOURCES), default=list(orchestrator.SOURCES))
+    parser.add_argument('--latency', type=float, default=0.05, help="mean delay of every replayed response in seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="standard deviation of the delay in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of replayed requests answered with a 503")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', type=Path, default=None, help="also write the results into this file")
+    return parser.parse_args()
+
+
+async def benchmark(args) -> List[Dict[str, Any]]:
+    app = create_app(FixtureStore(args.fixtures), args.latency, args.jitter, args.error_rate, args.seed)
+    runner, replay_url = await start_replay_server(app)
+    try:
+        summaries = []
+        # one source at a time, so they don't compete for the cpu and the peak rss is their own
+        for name in args.sources:
+            result = await run_source_process(name, {'CRONSCRAPERS_REPLAY_URL': replay_url})
+            summaries.append(summarize(result))
+    finally:
+        await runner.cleanup()
+    print(f"Replay server: {app['stats']}")
+    return summaries
+
+
+def main():
+    args = parse_args()
+    summaries = asyncio.run(benchmark(args))
+    print_report(summaries)
+    if args.json is not None:
+        args.json.write_text(json.dumps(summaries, indent=1), encoding='utf-8')
+
+
+if __name__ == "__main__":
+    main()
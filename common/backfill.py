@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from common.http_client import get_session
+from common.parsing import parse_date
+from common.pipeline import ArticleSink
+from common.politeness import background_priority, get_politeness_scheduler
+from common.seen_store import get_seen_store
+from common.settings import DATA_DIR
+from common.storage import is_article
+
+
+logger = logging.getLogger(__name__)
+
+
+BACKFILL_DIR = DATA_DIR / 'backfill'
+# archive pages walked at the same time, each one streams its articles through the source's own pipeline
+DEFAULT_PAGE_CONCURRENCY = 2
+# this many archive pages failing in a row (a changed layout, a wrong selector, a ban) stops the walk
+MAX_CONSECUTIVE_FAILED_PAGES = 5
+
+
+async def fetch_archive_page(url: str) -> Optional[str]:
+    """Html of an archive page, None if the archive doesn't go that far (the page isn't there)"""
+    await get_politeness_scheduler().wait(url)
+    session = await get_session()
+    async with session.get(url) as response:
+        if response.status in (404, 410):
+            return None
+        response.raise_for_status()
+        return await response.text()
+
+
+class BackfillCheckpoint:
+    """Which archive pages of a source are done already and where the archive turned out to end, kept in a json file"""
+
+    def __init__(self, source: str, path: Optional[Union[str, Path]] = None):
+        self.source = source
+        self.path = Path(path) if path is not None else BACKFILL_DIR / f"{source}.json"
+        self.done: set = set()
+        # {'page': .., 'reason': 'empty' | 'since' | 'failing', 'since': ..} - nothing past that page is worth fetching again,
+        # except after 'failing': that's only noted, the next run walks on (once whatever broke the pages is fixed)
+        self.stopped_at: Optional[Dict[str, Any]] = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            self.done = set(state.get('done', []))
+            self.stopped_at = state.get('stopped_at')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Backfill checkpoint {self.path} is unreadable, starting from scratch: {e}")
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({'done': sorted(self.done), 'stopped_at': self.stopped_at, 'updated_at': time.time()}, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def stop_page(self, since: Optional[datetime]) -> Optional[int]:
+        """Page the archive ended at in an earlier run, a date cutoff only counts if it was the same one"""
+        if self.stopped_at is None or self.stopped_at['reason'] == 'failing':
+            return None
+        if self.stopped_at['reason'] == 'since' and self.stopped_at.get('since') != (since.date().isoformat() if since else None):
+            return None
+        return self.stopped_at['page']
+
+    def mark_done(self, page: int):
+        self.done.add(page)
+        self.save()
+
+    def mark_stop(self, page: int, reason: str, since: Optional[datetime]):
+        if reason == 'failing' and self.stop_page(since) is not None:
+            # a known end of the archive is worth more than the note of a broken run
+            return
+        if self.stopped_at is None or page < self.stopped_at['page'] or self.stop_page(since) is None:
+            self.stopped_at = {'page': page, 'reason': reason, 'since': since.date().isoformat() if since else None}
+            self.save()
+
+
+class _PageSink:
+    """Sink of one archive page - passes everything on and remembers the publication dates of the page's articles"""
+
+    def __init__(self, sink: Any, since: Optional[datetime]):
+        self.sink = sink
+        self.since = since
+        self.dates: List[Optional[datetime]] = []
+        # links of the articles left out for being older than `since`, they stay unseen for a later, longer backfill
+        self.dropped: set = set()
+
+    async def write(self, batch: List[Any]):
+        kept = []
+        for result in batch:
+            if is_article(result):
+                date = parse_date(result.get('creationDate'))
+                self.dates.append(date)
+                if self.since is not None and date is not None and date < self.since:
+                    self.dropped.add(result.get('articleLink'))
+                    continue
+            kept.append(result)
+        if kept:
+            await self.sink.write(kept)
+
+    @property
+    def all_older_than_since(self) -> bool:
+        known = [date for date in self.dates if date is not None]
+        return self.since is not None and bool(known) and all(date < self.since for date in known)
+
+
+async def run_backfill(source: str,
+                       get_page_links: Callable[[int], Awaitable[List[str]]],
+                       stream_links: Callable[[Iterable[str], Any], Awaitable[Dict[str, int]]],
+                       first_page: int,
+                       last_page: int,
+                       since: Optional[datetime] = None,
+                       concurrency: int = DEFAULT_PAGE_CONCURRENCY) -> Dict[str, int]:
+    """
+    Walk the archive pages `first_page`..`last_page` of a source (newest first) and ingest every article never seen before.
+
+    `get_page_links(page)` returns the article links of one archive page (empty past the end of the archive),
+    `stream_links(links, sink)` is the source's own fetch -> parse -> sink pipeline.
+    Every finished page is checkpointed, so an interrupted backfill picks up where it stopped.
+    The walk stops at the end of the archive, at the first page whose articles are all older than `since`,
+    or after MAX_CONSECUTIVE_FAILED_PAGES pages in a row failed.
+    Every request goes through the politeness scheduler with background priority, so the live sweep always goes first.
+    """
+    checkpoint = BackfillCheckpoint(source)
+    sink = ArticleSink(source)
+    seen_store = get_seen_store()
+    stats = {'pages': 0, 'skipped_pages': 0, 'failed_pages': 0, 'links': 0, 'new_links': 0, 'articles': 0}
+    stop_page = checkpoint.stop_page(since)
+    pages = iter(range(first_page, last_page + 1))
+    walked_links: set = set()
+    consecutive_failures = 0
+
+    async def page_worker():
+        nonlocal stop_page, consecutive_failures
+        for page in pages:
+            if stop_page is not None and page > stop_page:
+                return
+            if page in checkpoint.done:
+                stats['skipped_pages'] += 1
+                continue
+
+            try:
+                links = await get_page_links(page)
+            except Exception as e:
+                # not checkpointed, so the next run of the backfill tries the page again
+                logger.error(f"[{source}] backfill: archive page {page} failed, skipping it for now: {e}")
+                stats['failed_pages'] += 1
+                consecutive_failures += 1
+                if consecutive_failures >= MAX_CONSECUTIVE_FAILED_PAGES:
+                    logger.error(f"[{source}] backfill: {consecutive_failures} archive pages in a row failed, stopping at page {page}")
+                    stop_page = min(stop_page, page) if stop_page is not None else page
+                    checkpoint.mark_stop(page, 'failing', since)
+                    return
+                continue
+            consecutive_failures = 0
+            if not links:
+                logger.info(f"[{source}] backfill: archive page {page} is empty, that's the end of the archive")
+                stop_page = min(stop_page, page) if stop_page is not None else page
+                checkpoint.mark_stop(page, 'empty', since)
+                return
+
+            if walked_links.issuperset(links):
+                # a page number past the end (or one the site ignores) can come back with a page already walked
+                logger.info(f"[{source}] backfill: archive page {page} repeats an earlier page, that's the end of the archive")
+                stop_page = min(stop_page, page) if stop_page is not None else page
+                checkpoint.mark_stop(page, 'empty', since)
+                return
+            walked_links.update(links)
+
+            new_links = seen_store.filter_new(links)
+            page_sink = _PageSink(sink, since)
+            if new_links:
+                await stream_links(new_links, page_sink)
+            # marked seen only once the page went through, an interrupted page is simply redone on resume
+            seen_store.mark_seen(source, [link for link in new_links if link not in page_sink.dropped])
+            if not page_sink.dropped:
+                checkpoint.mark_done(page)
+            stats['pages'] += 1
+            stats['links'] += len(links)
+            stats['new_links'] += len(new_links)
+            logger.info(f"[{source}] backfill: page {page} done, {len(new_links)}/{len(links)} new links")
+
+            if page_sink.all_older_than_since:
+                logger.info(f"[{source}] backfill: page {page} is older than {since.date()}, stopping there")
+                stop_page = min(stop_page, page) if stop_page is not None else page
+                checkpoint.mark_stop(page, 'since', since)
+                return
+
+    with background_priority():
+        await asyncio.gather(*(page_worker() for _ in range(max(1, concurrency))))
+
+    stats['articles'] = sink.saved
+    logger.info(f"[{source}] backfill of pages {first_page}-{last_page} finished: {stats}")
+    return stats
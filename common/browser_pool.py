@@ -0,0 +1,346 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, FrozenSet, List, Optional
+from urllib.parse import urlsplit
+
+from playwright.async_api import async_playwright, Browser, BrowserContext, Error as PlaywrightError, Page, Playwright, Request, Response, Route
+
+from common.metrics import BYTES_RECEIVED, current_source
+from common.recording import record_response, replay_url
+from common.settings import RECORD_DIR, REPLAY_URL
+from common.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+# after serving this many pages a context is retired and replaced with a fresh one, so cookies/cache/leaked memory of a long lived context don't pile up
+MAX_PAGES_PER_CONTEXT = 50
+# how many warm contexts a single profile keeps around at most
+CONTEXTS_PER_PROFILE = 2
+# what gets saved as fixtures while recording - the rest (images, fonts, trackers...) isn't needed to replay a source
+RECORDED_RESOURCE_TYPES = {'document', 'xhr', 'fetch'}
+
+# nothing the parsers read comes from these, they only cost bandwidth and render time
+BLOCKED_RESOURCE_TYPES = frozenset({'image', 'media', 'font', 'stylesheet'})
+# ads, analytics, trackers and social widgets (subdomains included)
+BLOCKED_DOMAINS = frozenset({
+    'doubleclick.net', 'googlesyndication.com', 'googleadservices.com', 'googletagmanager.com', 'googletagservices.com',
+    'google-analytics.com', 'adservice.google.com', 'amazon-adsystem.com', 'adnxs.com', 'criteo.com', 'criteo.net',
+    'pubmatic.com', 'rubiconproject.com', 'casalemedia.com', 'openx.net', 'moatads.com', 'taboola.com', 'outbrain.com',
+    'scorecardresearch.com', 'quantserve.com', 'chartbeat.com', 'chartbeat.net', 'hotjar.com', 'clarity.ms',
+    'bat.bing.com', 'facebook.net', 'facebook.com', 'snap.licdn.com', 'ads.linkedin.com', 'platform.twitter.com',
+    'ads-twitter.com', 'disqus.com', 'disquscdn.com', 'addthis.com', 'sharethis.com', 'nr-data.net', 'segment.io',
+    'cdn.segment.com', 'optimizely.com', 'cookielaw.org', 'onetrust.com', 'cloudflareinsights.com',
+})
+# whatever cloudflare's challenge needs always goes through, even if its type is blocked
+ALLOWED_DOMAINS = frozenset({'challenges.cloudflare.com'})
+ALLOWED_PATH_PREFIXES = ('/cdn-cgi/',)
+
+
+def _domain_matches(host: str, domains: FrozenSet[str]) -> Optional[str]:
+    """The entry of `domains` the host is, or is a subdomain of"""
+    parts = host.split('.')
+    for i in range(len(parts) - 1):
+        candidate = '.'.join(parts[i:])
+        if candidate in domains:
+            return candidate
+    return None
+
+
+@dataclass(frozen=True)
+class RoutePolicy:
+    """Which requests of a page are aborted - by resource type and by domain, cloudflare's own requests are never touched"""
+    blocked_resource_types: FrozenSet[str] = BLOCKED_RESOURCE_TYPES
+    blocked_domains: FrozenSet[str] = BLOCKED_DOMAINS
+    allowed_domains: FrozenSet[str] = ALLOWED_DOMAINS
+
+    def block_reason(self, request: Request) -> Optional[str]:
+        """Why the request gets aborted, None if it's let through"""
+        parts = urlsplit(request.url)
+        host = parts.hostname or ''
+        if parts.path.startswith(ALLOWED_PATH_PREFIXES) or _domain_matches(host, self.allowed_domains):
+            return None
+        domain = _domain_matches(host, self.blocked_domains)
+        if domain is not None:
+            return f"domain:{domain}"
+        if request.resource_type in self.blocked_resource_types:
+            return f"type:{request.resource_type}"
+        return None
+
+
+class RouteStats:
+    """What a route policy let through and what it saved, for one page or summed up over a profile"""
+
+    def __init__(self):
+        self.pages = 0
+        self.allowed = 0
+        self.blocked = 0
+        self.blocked_by: Dict[str, int] = {}
+        # what the allowed requests actually transferred (headers + body)
+        self.bytes_loaded = 0
+
+    def add(self, other: 'RouteStats'):
+        self.pages += other.pages
+        self.allowed += other.allowed
+        self.blocked += other.blocked
+        self.bytes_loaded += other.bytes_loaded
+        for reason, count in other.blocked_by.items():
+            self.blocked_by[reason] = self.blocked_by.get(reason, 0) + count
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'pages': self.pages,
+            'allowed': self.allowed,
+            'blocked': self.blocked,
+            'blocked_per_page': round(self.blocked / self.pages, 1) if self.pages else 0.0,
+            'kb_loaded_per_page': round(self.bytes_loaded / 1024 / self.pages, 1) if self.pages else 0.0,
+            'blocked_by': dict(sorted(self.blocked_by.items(), key=lambda item: -item[1])),
+        }
+
+
+async def _apply_route_policy(page: Page, policy: RoutePolicy) -> RouteStats:
+    stats = RouteStats()
+    stats.pages = 1
+    # the page events come from playwright's own task, the source has to be taken now
+    source = current_source.get()
+
+    async def handle(route: Route):
+        reason = policy.block_reason(route.request)
+        if reason is None:
+            stats.allowed += 1
+            # the context level routes (replay) still get their turn
+            await route.fallback()
+        else:
+            stats.blocked += 1
+            stats.blocked_by[reason] = stats.blocked_by.get(reason, 0) + 1
+            await route.abort('blockedbyclient')
+
+    async def on_request_finished(request: Request):
+        try:
+            sizes = await request.sizes()
+        except PlaywrightError:
+            # the page was closed in the meantime
+            return
+        loaded = sizes['responseHeadersSize'] + max(sizes['responseBodySize'], 0)
+        stats.bytes_loaded += loaded
+        BYTES_RECEIVED.inc(loaded, source=source, client='browser')
+
+    await page.route('**/*', handle)
+    page.on('requestfinished', on_request_finished)
+    return stats
+
+
+@dataclass(frozen=True)
+class BrowserProfile:
+    """Everything needed to launch a browser and set up its contexts for one kind of source"""
+    name: str
+    launch_options: Dict[str, Any] = field(default_factory=dict, hash=False, compare=False)
+    context_options: Dict[str, Any] = field(default_factory=dict, hash=False, compare=False)
+    init_scripts: List[str] = field(default_factory=list, hash=False, compare=False)
+    # called on every freshly opened page (e.g. stealth_async)
+    page_setup: Optional[Callable[[Page], Awaitable[Any]]] = field(default=None, hash=False, compare=False)
+    # requests of the profile's pages that get aborted, None lets everything through
+    route_policy: Optional[RoutePolicy] = field(default=None, hash=False, compare=False)
+    # a single persistent context kept in this user data dir (its cookies, e.g. cloudflare's clearance, survive restarts),
+    # None means throwaway contexts that are rotated
+    persistent_dir: Optional[Path] = field(default=None, hash=False, compare=False)
+
+
+async def _replay_route(route: Route):
+    """Serve every request of the page from the replay server instead of the real site"""
+    response = await route.fetch(url=replay_url(route.request.url))
+    await route.fulfill(response=response)
+
+
+async def _record_browser_response(response: Response):
+    if response.request.resource_type not in RECORDED_RESOURCE_TYPES:
+        return
+    try:
+        body = await response.body()
+    except PlaywrightError:
+        # redirects and aborted requests have no body
+        return
+    record_response(response.url, response.status, response.headers.get('content-type'), body)
+
+
+class _PooledContext:
+    def __init__(self, context: BrowserContext):
+        self.context = context
+        self.pages_served = 0
+        self.active_pages = 0
+        self.retired = False
+        self.closed = False
+        context.on('close', lambda _: setattr(self, 'closed', True))
+
+
+class _ProfileState:
+    def __init__(self):
+        self.browser: Optional[Browser] = None
+        self.contexts: List[_PooledContext] = []
+        self.lock = asyncio.Lock()
+
+
+class BrowserPool:
+    """Long lived browsers (one per profile) with warm contexts that sources lease pages from"""
+
+    def __init__(self,
+                 max_pages_per_context: int = MAX_PAGES_PER_CONTEXT,
+                 contexts_per_profile: int = CONTEXTS_PER_PROFILE):
+        self.max_pages_per_context = max_pages_per_context
+        self.contexts_per_profile = contexts_per_profile
+        self._playwright: Optional[Playwright] = None
+        self._start_lock = asyncio.Lock()
+        self._profiles: Dict[str, _ProfileState] = {}
+        # per profile totals of the route policies
+        self.route_stats: Dict[str, RouteStats] = {}
+
+    async def _get_playwright(self) -> Playwright:
+        async with self._start_lock:
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            return self._playwright
+
+    async def _get_browser(self, profile: BrowserProfile, state: _ProfileState) -> Browser:
+        """Return the browser of the profile, (re)launching it if it isn't running"""
+        if state.browser is None or not state.browser.is_connected():
+            playwright = await self._get_playwright()
+            logger.info(f"Launching browser for profile '{profile.name}'")
+            state.browser = await playwright.chromium.launch(**profile.launch_options)
+            state.contexts = []
+        return state.browser
+
+    async def _new_context(self, profile: BrowserProfile, browser: Browser) -> _PooledContext:
+        context = await browser.new_context(**profile.context_options)
+        await self._setup_context(profile, context)
+        return _PooledContext(context)
+
+    async def _setup_context(self, profile: BrowserProfile, context: BrowserContext):
+        for script in profile.init_scripts:
+            await context.add_init_script(script)
+        if REPLAY_URL is not None:
+            await context.route('**/*', _replay_route)
+        if RECORD_DIR is not None:
+            context.on('response', _record_browser_response)
+
+    async def _acquire_persistent_context(self, profile: BrowserProfile, state: _ProfileState) -> _PooledContext:
+        """Return the one persistent context of the profile, (re)launching it if it isn't open - it's never rotated"""
+        pooled = state.contexts[0] if state.contexts else None
+        if pooled is None or pooled.closed:
+            playwright = await self._get_playwright()
+            Path(profile.persistent_dir).mkdir(parents=True, exist_ok=True)
+            logger.info(f"Launching persistent context for profile '{profile.name}' in {profile.persistent_dir}")
+            context = await playwright.chromium.launch_persistent_context(
+                str(profile.persistent_dir), **profile.launch_options, **profile.context_options,
+            )
+            await self._setup_context(profile, context)
+            pooled = _PooledContext(context)
+            state.contexts = [pooled]
+        pooled.active_pages += 1
+        pooled.pages_served += 1
+        return pooled
+
+    async def _acquire_context(self, profile: BrowserProfile) -> _PooledContext:
+        state = self._profiles.setdefault(profile.name, _ProfileState())
+        async with state.lock:
+            if profile.persistent_dir is not None:
+                return await self._acquire_persistent_context(profile, state)
+
+            browser = await self._get_browser(profile, state)
+
+            # pick the least busy warm context, open a new one only if all of them are busy and there's still room
+            pooled = min(state.contexts, key=lambda c: c.active_pages, default=None)
+            if pooled is None or (pooled.active_pages and len(state.contexts) < self.contexts_per_profile):
+                pooled = await self._new_context(profile, browser)
+                state.contexts.append(pooled)
+
+            pooled.active_pages += 1
+            pooled.pages_served += 1
+            if pooled.pages_served >= self.max_pages_per_context:
+                # no new leases for this one, it gets closed once its last page is returned
+                pooled.retired = True
+                state.contexts.remove(pooled)
+            return pooled
+
+    async def _release_context(self, pooled: _PooledContext):
+        pooled.active_pages -= 1
+        if pooled.retired and pooled.active_pages == 0:
+            try:
+                await pooled.context.close()
+            except Exception as e:
+                logger.warning(f"Error closing retired browser context: {e}")
+
+    @asynccontextmanager
+    async def lease_page(self, profile: BrowserProfile) -> AsyncIterator[Page]:
+        """Lease a fresh page from a warm context of the given profile, the page is closed on exit"""
+        with span('browser_lease'):
+            pooled = await self._acquire_context(profile)
+        page = None
+        route_stats = None
+        try:
+            with span('page_setup'):
+                page = await pooled.context.new_page()
+                if profile.route_policy is not None:
+                    route_stats = await _apply_route_policy(page, profile.route_policy)
+                if profile.page_setup is not None:
+                    await profile.page_setup(page)
+            yield page
+        finally:
+            if page is not None:
+                try:
+                    await page.close()
+                except Exception as e:
+                    logger.warning(f"Error closing leased page: {e}")
+            if route_stats is not None:
+                logger.debug(f"[{profile.name}] page route stats: {route_stats.as_dict()}")
+                self.route_stats.setdefault(profile.name, RouteStats()).add(route_stats)
+            await self._release_context(pooled)
+
+    async def close(self):
+        """Close every context and browser of the pool and stop playwright"""
+        for name, stats in self.route_stats.items():
+            logger.info(f"[{name}] browser route stats: {stats.as_dict()}")
+        for state in self._profiles.values():
+            async with state.lock:
+                if state.browser is None:
+                    # persistent contexts have no browser object of their own, closing the context closes the browser
+                    for pooled in state.contexts:
+                        try:
+                            await pooled.context.close()
+                        except Exception as e:
+                            logger.warning(f"Error closing persistent browser context: {e}")
+                if state.browser is not None:
+                    try:
+                        await state.browser.close()
+                    except Exception as e:
+                        logger.warning(f"Error closing browser: {e}")
+                state.browser = None
+                state.contexts = []
+        self._profiles = {}
+
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+
+# process wide pool shared by all sources
+_browser_pool: Optional[BrowserPool] = None
+
+
+def get_browser_pool() -> BrowserPool:
+    """Return the process wide browser pool, creating it on first use"""
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool()
+    return _browser_pool
+
+
+async def close_browser_pool():
+    """Close the process wide browser pool if it was ever started"""
+    global _browser_pool
+    if _browser_pool is not None:
+        await _browser_pool.close()
+        _browser_pool = None
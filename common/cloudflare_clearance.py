@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+from urllib.parse import urlsplit
+
+from playwright.async_api import Page
+
+from common.settings import DATA_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+CLEARANCE_FILE = DATA_DIR / 'cf_clearance.json'
+CLEARANCE_COOKIE = 'cf_clearance'
+# a clearance is dropped this many seconds before it really expires, so it never runs out mid-request
+EXPIRY_MARGIN = 60
+# lifetime assumed for a session cookie (no expiry of its own)
+SESSION_COOKIE_LIFETIME = 30 * 60
+
+
+class Clearance:
+    """Cookies of a host that passed cloudflare's challenge, valid only together with the user agent that solved it"""
+
+    def __init__(self, host: str, cookies: Dict[str, str], user_agent: str, expires: float):
+        self.host = host
+        self.cookies = cookies
+        self.user_agent = user_agent
+        self.expires = expires
+
+    @property
+    def valid(self) -> bool:
+        return time.time() < self.expires - EXPIRY_MARGIN
+
+    def headers(self) -> Dict[str, str]:
+        """Headers that make a plain http request look like the browser session that got the clearance"""
+        return {
+            'User-Agent': self.user_agent,
+            'Cookie': '; '.join(f"{name}={value}" for name, value in self.cookies.items()),
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'cookies': self.cookies, 'user_agent': self.user_agent, 'expires': self.expires}
+
+
+class ClearanceManager:
+    """Persistent store of cloudflare clearances per host, filled from the browser and used by the http client"""
+
+    def __init__(self, path: Union[str, Path] = CLEARANCE_FILE):
+        self.path = Path(path)
+        self._clearances: Optional[Dict[str, Clearance]] = None
+
+    def _load(self) -> Dict[str, Clearance]:
+        if self._clearances is None:
+            self._clearances = {}
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    for host, entry in json.load(file).items():
+                        self._clearances[host] = Clearance(host, entry['cookies'], entry['user_agent'], entry['expires'])
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Clearance file {self.path} is unreadable, starting from scratch: {e}")
+        return self._clearances
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump({host: clearance.as_dict() for host, clearance in self._clearances.items()}, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def get(self, url: str) -> Optional[Clearance]:
+        """The still valid clearance of the url's host, None if there's none"""
+        clearance = self._load().get(urlsplit(url).hostname or '')
+        return clearance if clearance is not None and clearance.valid else None
+
+    def invalidate(self, url: str):
+        """Forget the clearance of the url's host, e.g. after it got challenged again in spite of it"""
+        host = urlsplit(url).hostname or ''
+        if self._load().pop(host, None) is not None:
+            logger.info(f"Clearance of {host} no longer works, dropping it")
+            self._save()
+
+    async def harvest(self, page: Page, url: str) -> Optional[Clearance]:
+        """Take the clearance out of a page that just got through the challenge, None if it holds none"""
+        cookies = await page.context.cookies(url)
+        cf_clearance = next((cookie for cookie in cookies if cookie['name'] == CLEARANCE_COOKIE), None)
+        if cf_clearance is None:
+            return None
+
+        host = urlsplit(url).hostname or ''
+        known = self._load().get(host)
+        if known is not None and known.cookies.get(CLEARANCE_COOKIE) == cf_clearance['value']:
+            return known
+
+        expires = cf_clearance.get('expires', -1)
+        if expires is None or expires <= 0:
+            expires = time.time() + SESSION_COOKIE_LIFETIME
+        clearance = Clearance(
+            host,
+            {cookie['name']: cookie['value'] for cookie in cookies},
+            await page.evaluate('navigator.userAgent'),
+            expires,
+        )
+        self._clearances[host] = clearance
+        self._save()
+        logger.info(f"Got a cloudflare clearance for {host}, valid for {(expires - time.time()) / 60:.0f} min")
+        return clearance
+
+
+_clearance_manager: Optional[ClearanceManager] = None
+
+
+def get_clearance_manager() -> ClearanceManager:
+    """Return the process wide clearance manager"""
+    global _clearance_manager
+    if _clearance_manager is None:
+        _clearance_manager = ClearanceManager()
+    return _clearance_manager
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from common.http_client import get_session
+from common.metrics import CACHE_LOOKUPS, COLLECTOR_FETCH_SECONDS, current_source, timed
+from common.politeness import get_politeness_scheduler
+from common.settings import DATA_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+VALIDATORS_FILE = DATA_DIR / 'validators.json'
+
+
+class ConditionalResponse:
+    """Result of a conditional GET - `unchanged` means the resource is the same as the last committed one"""
+
+    def __init__(self,
+                 url: str,
+                 status: int,
+                 body: Optional[bytes],
+                 encoding: Optional[str],
+                 etag: Optional[str],
+                 last_modified: Optional[str],
+                 digest: Optional[str],
+                 unchanged: bool):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.unchanged = unchanged
+
+    def text(self) -> str:
+        return self.body.decode(self.encoding or 'utf-8', errors='replace')
+
+
+class ValidatorCache:
+    """Persistent ETag / Last-Modified / body hash validators keyed by url"""
+
+    def __init__(self, path: Path = VALIDATORS_FILE):
+        self.path = Path(path)
+        self._entries: Optional[Dict[str, Dict[str, str]]] = None
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        if self._entries is None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    self._entries = json.load(file)
+            except FileNotFoundError:
+                self._entries = {}
+            except (OSError, ValueError) as e:
+                logger.warning(f"Validator cache {self.path} is unreadable, starting from scratch: {e}")
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self._entries, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    async def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> ConditionalResponse:
+        """GET the url sending the stored validators, raising on error statuses"""
+        entry = self._load().get(url, {})
+        request_headers = dict(headers or {})
+        if entry.get('etag'):
+            request_headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            request_headers['If-Modified-Since'] = entry['last_modified']
+
+        await get_politeness_scheduler().wait(url)
+        session = await get_session()
+        with timed(COLLECTOR_FETCH_SECONDS) as stage:
+            async with session.get(url, headers=request_headers) as response:
+                if response.status == 304:
+                    logger.info(f"{url} not modified (304), skipping")
+                    stage.outcome = 'not_modified'
+                    CACHE_LOOKUPS.inc(source=current_source.get(), cache='validators', result='hit')
+                    return ConditionalResponse(url, 304, None, None, entry.get('etag'), entry.get('last_modified'), entry.get('digest'), unchanged=True)
+
+                response.raise_for_status()
+                body = await response.read()
+                digest = hashlib.sha256(body).hexdigest()
+                # some servers don't support validators at all, the body hash still lets us skip the parsing
+                unchanged = digest == entry.get('digest')
+                if unchanged:
+                    logger.info(f"{url} body is unchanged since the last run, skipping")
+                    stage.outcome = 'unchanged'
+                CACHE_LOOKUPS.inc(source=current_source.get(), cache='validators', result='hit' if unchanged else 'miss')
+                return ConditionalResponse(
+                    url,
+                    response.status,
+                    body,
+                    response.get_encoding(),
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'),
+                    digest,
+                    unchanged=unchanged,
+                )
+
+    def commit(self, response: ConditionalResponse):
+        """Remember the validators of a response, call it only once the response was processed successfully"""
+        self._load()[response.url] = {
+            'etag': response.etag,
+            'last_modified': response.last_modified,
+            'digest': response.digest,
+            'checked_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self._save()
+
+
+_validator_cache: Optional[ValidatorCache] = None
+
+
+def get_validator_cache() -> ValidatorCache:
+    """Return the process wide validator cache"""
+    global _validator_cache
+    if _validator_cache is None:
+        _validator_cache = ValidatorCache()
+    return _validator_cache
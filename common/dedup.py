@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import re
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from common.storage import ArticleStore, get_article_store
+
+
+logger = logging.getLogger(__name__)
+
+
+# words per shingle - 3 is enough to tell a shared story apart from a shared vocabulary
+SHINGLE_SIZE = 3
+# minhash signature of NUM_PERM values, cut into BANDS bands of ROWS values for the lsh index
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+# estimated jaccard similarity of the shingle sets from which two articles count as the same story
+DUPLICATE_THRESHOLD = 0.5
+# articles clustered per transaction
+BATCH_SIZE = 500
+# boilerplate can fill a bucket with unrelated articles, no more than this many candidates are taken out of one
+MAX_BUCKET_CANDIDATES = 50
+
+_WORD = re.compile(r'\w+')
+# the hash functions are fixed once and for all, signatures are stored and compared across runs
+_RANDOM = np.random.default_rng(20250527)
+_PERM_A = _RANDOM.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_PERM_B = _RANDOM.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingle_hashes(text: Optional[str]) -> np.ndarray:
+    """64 bit hashes of the word shingles of the text, lowercased so the formatting of a source doesn't matter"""
+    words = _WORD.findall((text or '').lower())
+    if len(words) < SHINGLE_SIZE:
+        shingles = {' '.join(words)} if words else set()
+    else:
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little') for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+
+
+def minhash(hashes: np.ndarray) -> Optional[np.ndarray]:
+    """Minhash signature of a set of shingle hashes (multiply-shift hashing, the upper 32 bits), None for an empty set"""
+    if not len(hashes):
+        return None
+    # uint64 arithmetic wraps around, which is exactly the modulo 2^64 of the hash family
+    with np.errstate(over='ignore'):
+        permuted = (hashes[:, None] * _PERM_A + _PERM_B) >> np.uint64(32)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def band_buckets(signature: np.ndarray) -> List[int]:
+    """Bucket of the signature in every band - two articles sharing any bucket are candidate duplicates"""
+    return [
+        int.from_bytes(hashlib.blake2b(band.tobytes(), digest_size=8).digest(), 'little', signed=True)
+        for band in signature.reshape(BANDS, ROWS)
+    ]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Jaccard similarity of the two shingle sets, estimated from their signatures"""
+    return float(np.count_nonzero(a == b)) / NUM_PERM
+
+
+class NearDuplicateIndex:
+    """Minhash signatures and lsh buckets of the articles, kept in the article database next to them"""
+
+    def __init__(self, store: Optional[ArticleStore] = None):
+        self.store = store or get_article_store()
+        with self.store.lock, self.store.connection as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS article_signatures (
+                    article_id INTEGER PRIMARY KEY,
+                    signature BLOB
+                )
+            ''')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS lsh_buckets (
+                    band INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    article_id INTEGER NOT NULL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS idx_lsh_buckets ON lsh_buckets (band, bucket)')
+            connection.execute('CREATE INDEX IF NOT EXISTS idx_lsh_buckets_article ON lsh_buckets (article_id)')
+
+    def _candidates(self, article_id: int, buckets: List[int]) -> Dict[int, np.ndarray]:
+        connection = self.store.connection
+        candidate_ids = set()
+        for band, bucket in enumerate(buckets):
+            candidate_ids.update(row[0] for row in connection.execute(
+                'SELECT article_id FROM lsh_buckets WHERE band = ? AND bucket = ? LIMIT ?',
+                (band, bucket, MAX_BUCKET_CANDIDATES),
+            ))
+        candidate_ids.discard(article_id)
+        if not candidate_ids:
+            return {}
+        rows = connection.execute(
+            f"SELECT article_id, signature FROM article_signatures WHERE article_id IN ({', '.join('?' * len(candidate_ids))})",
+            list(candidate_ids),
+        )
+        return {row[0]: np.frombuffer(row[1], dtype=np.uint32) for row in rows if row[1] is not None}
+
+    def _cluster_batch(self, rows: List[Any]) -> Dict[str, int]:
+        """Sign the batch and put every article into the cluster of its most similar earlier article (or a new one)"""
+        stats = {'articles': 0, 'duplicates': 0}
+        # the signing is the expensive part and needs no database, so it's done before taking the lock
+        signed = [(article_id, minhash(shingle_hashes(text))) for article_id, text in rows]
+        connection = self.store.connection
+        with self.store.lock, connection:
+            for article_id, signature in signed:
+                # the text changed since it was last clustered, its old buckets are stale
+                connection.execute('DELETE FROM lsh_buckets WHERE article_id = ?', (article_id,))
+                # and if it headed a cluster, the other articles of that one were duplicates of the old text: the oldest of
+                # them becomes their head, instead of them following the article into whatever cluster its new text joins
+                new_head = connection.execute('SELECT MIN(id) FROM articles WHERE cluster_id = ? AND id != ?',
+                                              (article_id, article_id)).fetchone()[0]
+                if new_head is not None:
+                    connection.execute('UPDATE articles SET cluster_id = ? WHERE cluster_id = ? AND id != ?',
+                                       (new_head, article_id, article_id))
+                cluster_id = article_id
+                if signature is not None:
+                    buckets = band_buckets(signature)
+                    best_id, best_similarity = None, DUPLICATE_THRESHOLD
+                    for candidate_id, candidate in self._candidates(article_id, buckets).items():
+                        candidate_similarity = similarity(signature, candidate)
+                        if candidate_similarity >= best_similarity:
+                            best_id, best_similarity = candidate_id, candidate_similarity
+                    if best_id is not None:
+                        cluster_id = connection.execute('SELECT cluster_id FROM articles WHERE id = ?', (best_id,)).fetchone()[0] or best_id
+                        stats['duplicates'] += 1
+                    connection.executemany(
+                        'INSERT INTO lsh_buckets (band, bucket, article_id) VALUES (?, ?, ?)',
+                        [(band, bucket, article_id) for band, bucket in enumerate(buckets)],
+                    )
+                connection.execute(
+                    'INSERT OR REPLACE INTO article_signatures (article_id, signature) VALUES (?, ?)',
+                    (article_id, signature.tobytes() if signature is not None else None),
+                )
+                connection.execute('UPDATE articles SET cluster_id = ? WHERE id = ?', (cluster_id, article_id))
+                stats['articles'] += 1
+        return stats
+
+    def assign_clusters(self, batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+        """Cluster every article that isn't clustered yet (new ones and the ones whose text changed), oldest first"""
+        stats = {'articles': 0, 'duplicates': 0}
+        last_id = 0
+        while True:
+            with self.store.lock:
+                rows = self.store.connection.execute(
+                    'SELECT id, article_text FROM articles WHERE cluster_id IS NULL AND id > ? ORDER BY id LIMIT ?',
+                    (last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for key, value in self._cluster_batch(rows).items():
+                stats[key] += value
+        if stats['articles']:
+            logger.info(f"Clustered {stats['articles']} articles, {stats['duplicates']} of them near-duplicates of earlier ones")
+        return stats
+
+
+_near_duplicate_index: Optional[NearDuplicateIndex] = None
+
+
+def get_near_duplicate_index() -> NearDuplicateIndex:
+    """Return the process wide near-duplicate index"""
+    global _near_duplicate_index
+    if _near_duplicate_index is None:
+        _near_duplicate_index = NearDuplicateIndex()
+    return _near_duplicate_index
+
+
+def assign_clusters() -> Dict[str, int]:
+    """Put the newly saved articles into their clusters of near-duplicates, never raising (the articles are saved anyway)"""
+    try:
+        return get_near_duplicate_index().assign_clusters()
+    except Exception as e:
+        logger.exception(f"Clustering the new articles failed: {e}")
+        return {'articles': 0, 'duplicates': 0}
@@ -0,0 +1,215 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from common.metrics import CACHE_LOOKUPS, current_source
+from common.pipeline import run_pipeline
+from common.settings import DATA_DIR
+from common.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+HTML_CACHE_DIR = DATA_DIR / 'html_cache'
+# a cached page isn't served to a regular fetch once it's older than this (reparsing still uses it until it's evicted)
+HTML_CACHE_TTL = 30 * 24 * 60 * 60
+# once the compressed blobs take more than this, the least recently used pages are dropped
+HTML_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# eviction is a few queries, so it's only done every this many writes
+EVICT_EVERY = 50
+
+
+class HtmlCache:
+    """
+    Content addressed cache of fetched/rendered pages.
+
+    The bodies are zlib compressed files named by their sha256 (identical pages are stored once),
+    a sqlite index maps every url to its current body, its source and when it was fetched/last used.
+    """
+
+    def __init__(self,
+                 path: Union[str, Path] = HTML_CACHE_DIR,
+                 ttl: float = HTML_CACHE_TTL,
+                 max_bytes: int = HTML_CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.blobs_dir = self.path / 'blobs'
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        # the connection is shared with worker threads, the lock keeps the access serialised
+        self.connection = sqlite3.connect(self.path / 'index.sqlite', check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_pages_source ON pages (source)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_pages_accessed_at ON pages (accessed_at)')
+        self.connection.commit()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.blobs_dir / digest[:2] / f"{digest}.zlib"
+
+    def _read_blob(self, digest: str) -> Optional[str]:
+        try:
+            return zlib.decompress(self._blob_path(digest).read_bytes()).decode('utf-8')
+        except (OSError, zlib.error) as e:
+            logger.warning(f"Cached body {digest} is unreadable: {e}")
+            return None
+
+    def get(self, url: str, max_age: Optional[float] = -1) -> Optional[str]:
+        """Cached body of the url, None if there's none younger than `max_age` (the cache's ttl by default, None for any age)"""
+        max_age = self.ttl if max_age == -1 else max_age
+        with self.lock:
+            row = self.connection.execute('SELECT digest, fetched_at FROM pages WHERE url = ?', (url,)).fetchone()
+            if row is None or (max_age is not None and time.time() - row[1] > max_age):
+                self.misses += 1
+                return None
+            html = self._read_blob(row[0])
+            if html is None:
+                self.misses += 1
+                return None
+            with self.connection:
+                self.connection.execute('UPDATE pages SET accessed_at = ? WHERE url = ?', (time.time(), url))
+            self.hits += 1
+            return html
+
+    def put(self, source: str, url: str, html: str):
+        """Store the body of the url, the blob is only written if that exact content isn't cached yet"""
+        body = html.encode('utf-8')
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        with self.lock:
+            if self.connection.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone() is None:
+                blob = zlib.compress(body, 6)
+                blob_path = self._blob_path(digest)
+                blob_path.parent.mkdir(exist_ok=True)
+                tmp_path = blob_path.with_suffix('.tmp')
+                tmp_path.write_bytes(blob)
+                os.replace(tmp_path, blob_path)
+                with self.connection:
+                    self.connection.execute('INSERT INTO blobs (digest, size) VALUES (?, ?)', (digest, len(blob)))
+            with self.connection:
+                self.connection.execute(
+                    'INSERT INTO pages (url, source, digest, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(url) DO UPDATE SET source = excluded.source, digest = excluded.digest, '
+                    'fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at',
+                    (url, source, digest, now, now),
+                )
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict()
+
+    def urls(self, source: Optional[str] = None) -> List[str]:
+        """Every cached url (of the source), oldest fetch first"""
+        query = 'SELECT url FROM pages'
+        params: List[Any] = []
+        if source is not None:
+            query += ' WHERE source = ?'
+            params.append(source)
+        query += ' ORDER BY fetched_at'
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query, params)]
+
+    def _evict(self):
+        """Drop the expired pages, then the least recently used ones until the blobs fit in `max_bytes` (call with the lock held)"""
+        with self.connection:
+            expired = self.connection.execute('DELETE FROM pages WHERE fetched_at < ?', (time.time() - self.ttl,)).rowcount
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            dropped = 0
+            if total > self.max_bytes:
+                rows = self.connection.execute(
+                    'SELECT pages.url, pages.digest, blobs.size FROM pages JOIN blobs ON blobs.digest = pages.digest ORDER BY pages.accessed_at'
+                ).fetchall()
+                # a blob shared by several urls only frees its space together with the last of them
+                references: Dict[str, int] = {}
+                for _, digest, _ in rows:
+                    references[digest] = references.get(digest, 0) + 1
+                to_drop = []
+                for url, digest, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    to_drop.append((url,))
+                    references[digest] -= 1
+                    if not references[digest]:
+                        total -= size
+                self.connection.executemany('DELETE FROM pages WHERE url = ?', to_drop)
+                dropped = len(to_drop)
+            orphans = [row[0] for row in self.connection.execute(
+                'SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM pages)'
+            )]
+            self.connection.executemany('DELETE FROM blobs WHERE digest = ?', [(digest,) for digest in orphans])
+        for digest in orphans:
+            try:
+                self._blob_path(digest).unlink()
+            except FileNotFoundError:
+                pass
+        if expired or dropped:
+            logger.info(f"HTML cache: evicted {expired} expired and {dropped} least recently used pages, {len(orphans)} blobs removed")
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def close(self):
+        self.connection.close()
+
+
+_html_cache: Optional[HtmlCache] = None
+
+
+def get_html_cache() -> HtmlCache:
+    """Return the process wide html cache"""
+    global _html_cache
+    if _html_cache is None:
+        _html_cache = HtmlCache()
+    return _html_cache
+
+
+async def cached_html(url: str, max_age: Optional[float] = -1) -> Optional[str]:
+    """Cached body of the url, looked up off the event loop"""
+    with span('cache_lookup') as attributes:
+        html = await asyncio.to_thread(get_html_cache().get, url, max_age)
+        attributes['hit'] = html is not None
+    CACHE_LOOKUPS.inc(source=current_source.get(), cache='html', result='hit' if html is not None else 'miss')
+    return html
+
+
+async def cache_html(source: str, url: str, html: str):
+    """Store a fetched body, off the event loop - a failing cache never fails the fetch"""
+    try:
+        with span('cache_write'):
+            await asyncio.to_thread(get_html_cache().put, source, url, html)
+    except Exception as e:
+        logger.warning(f"Couldn't cache {url}: {e}")
+
+
+async def reparse_from_cache(source: str, parse: Callable[[str, str], Any], sink: Any) -> Dict[str, int]:
+    """Run every cached page of the source through its parser again, without a single request"""
+    urls = await asyncio.to_thread(get_html_cache().urls, source)
+    logger.info(f"[{source}] reparsing {len(urls)} cached pages")
+    return await run_pipeline(urls, fetch=lambda url: cached_html(url, max_age=None), parse=parse, sink=sink, fetch_workers=1)
@@ -0,0 +1,185 @@
+import logging
+import ssl
+from types import SimpleNamespace
+from typing import Any, Dict, Optional
+
+import aiohttp
+from yarl import URL
+
+from common.metrics import BYTES_RECEIVED, current_source
+from common.recording import record_response, replay_url
+from common.settings import RECORD_DIR, REPLAY_URL
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TIMEOUT = 30
+# connection pool limits of the shared connector
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 6
+# resolved hosts are kept for this many seconds
+DNS_CACHE_TTL = 300
+# idle keep-alive connections are kept open for this many seconds
+KEEPALIVE_TIMEOUT = 60
+
+# brotli is optional - aiohttp decodes `br` bodies only if one of these packages is installed
+try:
+    import brotli  # noqa: F401
+    HAS_BROTLI = True
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        HAS_BROTLI = True
+    except ImportError:
+        HAS_BROTLI = False
+
+ACCEPT_ENCODING = 'gzip, deflate, br' if HAS_BROTLI else 'gzip, deflate'
+
+
+class ConnectionStats:
+    """Counters of how often the shared connector could reuse a connection instead of opening (and handshaking) a new one"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.per_host: Dict[str, Dict[str, int]] = {}
+
+    def _host(self, host: str) -> Dict[str, int]:
+        return self.per_host.setdefault(host, {'requests': 0, 'new_connections': 0, 'reused_connections': 0})
+
+    @property
+    def reuse_ratio(self) -> float:
+        connections = self.new_connections + self.reused_connections
+        return self.reused_connections / connections if connections else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_ratio': round(self.reuse_ratio, 3),
+            'dns_cache_hits': self.dns_cache_hits,
+            'dns_cache_misses': self.dns_cache_misses,
+            'per_host': self.per_host,
+        }
+
+
+_stats = ConnectionStats()
+
+
+def get_connection_stats() -> ConnectionStats:
+    """Return the connection reuse statistics of the shared session"""
+    return _stats
+
+
+def _build_trace_config() -> aiohttp.TraceConfig:
+    # the per-request context remembers the host, since the connection signals don't carry it
+    trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=lambda trace_request_ctx: SimpleNamespace(host=None))
+
+    async def on_request_start(session, ctx, params):
+        ctx.host = params.url.host
+        _stats.requests += 1
+        _stats._host(ctx.host)['requests'] += 1
+
+    async def on_connection_create_end(session, ctx, params):
+        _stats.new_connections += 1
+        if ctx.host:
+            _stats._host(ctx.host)['new_connections'] += 1
+
+    async def on_connection_reuseconn(session, ctx, params):
+        _stats.reused_connections += 1
+        if ctx.host:
+            _stats._host(ctx.host)['reused_connections'] += 1
+
+    async def on_response_chunk_received(session, ctx, params):
+        BYTES_RECEIVED.inc(len(params.chunk), source=current_source.get(), client='http')
+
+    async def on_dns_cache_hit(session, ctx, params):
+        _stats.dns_cache_hits += 1
+
+    async def on_dns_cache_miss(session, ctx, params):
+        _stats.dns_cache_misses += 1
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+    trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+    return trace_config
+
+
+async def _offline_middleware(request: aiohttp.ClientRequest, handler) -> aiohttp.ClientResponse:
+    """Sends the request to the replay server instead and/or records its response as a fixture (see benchmarks/)"""
+    url = str(request.url)
+    if REPLAY_URL is not None:
+        request.url = URL(replay_url(url), encoded=True)
+    response = await handler(request)
+    if RECORD_DIR is not None:
+        # the body stays cached on the response, so the caller can still read it
+        record_response(url, response.status, response.content_type, await response.read())
+    return response
+
+
+# process wide session shared by all collectors and processors
+_session: Optional[aiohttp.ClientSession] = None
+# one ssl context for every connection, so the CA bundle is loaded once instead of per session
+_ssl_context: Optional[ssl.SSLContext] = None
+
+
+def _get_ssl_context() -> ssl.SSLContext:
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Return the process wide aiohttp session, creating it on first use"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONNECTIONS,
+            limit_per_host=MAX_CONNECTIONS_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ssl=_get_ssl_context(),
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Accept-Encoding': ACCEPT_ENCODING},
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+            trace_configs=[_build_trace_config()],
+            middlewares=(_offline_middleware,) if REPLAY_URL is not None or RECORD_DIR is not None else (),
+        )
+    return _session
+
+
+async def close_session():
+    """Close the process wide session if it was ever opened"""
+    global _session
+    if _session is not None and not _session.closed:
+        logger.info(f"HTTP connection stats: {_stats.as_dict()}")
+        await _session.close()
+    _session = None
+
+
+async def fetch_bytes(url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+    """GET the url with the shared session and return the raw body, raising on error statuses"""
+    session = await get_session()
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+async def fetch_text(url: str, headers: Optional[Dict[str, str]] = None) -> str:
+    """GET the url with the shared session and return the decoded body, raising on error statuses"""
+    session = await get_session()
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        return await response.text()
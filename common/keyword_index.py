@@ -0,0 +1,416 @@
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import unicodedata
+from collections import Counter
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from common.parsing import parse_date
+from common.settings import DATA_DIR
+from common.storage import ArticleStore, get_article_store
+from common.text import tokenize
+
+
+logger = logging.getLogger(__name__)
+
+
+KEYWORD_INDEX_DIR = DATA_DIR / 'keyword_index'
+# bm25 parameters, the usual ones
+K1 = 1.2
+B = 0.75
+# the title counts this many times, a word in it says more about the article than one somewhere in the text
+TITLE_WEIGHT = 2
+# articles indexed per read from the article store (and at most per new segment)
+UPDATE_BATCH_SIZE = 5000
+# segments of the same size tier (powers of MERGE_FACTOR articles) are merged once there are this many of them
+MERGE_FACTOR = 8
+
+# polish letters that don't decompose into a base letter and a combining accent
+_FOLD = str.maketrans({'ł': 'l', 'ø': 'o', 'ß': 'ss'})
+# polish inflection (and the most common english endings), longest first; only stripped off long enough words
+_SUFFIXES = sorted({
+    'ami', 'ach', 'ego', 'emu', 'owi', 'ymi', 'imi', 'ych', 'ich', 'owa', 'owe', 'owy', 'ow', 'om', 'em', 'ie', 'ej',
+    'y', 'i', 'a', 'u', 'o', 'e',
+    'ing', 'ed', 'es', 's',
+}, key=len, reverse=True)
+MIN_STEM = 4
+_EPOCH = date(1970, 1, 1)
+
+
+def normalize(token: str) -> str:
+    """Accent folded, crudely stemmed form of a token, so 'złośliwego' and 'zlosliwe' or 'attacks' and 'attack' meet"""
+    token = unicodedata.normalize('NFKD', token.translate(_FOLD))
+    token = ''.join(char for char in token if not unicodedata.combining(char))
+    if not token.isalpha():
+        return token
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= MIN_STEM:
+            return token[:-len(suffix)]
+    return token
+
+
+def analyze(text: Optional[str]) -> List[str]:
+    return [normalize(token) for token in tokenize(text)]
+
+
+def _day(value: Optional[Union[str, date, datetime]]) -> int:
+    """Days since the epoch (-1 if unknown), the date filters compare those"""
+    if isinstance(value, str):
+        value = parse_date(value)
+    if value is None:
+        return -1
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - _EPOCH).days
+
+
+class Segment:
+    """
+    Immutable piece of the index: postings of its terms memory mapped, plus the id, length, date and source of its articles
+    and the text revision they were indexed at (0 for the text the article was first saved with).
+    """
+
+    ARRAYS = ('postings_docs', 'postings_tf', 'doc_ids', 'doc_lengths', 'doc_days', 'doc_sources', 'doc_versions')
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.name = path.name
+        with open(path / 'terms.json', 'r', encoding='utf-8') as file:
+            # term -> [start, count] in the postings arrays
+            self.terms: Dict[str, List[int]] = json.load(file)
+        for name in self.ARRAYS:
+            if name == 'doc_versions' and not (path / f"{name}.npy").exists():
+                # a segment written before the articles had revisions
+                self.doc_versions = np.zeros(len(self.doc_ids), dtype=np.int64)
+                continue
+            setattr(self, name, np.load(path / f"{name}.npy", mmap_mode='r'))
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        start, count = self.terms.get(term, (0, 0))
+        return self.postings_docs[start:start + count], self.postings_tf[start:start + count]
+
+    @staticmethod
+    def write(path: Path, postings: Dict[str, Tuple[np.ndarray, np.ndarray]], docs: Dict[str, np.ndarray]) -> 'Segment':
+        """Write a segment out of {term: (doc ordinals, term frequencies)} and the per doc arrays"""
+        tmp_path = path.with_name(path.name + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        terms: Dict[str, List[int]] = {}
+        start = 0
+        for term in sorted(postings):
+            count = len(postings[term][0])
+            terms[term] = [start, count]
+            start += count
+        ordered = [postings[term] for term in terms]
+        arrays = {
+            'postings_docs': np.concatenate([term_docs for term_docs, _ in ordered]).astype(np.int32) if ordered else np.zeros(0, np.int32),
+            'postings_tf': np.concatenate([tf for _, tf in ordered]).astype(np.uint16) if ordered else np.zeros(0, np.uint16),
+            **docs,
+        }
+        for name in Segment.ARRAYS:
+            np.save(tmp_path / f"{name}.npy", arrays[name])
+        with open(tmp_path / 'terms.json', 'w', encoding='utf-8') as file:
+            json.dump(terms, file, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        return Segment(path)
+
+
+class KeywordIndex:
+    """
+    On-disk BM25 inverted index of the article titles and texts, built out of immutable segments.
+    New articles go into a new small segment on every update, similar sized segments are merged in the background.
+    An article whose title or text changed is indexed again into a new segment, its older copies are left out of
+    the searches (and out of the segments merged) from then on.
+    """
+
+    def __init__(self, path: Union[str, Path] = KEYWORD_INDEX_DIR, store: Optional[ArticleStore] = None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.store = store or get_article_store()
+        # guards the manifest and the list of open segments, searches take a snapshot of them
+        self.lock = threading.Lock()
+        # only one update or merge writes segments at a time
+        self._write_lock = threading.Lock()
+        self._merge_thread: Optional[threading.Thread] = None
+        self.manifest = {
+            'segments': [], 'next_segment': 0, 'last_article_id': 0, 'documents': 0, 'total_length': 0, 'sources': [],
+            # the latest text revision of every article indexed again, {article id: revision}
+            'last_revision': 0, 'revised': {},
+        }
+        try:
+            with open(self.path / 'manifest.json', 'r', encoding='utf-8') as file:
+                self.manifest.update(json.load(file))
+        except FileNotFoundError:
+            pass
+        self.segments = [Segment(self.path / name) for name in self.manifest['segments']]
+        self._stale_masks: Dict[str, np.ndarray] = {}
+        self._load_revised()
+
+    def _load_revised(self):
+        """Sorted arrays of the revised article ids and their latest revisions, the stale masks are computed off them"""
+        revised = sorted((int(article_id), version) for article_id, version in self.manifest['revised'].items())
+        self._revised_ids = np.array([article_id for article_id, _ in revised], dtype=np.int64)
+        self._revised_versions = np.array([version for _, version in revised], dtype=np.int64)
+        self._stale_masks = {}
+
+    def _stale(self, segment: Segment) -> np.ndarray:
+        """Which articles of the segment were indexed again since, with a newer revision of their text"""
+        mask = self._stale_masks.get(segment.name)
+        if mask is None:
+            mask = np.zeros(len(segment), dtype=bool)
+            if len(self._revised_ids) and len(segment):
+                position = np.minimum(np.searchsorted(self._revised_ids, segment.doc_ids), len(self._revised_ids) - 1)
+                mask = (self._revised_ids[position] == segment.doc_ids) & (segment.doc_versions < self._revised_versions[position])
+            self._stale_masks[segment.name] = mask
+        return mask
+
+    def _recount(self):
+        """Documents and their total length over the current copies only"""
+        documents = total_length = 0
+        for segment in self.segments:
+            current = ~self._stale(segment)
+            documents += int(np.count_nonzero(current))
+            total_length += int(segment.doc_lengths[current].sum())
+        self.manifest['documents'] = documents
+        self.manifest['total_length'] = total_length
+
+    def _save_manifest(self):
+        tmp_path = self.path / 'manifest.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(tmp_path, self.path / 'manifest.json')
+
+    def _source_code(self, source: str) -> int:
+        if source not in self.manifest['sources']:
+            self.manifest['sources'].append(source)
+        return self.manifest['sources'].index(source)
+
+    def _new_segment_path(self) -> Path:
+        with self.lock:
+            name = f"seg-{self.manifest['next_segment']:06d}"
+            self.manifest['next_segment'] += 1
+        return self.path / name
+
+    def _build_segment(self, articles: List[Dict[str, Any]]) -> Tuple[Segment, int]:
+        term_docs: Dict[str, List[int]] = {}
+        term_tfs: Dict[str, List[int]] = {}
+        lengths, days, sources = [], [], []
+        with self.lock:
+            source_codes = [self._source_code(article['source']) for article in articles]
+        for ordinal, article in enumerate(articles):
+            tokens = analyze(article['articleTitle']) * TITLE_WEIGHT + analyze(article['articleText'])
+            for term, count in Counter(tokens).items():
+                term_docs.setdefault(term, []).append(ordinal)
+                term_tfs.setdefault(term, []).append(min(count, 65535))
+            lengths.append(len(tokens))
+            day = _day(article['creationDate'])
+            days.append(day if day >= 0 else _day(article['fetchingDate']))
+            sources.append(source_codes[ordinal])
+        postings = {term: (np.array(term_docs[term]), np.array(term_tfs[term])) for term in term_docs}
+        docs = {
+            'doc_ids': np.array([article['id'] for article in articles], dtype=np.int64),
+            'doc_lengths': np.array(lengths, dtype=np.int32),
+            'doc_days': np.array(days, dtype=np.int32),
+            'doc_sources': np.array(sources, dtype=np.uint8),
+            'doc_versions': np.array([article.get('revision') or 0 for article in articles], dtype=np.int64),
+        }
+        return Segment.write(self._new_segment_path(), postings, docs), sum(lengths)
+
+    def update(self, batch_size: int = UPDATE_BATCH_SIZE) -> int:
+        """Index the articles saved since the last update as new segments and return how many were added"""
+        added = 0
+        with self._write_lock:
+            while True:
+                articles = self.store.get_articles(since_id=self.manifest['last_article_id'], limit=batch_size)
+                if not articles:
+                    break
+                segment, total_length = self._build_segment(articles)
+                with self.lock:
+                    self.segments.append(segment)
+                    self.manifest['segments'].append(segment.name)
+                    self.manifest['last_article_id'] = articles[-1]['id']
+                    self.manifest['documents'] += len(articles)
+                    self.manifest['total_length'] += total_length
+                    self._save_manifest()
+                added += len(articles)
+            while True:
+                articles = self.store.get_revised_articles(since_revision=self.manifest['last_revision'], limit=batch_size)
+                if not articles:
+                    break
+                segment, _ = self._build_segment(articles)
+                with self.lock:
+                    self.segments.append(segment)
+                    self.manifest['segments'].append(segment.name)
+                    self.manifest['last_revision'] = articles[-1]['revision']
+                    for article in articles:
+                        self.manifest['revised'][str(article['id'])] = article['revision']
+                    self._load_revised()
+                    self._recount()
+                    self._save_manifest()
+                logger.info(f"Keyword index: {len(articles)} articles with a changed text indexed again")
+        if added:
+            logger.info(f"Keyword index: {added} articles added, {self.manifest['documents']} in {len(self.segments)} segments")
+        return added
+
+    def _merge_candidates(self) -> Optional[List[Segment]]:
+        """MERGE_FACTOR segments of the same size tier, the smallest tier first, None if no tier is full"""
+        tiers: Dict[int, List[Segment]] = {}
+        with self.lock:
+            for segment in self.segments:
+                tiers.setdefault(int(math.log(max(len(segment), 1), MERGE_FACTOR)), []).append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= MERGE_FACTOR:
+                return tiers[tier][:MERGE_FACTOR]
+        return None
+
+    def _merge(self, segments: List[Segment]) -> Segment:
+        postings: Dict[str, List[Tuple[np.ndarray, np.ndarray]]] = {}
+        offset = 0
+        kept = []
+        for segment in segments:
+            # the copies superseded by a newer revision of the text are dropped for good
+            keep = ~self._stale(segment)
+            ordinals = np.cumsum(keep) - 1 + offset
+            for term, (start, count) in segment.terms.items():
+                docs = segment.postings_docs[start:start + count]
+                current = keep[docs]
+                if current.any():
+                    postings.setdefault(term, []).append((ordinals[docs[current]], segment.postings_tf[start:start + count][current]))
+            offset += int(np.count_nonzero(keep))
+            kept.append(keep)
+        merged = {term: (np.concatenate([docs for docs, _ in parts]), np.concatenate([tf for _, tf in parts]))
+                  for term, parts in postings.items()}
+        docs = {name: np.concatenate([getattr(segment, name)[keep] for segment, keep in zip(segments, kept)])
+                for name in ('doc_ids', 'doc_lengths', 'doc_days', 'doc_sources', 'doc_versions')}
+        return Segment.write(self._new_segment_path(), merged, docs)
+
+    def merge(self) -> int:
+        """Merge full tiers of segments until none is left, return how many merges that took"""
+        merges = 0
+        with self._write_lock:
+            while (segments := self._merge_candidates()) is not None:
+                merged = self._merge(segments)
+                with self.lock:
+                    # the merged segment takes the place of the first one it replaces, the order of the articles stays
+                    position = self.segments.index(segments[0])
+                    self.segments = [segment for segment in self.segments if segment not in segments]
+                    self.segments.insert(position, merged)
+                    self.manifest['segments'] = [segment.name for segment in self.segments]
+                    self._save_manifest()
+                for segment in segments:
+                    # searches still holding the old segment keep working, the mapped files outlive the unlink
+                    shutil.rmtree(segment.path, ignore_errors=True)
+                merges += 1
+        if merges:
+            logger.info(f"Keyword index: {merges} segment merges, {len(self.segments)} segments left")
+        return merges
+
+    def merge_in_background(self) -> threading.Thread:
+        """Start merging in a thread of its own (unless one's already at it), searches keep going meanwhile"""
+        with self.lock:
+            if self._merge_thread is None or not self._merge_thread.is_alive():
+                # not a daemon thread, a one-shot run waits for the merge to finish instead of leaving half a segment behind
+                self._merge_thread = threading.Thread(target=self._merge_logged, name='keyword-index-merge')
+                self._merge_thread.start()
+            return self._merge_thread
+
+    def _merge_logged(self):
+        try:
+            self.merge()
+        except Exception as e:
+            logger.exception(f"Merging keyword index segments failed: {e}")
+
+    def search(self,
+               query: str,
+               k: int = 10,
+               sources: Optional[List[str]] = None,
+               since: Optional[Union[str, date, datetime]] = None,
+               until: Optional[Union[str, date, datetime]] = None) -> List[Tuple[int, float]]:
+        """
+        (article id, bm25 score) of the k best matching articles, best first. Articles of other `sources`
+        or published outside `since`..`until` (inclusive) are left out, articles of unknown date too when filtering by date.
+        """
+        terms = list(dict.fromkeys(analyze(query)))
+        with self.lock:
+            segments = list(self.segments)
+            documents = self.manifest['documents']
+            average_length = self.manifest['total_length'] / documents if documents else 0.0
+            source_codes = None if sources is None else [
+                self.manifest['sources'].index(source) for source in sources if source in self.manifest['sources']]
+        if not terms or not documents or source_codes == []:
+            return []
+
+        stale = {segment.name: self._stale(segment) for segment in segments}
+        # idf is over the whole index (the current copies of the articles), not per segment, so the scores of all segments are comparable
+        document_frequency = {term: sum(int(np.count_nonzero(~stale[segment.name][segment.postings(term)[0]])) for segment in segments)
+                              for term in terms}
+        idf = {term: math.log(1 + (documents - df + 0.5) / (df + 0.5)) for term, df in document_frequency.items() if df}
+        since_day = _day(since) if since is not None else None
+        until_day = _day(until) if until is not None else None
+
+        best_ids: List[np.ndarray] = []
+        best_scores: List[np.ndarray] = []
+        for segment in segments:
+            scores = np.zeros(len(segment), dtype=np.float32)
+            length_norm = K1 * (1 - B + B * segment.doc_lengths / average_length)
+            for term, term_idf in idf.items():
+                docs, tf = segment.postings(term)
+                if len(docs):
+                    tf = tf.astype(np.float32)
+                    scores[docs] += term_idf * tf * (K1 + 1) / (tf + length_norm[docs])
+            matched = (scores > 0) & ~stale[segment.name]
+            if source_codes is not None:
+                matched &= np.isin(segment.doc_sources, source_codes)
+            if since_day is not None:
+                matched &= segment.doc_days >= since_day
+            if until_day is not None:
+                matched &= (segment.doc_days <= until_day) & (segment.doc_days >= 0)
+            keep = np.flatnonzero(matched)
+            if len(keep) > k:
+                keep = keep[np.argpartition(scores[keep], -k)[-k:]]
+            best_ids.append(segment.doc_ids[keep])
+            best_scores.append(scores[keep])
+        if not best_ids:
+            return []
+        ids = np.concatenate(best_ids)
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    def search_articles(self, query: str, k: int = 10, **filters) -> List[Dict[str, Any]]:
+        """Like `search`, but the article dicts themselves (with their `score`) come back"""
+        hits = self.search(query, k, **filters)
+        articles = {article['id']: article for article in self.store.get_articles_by_id([article_id for article_id, _ in hits])}
+        return [{**articles[article_id], 'score': score} for article_id, score in hits if article_id in articles]
+
+
+_keyword_index: Optional[KeywordIndex] = None
+
+
+def get_keyword_index() -> KeywordIndex:
+    """Return the process wide keyword index"""
+    global _keyword_index
+    if _keyword_index is None:
+        _keyword_index = KeywordIndex()
+    return _keyword_index
+
+
+def update_keyword_index() -> int:
+    """Index the newly saved articles and merge segments in the background, never raising (it catches up on the next run)"""
+    try:
+        added = get_keyword_index().update()
+        get_keyword_index().merge_in_background()
+        return added
+    except Exception as e:
+        logger.exception(f"Updating the keyword index failed: {e}")
+        return 0
@@ -0,0 +1,50 @@
+import logging
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+from common.settings import DATA_DIR
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+
+logger = logging.getLogger(__name__)
+
+
+LOCKS_DIR = DATA_DIR / 'locks'
+
+
+@contextmanager
+def overlap_lock(name: str) -> Iterator[bool]:
+    """
+    Non blocking, process crossing lock of `name` - yields whether it was acquired. The os drops it when the process dies,
+    so a crashed run never leaves a stale lock behind. Every `with` opens the file anew, so it excludes within a process too.
+    """
+    LOCKS_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(LOCKS_DIR / f"{name}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    acquired = False
+    try:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            acquired = True
+        except OSError:
+            pass
+        if acquired:
+            os.ftruncate(fd, 0)
+            os.write(fd, str(os.getpid()).encode())
+        yield acquired
+    finally:
+        if acquired:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
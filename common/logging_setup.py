@@ -0,0 +1,136 @@
+import atexit
+import copy
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional, Tuple
+
+from common.settings import LOG_DIR, LOG_LEVEL
+
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+# one log for the whole process, rotated so it never outgrows LOG_FILE_MAX_BYTES * (LOG_FILE_BACKUPS + 1)
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+# longer messages (a whole page, an article text) are cut here, the tracebacks of errors are kept whole
+MAX_MESSAGE_CHARS = 2000
+# records waiting for the writer thread - past this they're dropped (and counted) instead of blocking the event loop
+QUEUE_SIZE = 10000
+# below WARNING, one line of code may log at most SAMPLE_BURST records per SAMPLE_WINDOW seconds, the rest is only counted
+SAMPLE_WINDOW = 60
+SAMPLE_BURST = 20
+
+
+class SamplingFilter(logging.Filter):
+    """Cap the debug/info records per call site, so a per-element log line in a loop can't flood the log"""
+
+    def __init__(self, window: float = SAMPLE_WINDOW, burst: int = SAMPLE_BURST):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        # per (logger, line): start of the current window, records passed in it, records suppressed in it
+        self._sites: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.setdefault((record.name, record.lineno), [now, 0, 0])
+            if now - site[0] >= self.window:
+                suppressed = site[2]
+                site[:] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} [{suppressed} more like this suppressed in the last window]"
+            if site[1] >= self.burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands the records over to the writer thread without ever waiting: the message is formatted and cut to
+    MAX_MESSAGE_CHARS in the calling thread, and a full queue drops the record instead of blocking.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if len(message) > MAX_MESSAGE_CHARS:
+            message = f"{message[:MAX_MESSAGE_CHARS]}... [{len(message) - MAX_MESSAGE_CHARS} more chars cut]"
+        record = copy.copy(record)
+        # the writer thread only gets plain strings, the args and the traceback objects stay here
+        record.msg = message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.dropped:
+                notice = logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+                                           f"{self.dropped} log records dropped, the log writer couldn't keep up", None, None)
+                self.queue.put_nowait(notice)
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+
+
+def setup_logging(level: Optional[str] = None, console: bool = True):
+    """
+    Route every log record of the process through a queue to a background writer thread (a rotating file
+    in LOG_DIR and the console), so logging never blocks the event loop. Calling it again changes nothing.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [RotatingFileHandler(LOG_DIR / 'scraper.log', maxBytes=LOG_FILE_MAX_BYTES,
+                                    backupCount=LOG_FILE_BACKUPS, encoding='utf-8')]
+    if console:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level or LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # whatever is still queued is written before the process exits
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out the queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -0,0 +1,206 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Tuple, Union
+
+import aiohttp
+from aiohttp import web
+
+from common.settings import DATA_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+# where one-shot runs leave their metrics (the node exporter textfile collector format)
+METRICS_FILE = DATA_DIR / 'metrics.prom'
+# seconds - from a cached page to a browser render behind a cloudflare challenge
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SWEEP_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 2700)
+
+# source the running code works for, set by the orchestrator for each sweep - every task of the sweep inherits it
+current_source: ContextVar[str] = ContextVar('current_source', default='unknown')
+
+LabelValues = Tuple[str, ...]
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels[label]) for label in self.labels), 0)
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: the count of every bucket (not cumulative, +Inf last), the sum and the count
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(tuple(str(labels[label]) for label in self.labels))
+        return sum(entry[0]) if entry else 0
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + [float('inf')], counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _format_value(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + (le,))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Registry:
+    """Every metric of the process, exposed together in the prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[Counter, Histogram]] = {}
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+    def expose(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+
+
+def get_registry() -> Registry:
+    """Return the process wide metrics registry"""
+    return _registry
+
+
+# the stages of a sweep, every one timed per source and outcome
+COLLECTOR_FETCH_SECONDS = _registry.histogram(
+    'scraper_collector_fetch_seconds', "Fetch of the feed or index page of a source", ('source', 'outcome'))
+FEED_PARSE_SECONDS = _registry.histogram(
+    'scraper_feed_parse_seconds', "Link extraction out of the feed or index page", ('source', 'outcome'))
+ARTICLE_FETCH_SECONDS = _registry.histogram(
+    'scraper_article_fetch_seconds', "Fetch of one article page (one attempt)", ('source', 'tier', 'outcome'))
+PARSE_SECONDS = _registry.histogram(
+    'scraper_parse_seconds', "Extraction of the article(s) out of one page", ('source', 'outcome'))
+STORE_WRITE_SECONDS = _registry.histogram(
+    'scraper_store_write_seconds', "Write of one batch of results into the article store", ('source', 'outcome'))
+SWEEP_SECONDS = _registry.histogram(
+    'scraper_sweep_seconds', "Whole sweep of a source", ('source', 'status'), buckets=SWEEP_BUCKETS)
+
+ARTICLES_SAVED = _registry.counter('scraper_articles_saved_total', "Articles written into the article store", ('source',))
+RETRIES = _registry.counter('scraper_retries_total', "Attempts repeated after a failure", ('source', 'stage'))
+CACHE_LOOKUPS = _registry.counter('scraper_cache_lookups_total', "Cache lookups by cache and result", ('source', 'cache', 'result'))
+SELECTOR_MISSES = _registry.counter('scraper_selector_misses_total', "Required selectors that matched nothing", ('source', 'selector'))
+BYTES_RECEIVED = _registry.counter('scraper_bytes_received_total', "Response bytes received", ('source', 'client'))
+
+
+def outcome_of(error: BaseException) -> str:
+    """Outcome label of a failed stage"""
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(error, aiohttp.ClientResponseError):
+        return 'non_200'
+    # the parsing module's SelectorMiss and the collectors' own AbsentAnchorElementException alike
+    if type(error).__name__ in ('SelectorMiss', 'AbsentAnchorElementException'):
+        return 'selector_miss'
+    return 'error'
+
+
+class _Stage:
+    """Outcome of a timed stage, 'ok' unless the stage sets another one (or raises)"""
+
+    def __init__(self):
+        self.outcome = 'ok'
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels: str) -> Iterator[_Stage]:
+    """Time the block into the histogram, labelled with the current source and the outcome of the block"""
+    stage = _Stage()
+    started = time.perf_counter()
+    try:
+        yield stage
+    except BaseException as e:
+        stage.outcome = 'cancelled' if isinstance(e, asyncio.CancelledError) else outcome_of(e)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started, **{'source': current_source.get(), **labels, 'outcome': stage.outcome})
+
+
+def write_metrics_file(path: Union[str, Path] = METRICS_FILE):
+    """Leave the metrics of a one-shot run in a file, e.g. for the node exporter's textfile collector"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(_registry.expose())
+    os.replace(tmp_path, path)
+
+
+async def start_metrics_server(port: int, host: str = '127.0.0.1') -> web.AppRunner:
+    """Serve the metrics on http://host:port/metrics for a prometheus scraper, until the returned runner is cleaned up"""
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=_registry.expose(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
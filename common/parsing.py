@@ -0,0 +1,112 @@
+import logging
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+
+from cssselect import HTMLTranslator
+from lxml import etree
+from lxml import html as lxml_html
+
+from common.metrics import SELECTOR_MISSES, current_source
+
+
+logger = logging.getLogger(__name__)
+
+
+_translator = HTMLTranslator()
+
+# all text nodes below an element, leaving out what's inside script/style/template (same as bs4's `.text` does)
+_TEXT_XPATH = etree.XPath('descendant::text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+
+
+# english and polish (nominative and genitive) month names, as the sources write them
+_MONTHS = {
+    'jan': 1, 'january': 1, 'styczeń': 1, 'stycznia': 1,
+    'feb': 2, 'february': 2, 'luty': 2, 'lutego': 2,
+    'mar': 3, 'march': 3, 'marzec': 3, 'marca': 3,
+    'apr': 4, 'april': 4, 'kwiecień': 4, 'kwietnia': 4,
+    'may': 5, 'maj': 5, 'maja': 5,
+    'jun': 6, 'june': 6, 'czerwiec': 6, 'czerwca': 6,
+    'jul': 7, 'july': 7, 'lipiec': 7, 'lipca': 7,
+    'aug': 8, 'august': 8, 'sierpień': 8, 'sierpnia': 8,
+    'sep': 9, 'sept': 9, 'september': 9, 'wrzesień': 9, 'września': 9,
+    'oct': 10, 'october': 10, 'październik': 10, 'października': 10,
+    'nov': 11, 'november': 11, 'listopad': 11, 'listopada': 11,
+    'dec': 12, 'december': 12, 'grudzień': 12, 'grudnia': 12,
+}
+_ISO_DATE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+# day first, as every source but the american ones writes it (thecyberwire is already converted to DD/MM/YYYY)
+_NUMERIC_DATE = re.compile(r'(\d{1,2})[./](\d{1,2})[./](\d{4})')
+_DAY_MONTH_YEAR = re.compile(r'(\d{1,2})\s+([^\W\d_]+)\.?,?\s+(\d{4})')
+_MONTH_DAY_YEAR = re.compile(r'([^\W\d_]+)\.?\s+(\d{1,2}),?\s+(\d{4})')
+
+
+def parse_date(text: Optional[str]) -> Optional[datetime]:
+    """Best effort date out of the many formats the sources use for `creationDate`, None if nothing looks like one"""
+    if not text:
+        return None
+    candidates = []
+    if match := _ISO_DATE.search(text):
+        candidates.append((int(match[1]), int(match[2]), int(match[3])))
+    if match := _NUMERIC_DATE.search(text):
+        candidates.append((int(match[3]), int(match[2]), int(match[1])))
+    if (match := _DAY_MONTH_YEAR.search(text)) and match[2].lower() in _MONTHS:
+        candidates.append((int(match[3]), _MONTHS[match[2].lower()], int(match[1])))
+    if (match := _MONTH_DAY_YEAR.search(text)) and match[1].lower() in _MONTHS:
+        candidates.append((int(match[3]), _MONTHS[match[1].lower()], int(match[2])))
+    for year, month, day in candidates:
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            continue
+    return None
+
+
+class SelectorMiss(Exception):
+    """A selector the page is expected to have matched nothing - the page doesn't look like it used to"""
+    pass
+
+
+def parse_document(html: Union[str, bytes]) -> etree._ElementTree:
+    """Parse the html into an lxml tree, much faster than BeautifulSoup with 'html.parser'"""
+    try:
+        root = lxml_html.document_fromstring(html)
+    except ValueError:
+        # lxml refuses str input that carries its own encoding declaration
+        root = lxml_html.document_fromstring(html.encode('utf-8'))
+    return root.getroottree()
+
+
+def text_of(element) -> str:
+    """The text of the element and everything below it, the equivalent of bs4's `element.text`"""
+    return ''.join(_TEXT_XPATH(element))
+
+
+class Selectors:
+    """CSS selectors of a source, translated to XPath and compiled once instead of on every page"""
+
+    def __init__(self, **css: str):
+        self.css: Dict[str, str] = css
+        # `descendant::` makes them behave like bs4's select - only elements below the given node are matched
+        self._compiled: Dict[str, etree.XPath] = {
+            name: etree.XPath(_translator.css_to_xpath(selector, prefix='descendant::'))
+            for name, selector in css.items()
+        }
+
+    def all(self, name: str, node) -> List[etree._Element]:
+        return self._compiled[name](node)
+
+    def one(self, name: str, node) -> Optional[etree._Element]:
+        matches = self._compiled[name](node)
+        return matches[0] if matches else None
+
+    def required(self, name: str, node) -> etree._Element:
+        element = self.one(name, node)
+        if element is None:
+            SELECTOR_MISSES.inc(source=current_source.get(), selector=name)
+            raise SelectorMiss(f"selector '{name}' ({self.css[name]}) matched nothing")
+        return element
+
+    def text(self, name: str, node) -> str:
+        """Stripped text of the first match, raising SelectorMiss if there's none"""
+        return text_of(self.required(name, node)).strip()
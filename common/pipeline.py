@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from common.metrics import ARTICLES_SAVED, PARSE_SECONDS, STORE_WRITE_SECONDS, timed
+from common.seen_store import get_seen_store
+from common.storage import is_article, save_results
+from common.tracing import record_span, span
+
+
+logger = logging.getLogger(__name__)
+
+
+# marks the end of the input of a stage
+_DONE = object()
+
+# bounded queues between the stages keep the memory flat however many urls come in
+QUEUE_SIZE = 50
+# the sink writes whatever piled up in the meantime, but never more than this in one transaction
+SINK_BATCH_SIZE = 50
+
+
+class ListSink:
+    """Sink that just keeps every result in memory, for callers that want the whole list back"""
+
+    def __init__(self):
+        self.results: List[Any] = []
+
+    async def write(self, batch: List[Any]):
+        self.results.extend(batch)
+
+
+class ArticleSink:
+    """
+    Sink that persists every batch of results into the article store (and the csv export) as soon as it's ready,
+    then marks the links of the saved articles as seen - a failed link stays unseen and is retried by the next sweep.
+    """
+
+    def __init__(self, source: str, csv_export: bool = True):
+        self.source = source
+        # the csv is append only, so rewriting already exported articles (a reparse) would only duplicate them there
+        self.csv_export = csv_export
+        self.saved = 0
+
+    async def write(self, batch: List[Any]):
+        # sqlite and the csv are blocking, so the write happens in a worker thread
+        with timed(STORE_WRITE_SECONDS, source=self.source):
+            saved = await asyncio.to_thread(save_results, self.source, batch, self.csv_export)
+        # only once they're in the database, the seen store is used from the event loop only
+        get_seen_store().mark_seen(self.source, [result['articleLink'] for result in batch if is_article(result)])
+        ARTICLES_SAVED.inc(saved, source=self.source)
+        self.saved += saved
+
+
+async def run_pipeline(urls: Iterable[str],
+                       fetch: Callable[[str], Awaitable[Optional[str]]],
+                       parse: Callable[[str, str], Any],
+                       sink: Any,
+                       fetch_workers: int = 3,
+                       parse_workers: int = 2,
+                       queue_size: int = QUEUE_SIZE) -> Dict[str, int]:
+    """
+    Stream the urls through fetch -> parse -> sink stages connected with bounded queues.
+
+    `fetch(url)` returns the html (None when it failed), `parse(url, html)` is a regular function
+    returning an article dict, a list of them or a failure dict, `sink.write(batch)` persists the results.
+    Every result reaches the sink as soon as it's parsed, so nothing finished is lost if the run dies later on.
+    """
+    url_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    html_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    result_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    stats = {'urls': 0, 'fetch_failed': 0, 'results': 0, 'articles': 0}
+
+    async def feed_urls():
+        for url in urls:
+            stats['urls'] += 1
+            await url_queue.put(url)
+        for _ in range(fetch_workers):
+            await url_queue.put(_DONE)
+
+    async def fetch_worker():
+        while (url := await url_queue.get()) is not _DONE:
+            with span('fetch', url=url) as attributes:
+                try:
+                    html = await fetch(url)
+                except Exception as e:
+                    logger.error(f"Error fetching {url}: {e}")
+                    html = None
+                if html is None:
+                    attributes['outcome'] = 'failed'
+            if html is None:
+                stats['fetch_failed'] += 1
+                await result_queue.put({"url": url, "success": False, "error": "Failed to fetch content"})
+            else:
+                await html_queue.put((url, html, time.time()))
+
+    async def parse_worker():
+        while (item := await html_queue.get()) is not _DONE:
+            url, html, fetched_at = item
+            # time the page waited for a free parse worker
+            record_span('parse_queue', fetched_at, time.time() - fetched_at, url=url)
+            with timed(PARSE_SECONDS) as stage, span('parse', url=url) as attributes:
+                try:
+                    # parsing is cpu bound, so it's kept off the event loop
+                    parsed = await asyncio.to_thread(parse, url, html)
+                except Exception as e:
+                    logger.error(f"Error processing {url}: {e}")
+                    parsed = {"url": url, "success": False, "error": str(e)}
+                if not any(is_article(result) for result in (parsed if isinstance(parsed, list) else [parsed])):
+                    stage.outcome = attributes['outcome'] = 'failed'
+            for result in (parsed if isinstance(parsed, list) else [parsed]):
+                if result is not None:
+                    await result_queue.put(result)
+
+    async def sink_worker():
+        finished = False
+        while not finished:
+            batch = []
+            item = await result_queue.get()
+            # take whatever else is already waiting, so bursts are written in one transaction
+            while True:
+                if item is _DONE:
+                    finished = True
+                    break
+                batch.append(item)
+                if len(batch) >= SINK_BATCH_SIZE or result_queue.empty():
+                    break
+                item = result_queue.get_nowait()
+            if batch:
+                stats['results'] += len(batch)
+                stats['articles'] += sum(1 for result in batch if is_article(result))
+                await sink.write(batch)
+
+    async def fetch_stage():
+        await asyncio.gather(*(fetch_worker() for _ in range(fetch_workers)))
+        for _ in range(parse_workers):
+            await html_queue.put(_DONE)
+
+    async def parse_stage():
+        await asyncio.gather(*(parse_worker() for _ in range(parse_workers)))
+        await result_queue.put(_DONE)
+
+    tasks = [asyncio.create_task(coro) for coro in (feed_urls(), fetch_stage(), parse_stage(), sink_worker())]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # if any stage blew up (or we got cancelled) the rest would wait forever on their queues
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return stats
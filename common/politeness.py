@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+from common.http_client import get_session
+from common.settings import DATA_DIR, REPLAY_URL
+from common.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+ROBOTS_CACHE_FILE = DATA_DIR / 'robots.json'
+# robots.txt is fetched again after this many seconds
+ROBOTS_TTL = 24 * 60 * 60
+
+# requests per second, how many can go out at once after an idle period, and extra random delay in seconds
+DEFAULT_POLICY = {'rate': 2.0, 'burst': 4, 'jitter': 0.0}
+HOST_POLICIES: Dict[str, Dict[str, float]] = {
+    # with cloudflare's clearance reused there's no need for the old 30-40 s between articles, just a modest steady pace
+    'www.darkreading.com': {'rate': 0.5, 'burst': 2, 'jitter': 1.0},
+    # it used to be 2 pages at a time with a 1.5-3 s sleep after each
+    'thehackernews.com': {'rate': 0.5, 'burst': 2, 'jitter': 1.0},
+}
+
+
+# background requests (archive backfills) only get a token once the host saw no regular request for this long (or 2 token intervals if that's longer)
+FOREGROUND_GRACE = 2.0
+BACKGROUND_POLL_INTERVAL = 0.5
+# on top of that they never take more than this share of a host's rate, so a backfill next to a sweep in another process stays polite too
+BACKGROUND_RATE_SHARE = 0.5
+
+# set for everything running inside `background_priority()` - tasks started in there inherit it
+_background: ContextVar[bool] = ContextVar('politeness_background', default=False)
+
+
+@contextmanager
+def background_priority() -> Iterator[None]:
+    """Requests made inside yield every host to the regular ones, e.g. a backfill never slows down the live sweep"""
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+
+class TokenBucket:
+    """Classic token bucket - tokens come back at `rate` per second up to `burst`, every request takes one"""
+
+    def __init__(self, rate: float, burst: float, jitter: float = 0.0):
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token and return how long the caller has to wait for it to be valid"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # going below zero is a reservation - the next callers queue up behind it in order
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate + random.uniform(0, self.jitter)
+
+
+class PolitenessScheduler:
+    """Per host token buckets, throttled further by the crawl-delay of the host's robots.txt"""
+
+    def __init__(self,
+                 policies: Optional[Dict[str, Dict[str, float]]] = None,
+                 respect_robots: bool = True,
+                 enabled: bool = True):
+        self.policies = HOST_POLICIES if policies is None else policies
+        self.respect_robots = respect_robots
+        self.enabled = enabled
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._bucket_locks: Dict[str, asyncio.Lock] = {}
+        # regular requests currently waiting for a host and when the last one got its token
+        self._foreground_waiting: Dict[str, int] = {}
+        self._last_foreground: Dict[str, float] = {}
+        self._background_buckets: Dict[str, TokenBucket] = {}
+        self._robots: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load_robots_cache(self) -> Dict[str, Dict[str, Any]]:
+        if self._robots is None:
+            try:
+                with open(ROBOTS_CACHE_FILE, 'r', encoding='utf-8') as file:
+                    self._robots = json.load(file)
+            except (OSError, ValueError):
+                self._robots = {}
+        return self._robots
+
+    def _save_robots_cache(self):
+        ROBOTS_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = ROBOTS_CACHE_FILE.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self._robots, file, indent=1)
+        os.replace(tmp_path, ROBOTS_CACHE_FILE)
+
+    async def crawl_delay(self, scheme: str, host: str) -> Optional[float]:
+        """Crawl-delay from the (cached) robots.txt of the host, None if there is none"""
+        cache = self._load_robots_cache()
+        entry = cache.get(host)
+        if entry is not None and time.time() - entry['fetched_at'] < ROBOTS_TTL:
+            return entry['crawl_delay']
+
+        crawl_delay = None
+        try:
+            session = await get_session()
+            async with session.get(f"{scheme}://{host}/robots.txt") as response:
+                if response.status == 200:
+                    parser = RobotFileParser()
+                    parser.parse((await response.text()).splitlines())
+                    delay = parser.crawl_delay('*')
+                    crawl_delay = float(delay) if delay is not None else None
+        except Exception as e:
+            logger.warning(f"Couldn't read robots.txt of {host}: {e}")
+
+        cache[host] = {'crawl_delay': crawl_delay, 'fetched_at': time.time()}
+        self._save_robots_cache()
+        return crawl_delay
+
+    async def _get_bucket(self, scheme: str, host: str) -> TokenBucket:
+        lock = self._bucket_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            if host not in self._buckets:
+                policy = {**DEFAULT_POLICY, **self.policies.get(host, {})}
+                rate = policy['rate']
+                if self.respect_robots:
+                    crawl_delay = await self.crawl_delay(scheme, host)
+                    if crawl_delay:
+                        rate = min(rate, 1 / crawl_delay)
+                logger.debug(f"Rate limit for {host}: {rate:.3f} req/s (burst {policy['burst']})")
+                self._buckets[host] = TokenBucket(rate, policy['burst'], policy['jitter'])
+            return self._buckets[host]
+
+    async def wait(self, url: str) -> float:
+        """Wait until the host of the url may be hit again and return how long that took"""
+        if not self.enabled:
+            return 0.0
+        # the deliberate pause shows up in the url's timeline
+        with span('politeness_wait'):
+            return await self._wait(url)
+
+    async def _wait(self, url: str) -> float:
+        parts = urlsplit(url)
+        host = parts.netloc
+        bucket = await self._get_bucket(parts.scheme or 'https', host)
+        started = time.monotonic()
+
+        if _background.get():
+            grace = max(FOREGROUND_GRACE, 2 / bucket.rate)
+            while self._foreground_waiting.get(host) or time.monotonic() - self._last_foreground.get(host, float('-inf')) < grace:
+                await asyncio.sleep(BACKGROUND_POLL_INTERVAL)
+            background_bucket = self._background_buckets.setdefault(
+                host, TokenBucket(bucket.rate * BACKGROUND_RATE_SHARE, 1, bucket.jitter))
+            for delay in (background_bucket.reserve(), bucket.reserve()):
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            return time.monotonic() - started
+
+        self._foreground_waiting[host] = self._foreground_waiting.get(host, 0) + 1
+        try:
+            delay = bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self._foreground_waiting[host] -= 1
+            self._last_foreground[host] = time.monotonic()
+        return delay
+
+
+_scheduler: Optional[PolitenessScheduler] = None
+
+
+def get_politeness_scheduler() -> PolitenessScheduler:
+    """Return the process wide politeness scheduler"""
+    global _scheduler
+    if _scheduler is None:
+        # a local replay server has no one to be polite to, throttling it would only skew the benchmarks
+        _scheduler = PolitenessScheduler(enabled=REPLAY_URL is None)
+    return _scheduler
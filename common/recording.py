@@ -0,0 +1,80 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
+from urllib.parse import quote
+
+from common.settings import RECORD_DIR, REPLAY_URL
+
+
+logger = logging.getLogger(__name__)
+
+
+# the replay server answers on this path, the original url goes in the `url` query parameter
+REPLAY_PATH = '/replay'
+
+
+class FixtureStore:
+    """Recorded responses - an index.json of url -> status/content type/body file, the bodies next to it"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.bodies_dir = self.path / 'bodies'
+        self.index_path = self.path / 'index.json'
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                self.index: Dict[str, Dict[str, Any]] = json.load(file)
+        except FileNotFoundError:
+            self.index = {}
+
+    def save(self, url: str, status: int, content_type: Optional[str], body: bytes):
+        name = f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.body"
+        with self.lock:
+            self.bodies_dir.mkdir(parents=True, exist_ok=True)
+            (self.bodies_dir / name).write_bytes(body)
+            self.index[url] = {'status': status, 'content_type': content_type, 'body': name}
+            tmp_path = self.index_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(self.index, file, indent=1)
+            os.replace(tmp_path, self.index_path)
+
+    def load(self, url: str) -> Optional[Dict[str, Any]]:
+        """The recorded response of the url as {status, content_type, body}, None if it was never recorded"""
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        return {**entry, 'body': (self.bodies_dir / entry['body']).read_bytes()}
+
+    def urls(self) -> List[str]:
+        return list(self.index)
+
+
+def replay_url(url: str) -> str:
+    """Where the url is fetched from while replaying"""
+    return f"{REPLAY_URL.rstrip('/')}{REPLAY_PATH}?url={quote(url, safe='')}"
+
+
+_recorder: Optional[FixtureStore] = None
+
+
+def get_recorder() -> Optional[FixtureStore]:
+    """The fixture store responses are recorded into, None unless recording was switched on"""
+    global _recorder
+    if _recorder is None and RECORD_DIR is not None:
+        _recorder = FixtureStore(RECORD_DIR)
+    return _recorder
+
+
+def record_response(url: str, status: int, content_type: Optional[str], body: bytes):
+    """Save the response as a fixture if recording is on, never failing the fetch itself"""
+    recorder = get_recorder()
+    if recorder is None:
+        return
+    try:
+        recorder.save(url, status, content_type, body)
+    except OSError as e:
+        logger.warning(f"Couldn't record {url}: {e}")
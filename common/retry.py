@@ -0,0 +1,41 @@
+import asyncio
+import functools
+import logging
+
+from common.metrics import RETRIES, current_source
+
+
+logger = logging.getLogger(__name__)
+
+
+def async_retry(exceptions=(Exception,), max_attempts=2, delay=1):
+    """
+    Retry decorator for coroutine functions that retries only when specific exceptions occur.
+    Waits with asyncio.sleep, so the other tasks on the event loop keep running between attempts.
+    
+    Args:
+        exceptions: Tuple of exception classes that should trigger retry
+        max_attempts: Maximum number of retry attempts
+        delay: Delay between retries in seconds
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            attempts = 0
+            while attempts <= max_attempts:
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    attempts += 1
+                    if attempts > max_attempts:
+                        logger.error(f"Failed after {max_attempts} attempts: {e}")
+                        raise
+                    RETRIES.inc(source=current_source.get(), stage=func.__name__)
+                    logger.warning(f"Attempt {attempts} failed with {e.__class__.__name__}: {e}. Retrying in {delay} seconds...")
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    # For any other exceptions, don't retry
+                    logger.error(f"Failed with non-retryable exception: {e}")
+                    raise
+        return wrapper
+    return decorator
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import math
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+from common.settings import DATA_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+SEEN_LINKS_DB = DATA_DIR / 'seen_links.sqlite'
+
+
+class BloomFilter:
+    """Plain bit array bloom filter - a miss is definite, a hit still has to be confirmed"""
+
+    def __init__(self, capacity: int = 200_000, error_rate: float = 0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        # double hashing: k positions out of two 64 bit hashes
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class SeenLinkStore:
+    """Every article link ever collected, kept in sqlite with a bloom filter in front of it"""
+
+    def __init__(self, path: Union[str, Path] = SEEN_LINKS_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS seen_links (
+                url TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                first_seen TEXT NOT NULL
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_seen_links_source ON seen_links (source, first_seen)')
+        self.connection.commit()
+
+        count = self.connection.execute('SELECT COUNT(*) FROM seen_links').fetchone()[0]
+        # room for plenty of growth, the filter is rebuilt from sqlite on every start anyway
+        self.bloom = BloomFilter(capacity=max(200_000, count * 4))
+        for (url,) in self.connection.execute('SELECT url FROM seen_links'):
+            self.bloom.add(url)
+
+    def is_seen(self, url: str) -> bool:
+        if url not in self.bloom:
+            return False
+        # possible false positive of the filter, sqlite has the final word
+        return self.connection.execute('SELECT 1 FROM seen_links WHERE url = ?', (url,)).fetchone() is not None
+
+    def filter_new(self, links: Iterable[str]) -> List[str]:
+        """Return the links that were never seen, without duplicates and in their original order"""
+        new_links = []
+        batch = set()
+        for link in links:
+            if link in batch or self.is_seen(link):
+                continue
+            batch.add(link)
+            new_links.append(link)
+        return new_links
+
+    def mark_seen(self, source: str, links: Iterable[str]):
+        links = list(links)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO seen_links (url, source, first_seen) VALUES (?, ?, ?)',
+                [(link, source, now) for link in links],
+            )
+        for link in links:
+            self.bloom.add(link)
+
+    def has_source(self, source: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM seen_links WHERE source = ? LIMIT 1', (source,)).fetchone() is not None
+
+    def collect_new_links(self,
+                          source: str,
+                          links: List[str],
+                          legacy_lastsaved_file: Optional[Union[str, Path]] = None) -> List[str]:
+        """
+        Return the links of the source that were never collected before. They aren't marked seen here: the sink
+        does that once their article is saved, so a link whose fetch or parse failed is collected again next time.
+
+        On the very first run of a source the old `lastsaved_articlelink.txt` is honoured once:
+        the saved link and everything after it in the feed are marked as seen without being returned.
+        """
+        if legacy_lastsaved_file is not None and not self.has_source(source):
+            try:
+                with open(legacy_lastsaved_file, 'r') as file:
+                    lastsaved_articlelink = file.read().strip()
+            except FileNotFoundError:
+                lastsaved_articlelink = ''
+            if lastsaved_articlelink in links:
+                already_collected = links[links.index(lastsaved_articlelink):]
+                logger.info(f"[{source}] seeding the seen links with {len(already_collected)} links from {legacy_lastsaved_file}")
+                self.mark_seen(source, already_collected)
+
+        return self.filter_new(links)
+
+    def close(self):
+        self.connection.close()
+
+
+_seen_store: Optional[SeenLinkStore] = None
+
+
+def get_seen_store() -> SeenLinkStore:
+    """Return the process wide seen links store"""
+    global _seen_store
+    if _seen_store is None:
+        _seen_store = SeenLinkStore()
+    return _seen_store
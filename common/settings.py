@@ -0,0 +1,20 @@
+import os
+from pathlib import Path
+
+
+# every piece of persistent state (caches, indexes, databases) lives under this directory
+DATA_DIR = Path(os.environ.get('CRONSCRAPERS_DATA_DIR', Path(__file__).resolve().parent.parent / 'data'))
+
+# offline runs (see benchmarks/): every request goes to this replay server instead of the real site
+REPLAY_URL = os.environ.get('CRONSCRAPERS_REPLAY_URL') or None
+# every response fetched is also saved as a fixture into this directory
+RECORD_DIR = Path(os.environ['CRONSCRAPERS_RECORD_DIR']) if os.environ.get('CRONSCRAPERS_RECORD_DIR') else None
+# every phase of every url fetched is written as a span into a daily jsonl file in this directory (see common/tracing.py)
+TRACE_DIR = Path(os.environ['CRONSCRAPERS_TRACE_DIR']) if os.environ.get('CRONSCRAPERS_TRACE_DIR') else None
+
+# the daemon serves its prometheus metrics on 127.0.0.1:<port>/metrics, 0 turns the endpoint off
+METRICS_PORT = int(os.environ.get('CRONSCRAPERS_METRICS_PORT', 9464))
+
+# the rotating log of the process (see common/logging_setup.py) and its level
+LOG_DIR = Path(os.environ.get('CRONSCRAPERS_LOG_DIR', DATA_DIR / 'logs'))
+LOG_LEVEL = os.environ.get('CRONSCRAPERS_LOG_LEVEL', 'INFO').upper()
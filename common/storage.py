@@ -0,0 +1,194 @@
+import csv
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from common.settings import DATA_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+ARTICLES_DB = DATA_DIR / 'articles.sqlite'
+# kept for now as a plain export next to the database | zostawiamy csv jako zwykly eksport obok bazy
+CSV_FILE = 'output.csv'
+
+ARTICLE_FIELDS = ['fetchingDate', 'creationDate', 'author', 'authorLink', 'articleLink', 'articleTitle', 'articleText']
+# the article dict keys and the matching columns of the articles table
+_COLUMNS = {
+    'fetchingDate': 'fetching_date',
+    'creationDate': 'creation_date',
+    'author': 'author',
+    'authorLink': 'author_link',
+    'articleLink': 'article_link',
+    'articleTitle': 'article_title',
+    'articleText': 'article_text',
+}
+# sources that put several articles on a single page (cyberwire's daily briefing), their link alone isn't unique
+MULTI_ARTICLE_SOURCES = {'thecyberwire'}
+
+
+def is_article(result: Any) -> bool:
+    """Tell real article dicts apart from the {"url", "success", "error"} failure dicts and exceptions"""
+    return isinstance(result, dict) and all(field in result for field in ARTICLE_FIELDS)
+
+
+def article_key(source: str, article: Dict[str, Any]) -> str:
+    if source in MULTI_ARTICLE_SOURCES:
+        return f"{article['articleLink']}#{article['articleTitle']}"
+    return article['articleLink']
+
+
+class ArticleStore:
+    """WAL mode sqlite store of the articles, one row per unique article key"""
+
+    def __init__(self, path: Union[str, Path] = ARTICLES_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # the connection is shared with worker threads, the lock keeps the writes serialised
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS articles (
+                id INTEGER PRIMARY KEY,
+                article_key TEXT NOT NULL,
+                source TEXT NOT NULL,
+                fetching_date TEXT,
+                creation_date TEXT,
+                author TEXT,
+                author_link TEXT,
+                article_link TEXT NOT NULL,
+                article_title TEXT,
+                article_text TEXT
+            )
+        ''')
+        # id of the first article of the story the article belongs to (see common.dedup), NULL until it's clustered
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(articles)')}
+        if 'cluster_id' not in columns:
+            self.connection.execute('ALTER TABLE articles ADD COLUMN cluster_id INTEGER')
+        # bumped (to a number greater than any other article's) whenever an upsert changes the title or the text,
+        # so the indexes can find the articles to index again - NULL for an article never changed
+        if 'text_revision' not in columns:
+            self.connection.execute('ALTER TABLE articles ADD COLUMN text_revision INTEGER')
+        self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_articles_key ON articles (article_key)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_articles_link ON articles (article_link)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_articles_source ON articles (source)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_articles_creation_date ON articles (creation_date)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_articles_cluster ON articles (cluster_id)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS idx_articles_text_revision ON articles (text_revision)')
+        self.connection.commit()
+
+    def save_articles(self, source: str, results: Iterable[Any]) -> int:
+        """Upsert a batch of results in a single transaction, skipping the failed ones, and return how many were saved"""
+        rows = []
+        for result in results:
+            if not is_article(result):
+                logger.warning(f"[{source}] not saving a failed result: {result}")
+                continue
+            rows.append([article_key(source, result), source] + [result[field] for field in ARTICLE_FIELDS])
+        if not rows:
+            return 0
+
+        columns = ['article_key', 'source'] + [_COLUMNS[field] for field in ARTICLE_FIELDS]
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns[2:] if column != 'fetching_date')
+        # a changed text has to be clustered again
+        updates += ", cluster_id = CASE WHEN article_text IS excluded.article_text THEN cluster_id ELSE NULL END"
+        # and indexed again (every expression sees the row as it was before the update)
+        updates += (", text_revision = CASE WHEN article_text IS excluded.article_text AND article_title IS excluded.article_title "
+                    "THEN text_revision ELSE (SELECT COALESCE(MAX(text_revision), 0) + 1 FROM articles) END")
+        statement = (
+            f"INSERT INTO articles ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT(article_key) DO UPDATE SET {updates}"
+        )
+        with self.lock, self.connection:
+            self.connection.executemany(statement, rows)
+        return len(rows)
+
+    def get_articles(self,
+                     source: Optional[str] = None,
+                     since_id: int = 0,
+                     limit: Optional[int] = None,
+                     unique_stories: bool = False) -> List[Dict[str, Any]]:
+        """
+        Read articles back as the usual article dicts (plus `id`, `source` and `clusterId`), oldest first.
+        With `unique_stories` only the first article of every cluster of near-duplicates is returned.
+        """
+        query = f"SELECT id, source, cluster_id, {', '.join(_COLUMNS[field] for field in ARTICLE_FIELDS)} FROM articles WHERE id > ?"
+        params: List[Any] = [since_id]
+        if source is not None:
+            query += ' AND source = ?'
+            params.append(source)
+        if unique_stories:
+            query += ' AND (cluster_id IS NULL OR cluster_id = id)'
+        query += ' ORDER BY id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [dict(zip(['id', 'source', 'clusterId'] + ARTICLE_FIELDS, row)) for row in rows]
+
+    def get_revised_articles(self, since_revision: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Articles whose title or text an upsert changed after `since_revision`, like `get_articles` plus their `revision`"""
+        query = (f"SELECT id, source, cluster_id, text_revision, {', '.join(_COLUMNS[field] for field in ARTICLE_FIELDS)} "
+                 f"FROM articles WHERE text_revision > ? ORDER BY text_revision")
+        params: List[Any] = [since_revision]
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+        return [dict(zip(['id', 'source', 'clusterId', 'revision'] + ARTICLE_FIELDS, row)) for row in rows]
+
+    def get_articles_by_id(self, ids: Iterable[int]) -> List[Dict[str, Any]]:
+        """The articles with the given ids (the ones that exist), in no particular order"""
+        ids = list(ids)
+        if not ids:
+            return []
+        query = (f"SELECT id, source, cluster_id, {', '.join(_COLUMNS[field] for field in ARTICLE_FIELDS)} FROM articles "
+                 f"WHERE id IN ({', '.join('?' * len(ids))})")
+        with self.lock:
+            rows = self.connection.execute(query, ids).fetchall()
+        return [dict(zip(['id', 'source', 'clusterId'] + ARTICLE_FIELDS, row)) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def append_to_csv(results: Iterable[Any], csv_file: Union[str, Path] = CSV_FILE) -> int:
+    """Append the successful results to the csv, writing the header only into a new file"""
+    articles = [result for result in results if is_article(result)]
+    if not articles:
+        return 0
+    write_header = not os.path.exists(csv_file) or os.path.getsize(csv_file) == 0
+    with open(csv_file, mode='a', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=ARTICLE_FIELDS, extrasaction='ignore')
+        if write_header:
+            writer.writeheader()
+        writer.writerows(articles)
+    return len(articles)
+
+
+_article_store: Optional[ArticleStore] = None
+
+
+def get_article_store() -> ArticleStore:
+    """Return the process wide article store"""
+    global _article_store
+    if _article_store is None:
+        _article_store = ArticleStore()
+    return _article_store
+
+
+def save_results(source: str, results: Iterable[Any], csv_export: bool = True) -> int:
+    """Save a batch of processor results into the database and (unless told otherwise) the csv export"""
+    results = list(results)
+    saved = get_article_store().save_articles(source, results)
+    if csv_export:
+        append_to_csv(results)
+    return saved
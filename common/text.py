@@ -0,0 +1,15 @@
+import re
+from typing import List, Optional
+
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Lowercased words of the text (unicode aware, so polish words stay whole), digits-only tokens included (CVE ids)"""
+    return _WORD.findall((text or '').lower())
+
+
+def article_text(article: dict) -> str:
+    """What an article is searched and compared by - its title followed by its text"""
+    return f"{article.get('articleTitle') or ''}\n{article.get('articleText') or ''}"
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import aiohttp
+
+from common.cloudflare_clearance import get_clearance_manager
+from common.html_cache import cache_html, cached_html
+from common.http_client import get_session
+from common.metrics import ARTICLE_FETCH_SECONDS, timed
+from common.politeness import get_politeness_scheduler
+from common.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+# what the plain http tier looks like to the site
+HTTP_TIER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+# bits of cloudflare's interstitial pages that never appear in a real article - not the challenge-platform script
+# or the turnstile widget, cloudflare injects those into ordinary pages of the sites it fronts as well
+CHALLENGE_MARKERS = (
+    'cf-browser-verification',
+    '_cf_chl_opt',
+    '<title>Just a moment...</title>',
+    'Attention Required! | Cloudflare',
+)
+# statuses cloudflare answers a challenge or a block with, only these (and cf-mitigated) mean the clearance was refused
+CHALLENGE_STATUSES = (403, 503)
+# after this many escalations in a row the http tier is only tried every PROBE_EVERY-th url, it's evidently blocked
+SKIP_HTTP_AFTER = 5
+PROBE_EVERY = 10
+
+
+def _outcome(reason: Optional[str]) -> str:
+    """Metrics outcome of an http tier attempt out of why it wasn't enough"""
+    if reason is None:
+        return 'ok'
+    if reason.startswith('status:'):
+        return 'non_200'
+    if reason == 'missing-anchor':
+        return 'selector_miss'
+    if reason == 'error:TimeoutError':
+        return 'timeout'
+    if reason.startswith('error:'):
+        return 'error'
+    return 'challenge'
+
+
+def challenge_reason(status: int, headers: Any, html: str, complete: bool = False) -> Optional[str]:
+    """Why the response isn't the real page, None if it looks like it is (a complete page is never a challenge page)"""
+    if headers.get('cf-mitigated') == 'challenge':
+        return 'cf-mitigated'
+    if status != 200:
+        return f"status:{status}"
+    if complete:
+        return None
+    for marker in CHALLENGE_MARKERS:
+        if marker in html:
+            return 'challenge-page'
+    return None
+
+
+class EscalationStats:
+    """How often the plain http tier of a source was enough and why it wasn't"""
+
+    def __init__(self):
+        self.urls = 0
+        self.http_ok = 0
+        self.escalated = 0
+        self.skipped_http = 0
+        self.reasons: Dict[str, int] = {}
+        self.consecutive_escalations = 0
+
+    @property
+    def escalation_rate(self) -> float:
+        return self.escalated / self.urls if self.urls else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'urls': self.urls,
+            'http_ok': self.http_ok,
+            'escalated': self.escalated,
+            'escalation_rate': round(self.escalation_rate, 3),
+            'skipped_http': self.skipped_http,
+            'reasons': self.reasons,
+        }
+
+
+_stats: Dict[str, EscalationStats] = {}
+
+
+def get_escalation_stats() -> Dict[str, EscalationStats]:
+    """Per source escalation statistics of every tiered fetcher of the process"""
+    return _stats
+
+
+def log_escalation_stats():
+    for source, stats in _stats.items():
+        logger.info(f"[{source}] tiered fetch stats: {stats.as_dict()}")
+
+
+class TieredFetcher:
+    """
+    Fetch article pages with the shared http client first and render them in the browser only if that wasn't enough
+    (a challenge page, an error status, or the page lacks what the parser needs).
+    """
+
+    def __init__(self,
+                 source: str,
+                 render: Callable[[str], Awaitable[Optional[str]]],
+                 is_complete: Callable[[str], bool],
+                 browser_concurrency: int = 1,
+                 headers: Optional[Dict[str, str]] = None,
+                 use_clearance: bool = False):
+        self.source = source
+        self.render = render
+        self.is_complete = is_complete
+        self.headers = headers or HTTP_TIER_HEADERS
+        # send the cloudflare clearance the browser got (cookies + its user agent) with the plain requests
+        self.use_clearance = use_clearance
+        # the browser tier keeps the concurrency the source always had, only the http tier goes wider
+        self._browser_slots = asyncio.Semaphore(browser_concurrency)
+        self.stats = _stats.setdefault(source, EscalationStats())
+
+    async def _fetch_http(self, url: str) -> Dict[str, Any]:
+        """Plain GET of the url, returning the html or why it isn't usable"""
+        with timed(ARTICLE_FETCH_SECONDS, source=self.source, tier='http') as stage, span('http_tier') as attributes:
+            result = await self._get(url)
+            stage.outcome = _outcome(result['reason'])
+            attributes['outcome'] = result['reason'] or 'ok'
+        return result
+
+    async def _get(self, url: str) -> Dict[str, Any]:
+        clearance = get_clearance_manager().get(url) if self.use_clearance else None
+        headers = {**self.headers, **clearance.headers()} if clearance is not None else self.headers
+        await get_politeness_scheduler().wait(url)
+        session = await get_session()
+        try:
+            async with session.get(url, headers=headers) as response:
+                html = await response.text(errors='replace')
+                complete = response.status == 200 and self.is_complete(html)
+                reason = challenge_reason(response.status, response.headers, html, complete)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {'html': None, 'reason': f"error:{type(e).__name__}"}
+        if clearance is not None and (reason == 'cf-mitigated' or response.status in CHALLENGE_STATUSES):
+            # challenged in spite of the clearance, the next render has to get a fresh one - a marker in the body alone
+            # (or a missing anchor) says nothing about the clearance, it's kept
+            get_clearance_manager().invalidate(url)
+        if reason is None and not complete:
+            reason = 'missing-anchor'
+        return {'html': html if reason is None else None, 'reason': reason}
+
+    def _should_try_http(self, url: str) -> bool:
+        if self.stats.consecutive_escalations < SKIP_HTTP_AFTER:
+            return True
+        if self.use_clearance and get_clearance_manager().get(url) is not None:
+            # a fresh clearance is exactly what the http tier was missing
+            return True
+        # the http tier keeps failing, only probe it now and then in case the block was lifted
+        return self.stats.urls % PROBE_EVERY == 0
+
+    async def fetch(self, url: str) -> Optional[str]:
+        cached = await cached_html(url)
+        if cached is not None:
+            return cached
+
+        self.stats.urls += 1
+        if self._should_try_http(url):
+            result = await self._fetch_http(url)
+            if result['html'] is not None:
+                self.stats.http_ok += 1
+                self.stats.consecutive_escalations = 0
+                await cache_html(self.source, url, result['html'])
+                return result['html']
+            reason = result['reason']
+            logger.info(f"[{self.source}] escalating {url} to the browser ({reason})")
+        else:
+            self.stats.skipped_http += 1
+            reason = 'http-tier-skipped'
+
+        self.stats.escalated += 1
+        self.stats.consecutive_escalations += 1
+        self.stats.reasons[reason] = self.stats.reasons.get(reason, 0) + 1
+        with span('browser_slot_wait'):
+            await self._browser_slots.acquire()
+        try:
+            with timed(ARTICLE_FETCH_SECONDS, source=self.source, tier='browser') as stage, span('browser_tier', reason=reason) as attributes:
+                html = await self.render(url)
+                if html is None:
+                    stage.outcome = attributes['outcome'] = 'failed'
+            return html
+        finally:
+            self._browser_slots.release()
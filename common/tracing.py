@@ -0,0 +1,207 @@
+import argparse
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from common.metrics import current_source
+from common.settings import TRACE_DIR
+
+
+logger = logging.getLogger(__name__)
+
+
+# the spans are buffered and appended to the file this many at a time (and at the end of every sweep)
+FLUSH_EVERY = 256
+# every process writes its spans under its own run id, so the same url in two runs isn't summed up
+RUN_ID = f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+
+# url the running code works on, set by the outermost span of the url - every nested span (and task) inherits it
+_current_url: ContextVar[Optional[str]] = ContextVar('trace_url', default=None)
+# phase path of the span the running code is in, e.g. 'fetch/http_get'
+_current_path: ContextVar[Optional[str]] = ContextVar('trace_path', default=None)
+
+
+class SpanWriter:
+    """Buffered appender of span records to a daily jsonl file"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._buffer: List[str] = []
+        # spans end in worker threads too (the parsing)
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) < FLUSH_EVERY:
+                return
+            lines, self._buffer = self._buffer, []
+        self._append(lines)
+
+    def flush(self):
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if lines:
+            self._append(lines)
+
+    def _append(self, lines: List[str]):
+        try:
+            with open(self.path / f"spans-{datetime.now():%Y-%m-%d}.jsonl", 'a', encoding='utf-8') as file:
+                file.write('\n'.join(lines) + '\n')
+        except OSError as e:
+            # tracing is a diagnostic, it never takes a sweep down
+            logger.warning(f"Writing {len(lines)} trace spans failed: {e}")
+
+
+_writer: Optional[SpanWriter] = SpanWriter(TRACE_DIR) if TRACE_DIR is not None else None
+if _writer is not None:
+    atexit.register(_writer.flush)
+
+
+def tracing_enabled() -> bool:
+    return _writer is not None
+
+
+def record_span(phase: str, started: float, duration: float, url: Optional[str] = None, **attributes: Any):
+    """Write a span measured by the caller (`started` is a wall clock timestamp) under the current span"""
+    if _writer is None:
+        return
+    parent = _current_path.get()
+    _writer.write({
+        'run': RUN_ID,
+        'source': current_source.get(),
+        'url': url or _current_url.get(),
+        'phase': f"{parent}/{phase}" if parent else phase,
+        'ts': round(started, 6),
+        'duration': round(duration, 6),
+        **attributes,
+    })
+
+
+@contextmanager
+def span(phase: str, url: Optional[str] = None, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Time the block as one phase of the url's timeline (the url of the enclosing span unless given). The yielded dict
+    takes extra attributes of the span; the outcome is 'ok', or the name of the exception that left the block.
+    """
+    if _writer is None:
+        yield attributes
+        return
+    url_token = _current_url.set(url) if url is not None else None
+    parent = _current_path.get()
+    path_token = _current_path.set(f"{parent}/{phase}" if parent else phase)
+    started = time.time()
+    started_counter = time.perf_counter()
+    attributes.setdefault('outcome', 'ok')
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes['outcome'] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started_counter
+        _current_path.reset(path_token)
+        record_span(phase, started, duration, url=url, **attributes)
+        if url_token is not None:
+            _current_url.reset(url_token)
+
+
+def flush_spans():
+    """Append the buffered spans to the trace file"""
+    if _writer is not None:
+        _writer.flush()
+
+
+# ---- report -----------------------------------------------------------------
+
+
+def read_spans(paths: Iterable[Union[str, Path]]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the last line of a file that's still being written
+                    continue
+
+
+def url_timelines(spans: Iterable[Dict[str, Any]],
+                  source: Optional[str] = None) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """Per (run, url): its source, its total time (the sum of its top level phases) and the time of every phase path"""
+    timelines: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for record in spans:
+        if not record.get('url') or (source is not None and record.get('source') != source):
+            continue
+        timeline = timelines.setdefault((record['run'], record['url']), {
+            'source': record.get('source'), 'total': 0.0, 'phases': defaultdict(float), 'counts': defaultdict(int), 'failed': [],
+        })
+        timeline['phases'][record['phase']] += record['duration']
+        timeline['counts'][record['phase']] += 1
+        if '/' not in record['phase']:
+            timeline['total'] += record['duration']
+        if record.get('outcome', 'ok') != 'ok':
+            timeline['failed'].append(f"{record['phase']}: {record['outcome']}")
+    return timelines
+
+
+def _percentile(values: List[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def format_report(timelines: Dict[Tuple[str, str], Dict[str, Any]], top: int = 10) -> str:
+    lines = []
+    slowest = sorted(timelines.items(), key=lambda item: item[1]['total'], reverse=True)[:top]
+    lines.append(f"Slowest {len(slowest)} of {len(timelines)} urls:")
+    for (run, url), timeline in slowest:
+        lines.append(f"\n{timeline['total']:8.2f}s  [{timeline['source']}] {url}  (run {run})")
+        for phase in sorted(timeline['phases']):
+            depth = phase.count('/')
+            count = timeline['counts'][phase]
+            lines.append(f"{timeline['phases'][phase]:8.2f}s  {'  ' * (depth + 1)}{phase.rsplit('/', 1)[-1]}"
+                         + (f" x{count}" if count > 1 else ''))
+        for failure in timeline['failed']:
+            lines.append(f"{'':10}  ! {failure}")
+
+    # where the time goes over all the urls, the hot spots are at the top
+    per_phase: Dict[str, List[float]] = defaultdict(list)
+    for timeline in timelines.values():
+        for phase, duration in timeline['phases'].items():
+            per_phase[phase].append(duration)
+    lines.append(f"\n{'phase':40} {'urls':>6} {'total':>10} {'p50':>8} {'p95':>8} {'max':>8}")
+    for phase, durations in sorted(per_phase.items(), key=lambda item: sum(item[1]), reverse=True):
+        lines.append(f"{phase:40} {len(durations):6} {sum(durations):9.1f}s {_percentile(durations, 0.5):7.2f}s "
+                     f"{_percentile(durations, 0.95):7.2f}s {max(durations):7.2f}s")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the slowest urls of the trace files with the breakdown of their phases")
+    parser.add_argument('files', nargs='*', type=Path,
+                        help="span files (default: every spans-*.jsonl in CRONSCRAPERS_TRACE_DIR)")
+    parser.add_argument('--top', type=int, default=10, help="how many of the slowest urls to print")
+    parser.add_argument('--source', default=None, help="only the urls of this source")
+    parser.add_argument('--run', default=None, help="only the spans of this run id")
+    args = parser.parse_args()
+
+    files = args.files or (sorted(TRACE_DIR.glob('spans-*.jsonl')) if TRACE_DIR is not None else [])
+    if not files:
+        parser.error("no span files given and CRONSCRAPERS_TRACE_DIR has none")
+    spans = (record for record in read_spans(files) if args.run is None or record.get('run') == args.run)
+    print(format_report(url_timelines(spans, args.source), args.top))
+
+
+if __name__ == '__main__':
+    main()
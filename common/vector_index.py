@@ -0,0 +1,311 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from common.settings import DATA_DIR
+from common.storage import ArticleStore, get_article_store
+from common.text import article_text, tokenize
+
+
+logger = logging.getLogger(__name__)
+
+
+VECTOR_INDEX_DIR = DATA_DIR / 'vector_index'
+# dimensions of the hashed vectors - 100k articles take 400 MB of float32 on disk, only the touched pages are in memory
+DIM = 1024
+# the matrix file grows by at least this many rows at a time, so appending doesn't mean resizing it on every run
+GROW_ROWS = 4096
+# rows multiplied at once in a query, keeps the temporary scores small however big the matrix gets
+QUERY_CHUNK_ROWS = 65536
+# articles vectorized per read from the article store
+UPDATE_BATCH_SIZE = 1000
+# hash collisions alone give unrelated articles cosines of up to ~0.15 at this DIM, below this nothing counts as relevant
+MIN_SCORE = 0.2
+# below this many rows a query scans the whole matrix (~0.4 us a row, so ~20 ms here), past it only the rows of the
+# cells (k-means clusters of the rows) closest to the query are scored - ~sqrt(N) cells, so a query costs O(sqrt(N))
+IVF_MIN_ROWS = 50_000
+# cells scored per query, more of them trade speed for recall
+IVF_PROBE_CELLS = 16
+# the cells are trained again once the matrix is this many times the size they were trained on
+IVF_RETRAIN_GROWTH = 4
+# rows sampled per cell to train the cells on, and the k-means rounds
+IVF_SAMPLE_PER_CELL = 32
+IVF_TRAIN_ROUNDS = 8
+
+
+def _feature(token: str) -> Tuple[int, float]:
+    """Dimension and sign of a token - the sign keeps hash collisions from only ever adding up"""
+    value = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+    return value % DIM, 1.0 if value >> 63 else -1.0
+
+
+def term_counts(text: str) -> Counter:
+    """Words and word bigrams of the text with their counts"""
+    words = tokenize(text)
+    return Counter(words + [f"{a} {b}" for a, b in zip(words, words[1:])])
+
+
+def vectorize(counts: Counter, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """Hashed, sublinear tf vector of the terms (times the per dimension `weights` if given), L2 normalised"""
+    vector = np.zeros(DIM, dtype=np.float32)
+    for term, count in counts.items():
+        dimension, sign = _feature(term)
+        vector[dimension] += sign * (1.0 + math.log(count))
+    if weights is not None:
+        vector *= weights
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class VectorIndex:
+    """
+    Hashed term vectors of every stored article in a memory mapped float32 matrix, one row per article.
+    Only the articles added since the last update are vectorized, plus the ones whose title or text an upsert
+    changed since - their rows are overwritten in place. Once the matrix is big enough its rows are bucketed into
+    cells around k-means centroids (an inverted file), and a search only scores the rows of the closest cells.
+    """
+
+    def __init__(self, path: Union[str, Path] = VECTOR_INDEX_DIR, store: Optional[ArticleStore] = None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.store = store or get_article_store()
+        self.lock = threading.Lock()
+        # ivf_rows: how many rows the cells were trained on, 0 while there are no cells
+        self.meta = {'dim': DIM, 'count': 0, 'capacity': 0, 'last_article_id': 0, 'last_revision': 0, 'ivf_rows': 0}
+        try:
+            with open(self.path / 'meta.json', 'r', encoding='utf-8') as file:
+                self.meta.update(json.load(file))
+        except FileNotFoundError:
+            pass
+        if self.meta['dim'] != DIM:
+            raise ValueError(f"Vector index in {self.path} has {self.meta['dim']} dimensions, {DIM} expected - delete it to rebuild")
+        # in how many articles every dimension is non zero, gives the idf weights of the queries
+        document_frequency_file = self.path / 'document_frequency.npy'
+        self.document_frequency = np.load(document_frequency_file) if document_frequency_file.exists() else np.zeros(DIM, dtype=np.int64)
+        self._vectors: Optional[np.memmap] = None
+        self._article_ids: Optional[np.memmap] = None
+        # cell of every row, meaningful only while there are centroids
+        self._cells: Optional[np.memmap] = None
+        centroids_file = self.path / 'centroids.npy'
+        self._centroids: Optional[np.ndarray] = np.load(centroids_file) if self.meta['ivf_rows'] and centroids_file.exists() else None
+        # rows of every cell (the inverted lists), built in memory out of the cells when a search first needs them
+        self._lists: Optional[Tuple[int, np.ndarray, np.ndarray]] = None
+        self._map(self.meta['capacity'])
+
+    def _map(self, capacity: int):
+        """(Re)map the matrix and the article ids with room for `capacity` rows, growing the files if needed"""
+        self._vectors = self._article_ids = self._cells = None
+        if capacity == 0:
+            return
+        for name, row_bytes in (('vectors.f32', DIM * 4), ('article_ids.i64', 8), ('cells.i32', 4)):
+            with open(self.path / name, 'ab') as file:
+                if file.tell() < capacity * row_bytes:
+                    file.truncate(capacity * row_bytes)
+        self._vectors = np.memmap(self.path / 'vectors.f32', dtype=np.float32, mode='r+', shape=(capacity, DIM))
+        self._article_ids = np.memmap(self.path / 'article_ids.i64', dtype=np.int64, mode='r+', shape=(capacity,))
+        self._cells = np.memmap(self.path / 'cells.i32', dtype=np.int32, mode='r+', shape=(capacity,))
+        self.meta['capacity'] = capacity
+
+    def _save_meta(self):
+        np.save(self.path / 'document_frequency.tmp.npy', self.document_frequency)
+        os.replace(self.path / 'document_frequency.tmp.npy', self.path / 'document_frequency.npy')
+        tmp_path = self.path / 'meta.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.meta, file, indent=1)
+        os.replace(tmp_path, self.path / 'meta.json')
+
+    def __len__(self) -> int:
+        return self.meta['count']
+
+    def _append(self, article_ids: List[int], vectors: np.ndarray):
+        count = self.meta['count']
+        needed = count + len(article_ids)
+        if needed > self.meta['capacity']:
+            self._map(max(needed, self.meta['capacity'] * 2, GROW_ROWS))
+        self._vectors[count:needed] = vectors
+        self._article_ids[count:needed] = article_ids
+        if self._centroids is not None:
+            self._cells[count:needed] = self._assign(vectors)
+            self._cells.flush()
+        self.document_frequency += np.count_nonzero(vectors, axis=0)
+        # the rows hit the disk before the meta says they're there, a crash in between only loses the batch
+        self._vectors.flush()
+        self._article_ids.flush()
+        self.meta['count'] = needed
+        self.meta['last_article_id'] = int(article_ids[-1])
+        self._save_meta()
+
+    def _overwrite(self, article_ids: List[int], vectors: np.ndarray, last_revision: int):
+        count = self.meta['count']
+        # the rows are appended in the order of the article ids, so they're sorted by them
+        rows = np.searchsorted(self._article_ids[:count], article_ids) if count else np.zeros(len(article_ids), dtype=np.int64)
+        for row, article_id, vector in zip(rows, article_ids, vectors):
+            if row >= count or self._article_ids[row] != article_id:
+                continue
+            self.document_frequency += (vector != 0).astype(np.int64) - (self._vectors[row] != 0)
+            self._vectors[row] = vector
+            if self._centroids is not None:
+                self._cells[row] = self._assign(vector[None, :])[0]
+        self._vectors.flush()
+        self._cells.flush()
+        self._lists = None
+        self.meta['last_revision'] = last_revision
+        self._save_meta()
+
+    def update(self, batch_size: int = UPDATE_BATCH_SIZE) -> int:
+        """Vectorize the articles saved (or changed) since the last update and return how many were added"""
+        added = revised = 0
+        with self.lock:
+            while True:
+                articles = self.store.get_articles(since_id=self.meta['last_article_id'], limit=batch_size)
+                if not articles:
+                    break
+                vectors = np.stack([vectorize(term_counts(article_text(article))) for article in articles])
+                self._append([article['id'] for article in articles], vectors)
+                added += len(articles)
+            while True:
+                articles = self.store.get_revised_articles(since_revision=self.meta['last_revision'], limit=batch_size)
+                if not articles:
+                    break
+                vectors = np.stack([vectorize(term_counts(article_text(article))) for article in articles])
+                self._overwrite([article['id'] for article in articles], vectors, articles[-1]['revision'])
+                revised += len(articles)
+            if len(self) >= IVF_MIN_ROWS and len(self) >= IVF_RETRAIN_GROWTH * self.meta['ivf_rows']:
+                self._train_cells()
+        if added or revised:
+            logger.info(f"Vector index: {added} articles added, {revised} vectorized again, {len(self)} in total")
+        return added
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """Cell of every vector - the centroid with the highest cosine"""
+        return np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _train_cells(self):
+        """(Re)train ~sqrt(N) centroids with spherical k-means on a sample of the rows and put every row in its cell"""
+        count = len(self)
+        cells = int(math.sqrt(count))
+        rng = np.random.default_rng(count)
+        sample = np.array(self._vectors[np.sort(rng.choice(count, min(count, cells * IVF_SAMPLE_PER_CELL), replace=False))])
+        centroids = sample[rng.choice(len(sample), cells, replace=False)]
+        for _ in range(IVF_TRAIN_ROUNDS):
+            assigned = np.argmax(sample @ centroids.T, axis=1)
+            by_cell = np.argsort(assigned, kind='stable')
+            filled, firsts = np.unique(assigned[by_cell], return_index=True)
+            sums = np.zeros_like(centroids)
+            sums[filled] = np.add.reduceat(sample[by_cell], firsts, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # a cell left empty keeps its centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids).astype(np.float32)
+        self._centroids = centroids
+        for start in range(0, count, QUERY_CHUNK_ROWS):
+            self._cells[start:min(start + QUERY_CHUNK_ROWS, count)] = self._assign(self._vectors[start:min(start + QUERY_CHUNK_ROWS, count)])
+        self._cells.flush()
+        np.save(self.path / 'centroids.tmp.npy', centroids)
+        os.replace(self.path / 'centroids.tmp.npy', self.path / 'centroids.npy')
+        self.meta['ivf_rows'] = count
+        self._save_meta()
+        self._lists = None
+        logger.info(f"Vector index: {count} rows bucketed into {cells} cells")
+
+    def _inverted_lists(self, count: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows sorted by their cell and where every cell starts in them, for the first `count` rows"""
+        lists = self._lists
+        if lists is None or lists[0] != count:
+            order = np.argsort(self._cells[:count], kind='stable')
+            starts = np.searchsorted(self._cells[:count][order], np.arange(len(self._centroids) + 1))
+            lists = self._lists = (count, order, starts)
+        return lists[1], lists[2]
+
+    def idf_weights(self) -> np.ndarray:
+        documents = max(self.meta['count'], 1)
+        return np.log((documents + 1) / (self.document_frequency + 1)).astype(np.float32) + 1.0
+
+    def search_vector(self,
+                      query: np.ndarray,
+                      k: int = 10,
+                      min_score: float = 0.0,
+                      exact: bool = False) -> List[Tuple[int, float]]:
+        """
+        (article id, cosine score) of the k rows closest to the query vector scoring at least `min_score`, best first.
+        With cells only the rows of the IVF_PROBE_CELLS cells closest to the query are scored - approximate, a close row
+        sitting in another cell is missed. `exact` (and a matrix too small for cells) scans every row instead.
+        """
+        count = self.meta['count']
+        if count == 0 or not np.any(query):
+            return []
+        if self._centroids is not None and not exact:
+            return self._search_cells(query, count, k, min_score)
+        best_ids: List[np.ndarray] = []
+        best_scores: List[np.ndarray] = []
+        for start in range(0, count, QUERY_CHUNK_ROWS):
+            scores = self._vectors[start:min(start + QUERY_CHUNK_ROWS, count)] @ query
+            keep = np.flatnonzero(scores >= min_score)
+            if len(keep) > k:
+                keep = keep[np.argpartition(scores[keep], -k)[-k:]]
+            best_ids.append(self._article_ids[start + keep])
+            best_scores.append(scores[keep])
+        ids = np.concatenate(best_ids)
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    def _search_cells(self, query: np.ndarray, count: int, k: int, min_score: float) -> List[Tuple[int, float]]:
+        order, starts = self._inverted_lists(count)
+        cell_scores = self._centroids @ query
+        probed = np.argpartition(-cell_scores, min(IVF_PROBE_CELLS, len(cell_scores)) - 1)[:IVF_PROBE_CELLS]
+        # in row order, so the matrix is read front to back
+        rows = np.sort(np.concatenate([order[starts[cell]:starts[cell + 1]] for cell in probed]))
+        scores = self._vectors[rows] @ query
+        keep = np.flatnonzero(scores >= min_score)
+        keep = keep[np.argsort(-scores[keep], kind='stable')[:k]]
+        return [(int(self._article_ids[rows[i]]), float(scores[i])) for i in keep]
+
+    def search(self, text: str, k: int = 10, min_score: float = MIN_SCORE) -> List[Tuple[int, float]]:
+        """
+        Articles most similar to the text, best first. Rare terms weigh more in the query (idf), so a score is
+        a cosine of the idf weighted query and the article; below `min_score` nothing is considered relevant.
+        """
+        return self.search_vector(vectorize(term_counts(text), self.idf_weights()), k, min_score)
+
+    def similar_articles(self, article_id: int, k: int = 10, min_score: float = MIN_SCORE) -> List[Tuple[int, float]]:
+        """Articles most similar to a stored one (the article itself left out)"""
+        count = self.meta['count']
+        row = int(np.searchsorted(self._article_ids[:count], article_id)) if count else 0
+        if row >= count or self._article_ids[row] != article_id:
+            return []
+        query = np.array(self._vectors[row])
+        return [(other, score) for other, score in self.search_vector(query, k + 1, min_score) if other != article_id][:k]
+
+    def search_articles(self, text: str, k: int = 10, min_score: float = MIN_SCORE) -> List[Dict[str, Any]]:
+        """Like `search`, but the article dicts themselves (with their `score`) come back"""
+        hits = self.search(text, k, min_score)
+        articles = {article['id']: article for article in self.store.get_articles_by_id([article_id for article_id, _ in hits])}
+        return [{**articles[article_id], 'score': score} for article_id, score in hits if article_id in articles]
+
+
+_vector_index: Optional[VectorIndex] = None
+
+
+def get_vector_index() -> VectorIndex:
+    """Return the process wide vector index"""
+    global _vector_index
+    if _vector_index is None:
+        _vector_index = VectorIndex()
+    return _vector_index
+
+
+def update_vector_index() -> int:
+    """Add the newly saved articles to the vector index, never raising (it's caught up on the next run anyway)"""
+    try:
+        return get_vector_index().update()
+    except Exception as e:
+        logger.exception(f"Updating the vector index failed: {e}")
+        return 0
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import signal
+import time
+from typing import Any, Dict, List, Optional
+
+import orchestrator
+from common.browser_pool import close_browser_pool
+from common.http_client import close_session, get_session
+from common.metrics import start_metrics_server
+from common.settings import DATA_DIR, METRICS_PORT
+from common.tiered_fetch import log_escalation_stats
+
+
+logger = logging.getLogger(__name__)
+
+
+# how long the sweeps in flight get to finish after a shutdown signal before they're cancelled
+SHUTDOWN_GRACE = 60
+# the first sweeps are spread over this many seconds, so a restart doesn't hit every source at the same moment
+STARTUP_SPREAD = 30
+
+SCHEDULE_STATE_FILE = DATA_DIR / 'schedules.json'
+# the publishing rate of a source is a moving average of what the sweeps found, older observations fade out over this many hours
+RATE_WINDOW_HOURS = 72
+# a source is polled about when this many new links are expected (halving it halves the average lag, and doubles the polls)
+NEW_LINKS_PER_POLL = 0.5
+# every poll in a row that found nothing multiplies the learned interval by this once more (up to max_interval)
+EMPTY_POLL_BACKOFF = 1.5
+# the jitter never gets bigger than this share of the interval
+MAX_JITTER_SHARE = 0.1
+
+
+class SourceSchedule:
+    """
+    When the daemon sweeps one source next. The interval follows the publishing rate of the source learned from
+    the links its sweeps found new, backs off fast after empty polls and stays within min_interval..max_interval.
+    """
+
+    def __init__(self,
+                 name: str,
+                 interval: float,
+                 jitter: float = 0.0,
+                 min_interval: Optional[float] = None,
+                 max_interval: Optional[float] = None,
+                 state: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.jitter = jitter
+        self.min_interval = min_interval if min_interval is not None else interval
+        self.max_interval = max_interval if max_interval is not None else interval
+        state = state or {}
+        self.interval = min(max(state.get('interval', interval), self.min_interval), self.max_interval)
+        # new links per hour, None until there's been a sweep to compare with
+        self.rate: Optional[float] = state.get('rate')
+        self.empty_streak: int = state.get('empty_streak', 0)
+        self.last_poll: Optional[float] = state.get('last_poll')
+        self.last_result: Optional[Dict[str, Any]] = None
+        self.next_run = time.monotonic() + random.uniform(0, STARTUP_SPREAD)
+
+    def state(self) -> Dict[str, Any]:
+        return {'interval': self.interval, 'rate': self.rate, 'empty_streak': self.empty_streak, 'last_poll': self.last_poll}
+
+    def _learn(self, new_links: int):
+        now = time.time()
+        if self.last_poll is not None and now > self.last_poll:
+            hours = (now - self.last_poll) / 3600
+            observed = new_links / hours
+            # time weighted: a poll after a long pause says more about the rate than one right after the previous
+            weight = 1 - math.exp(-hours / RATE_WINDOW_HOURS)
+            self.rate = observed if self.rate is None else weight * observed + (1 - weight) * self.rate
+        self.last_poll = now
+
+        self.empty_streak = 0 if new_links else self.empty_streak + 1
+        # a source that hasn't published anything in a long time (rate ~ 0) just ends up at max_interval
+        learned = NEW_LINKS_PER_POLL / self.rate * 3600 if self.rate else self.interval
+        interval = learned * EMPTY_POLL_BACKOFF ** self.empty_streak
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+
+    def record(self, result: Dict[str, Any], new_links: Optional[int] = None):
+        """Note the outcome of a sweep (and how many new links it found) and schedule the next one"""
+        self.last_result = result
+        # a failed or skipped sweep says nothing about the source's publishing, the interval stays as it was
+        if result['status'] == 'ok' and new_links is not None:
+            self._learn(new_links)
+        jitter = min(self.jitter, self.interval * MAX_JITTER_SHARE)
+        self.next_run = time.monotonic() + max(0.0, self.interval + random.uniform(-jitter, jitter))
+
+
+def load_schedule_state() -> Dict[str, Dict[str, Any]]:
+    try:
+        with open(SCHEDULE_STATE_FILE, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Schedule state {SCHEDULE_STATE_FILE} is unreadable, starting from the configured intervals: {e}")
+        return {}
+
+
+def save_schedule_state(schedules: Dict[str, SourceSchedule]):
+    SCHEDULE_STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = SCHEDULE_STATE_FILE.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({name: schedule.state() for name, schedule in schedules.items()}, file, indent=1)
+    os.replace(tmp_path, SCHEDULE_STATE_FILE)
+
+
+class Daemon:
+    """
+    Resident scheduler sweeping every source on its own interval, all on one event loop.
+    The http session, the browser pool and everything imported stay warm between the sweeps, so a sweep costs
+    only its network work; the overlap lock of `orchestrator.run_source` keeps two sweeps of a source from running together.
+    """
+
+    def __init__(self,
+                 names: Optional[List[str]] = None,
+                 shutdown_grace: float = SHUTDOWN_GRACE,
+                 metrics_port: int = METRICS_PORT):
+        names = names or list(orchestrator.SOURCES)
+        state = load_schedule_state()
+        self.schedules = {
+            name: SourceSchedule(
+                name,
+                orchestrator.SOURCES[name]['interval'],
+                orchestrator.SOURCES[name]['jitter'],
+                orchestrator.SOURCES[name].get('min_interval'),
+                orchestrator.SOURCES[name].get('max_interval'),
+                state=state.get(name),
+            )
+            for name in names
+        }
+        self.shutdown_grace = shutdown_grace
+        self.metrics_port = metrics_port
+        self.stopping = asyncio.Event()
+        self._sweeps: Dict[str, asyncio.Task] = {}
+
+    def stop(self):
+        if not self.stopping.is_set():
+            logger.info("Shutdown requested, no new sweeps are started")
+            self.stopping.set()
+
+    async def _sweep(self, schedule: SourceSchedule):
+        result = await orchestrator.run_source(schedule.name)
+        # what the sweep's own collector found new - not a count of the seen store, a backfill of the source marks links seen too
+        new_links = result.get('new_links')
+        schedule.record(result, new_links)
+        save_schedule_state(self.schedules)
+        await orchestrator.update_indexes()
+        rate = f"{schedule.rate:.2f}/h" if schedule.rate is not None else 'unknown'
+        logger.info(f"[{schedule.name}] {new_links} new links, publishing rate {rate}, "
+                    f"next sweep in {schedule.next_run - time.monotonic():.0f}s")
+
+    async def _source_loop(self, schedule: SourceSchedule):
+        while not self.stopping.is_set():
+            delay = schedule.next_run - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), timeout=delay)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+            # the sweep is a task of its own so the shutdown can give it a grace period instead of cancelling it outright
+            self._sweeps[schedule.name] = asyncio.create_task(self._sweep(schedule))
+            try:
+                await asyncio.shield(self._sweeps[schedule.name])
+            except Exception as e:
+                logger.exception(f"[{schedule.name}] sweep crashed: {e}")
+                schedule.record({'source': schedule.name, 'status': 'failed', 'error': str(e), 'elapsed': 0.0})
+            finally:
+                if self._sweeps.get(schedule.name) is not None and self._sweeps[schedule.name].done():
+                    del self._sweeps[schedule.name]
+
+    async def _shutdown(self):
+        running = [task for task in self._sweeps.values() if not task.done()]
+        if running:
+            logger.info(f"Waiting up to {self.shutdown_grace}s for {len(running)} running sweeps")
+            done, pending = await asyncio.wait(running, timeout=self.shutdown_grace)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        log_escalation_stats()
+        await close_browser_pool()
+        await close_session()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):  # windows, or not the main thread
+                pass
+
+        # opened once for the whole life of the daemon, as is the browser pool on the first browser sweep
+        await get_session()
+        metrics_runner = None
+        if self.metrics_port:
+            try:
+                metrics_runner = await start_metrics_server(self.metrics_port)
+            except OSError as e:
+                # e.g. the port is taken - the sweeps matter more than their metrics
+                logger.error(f"Metrics endpoint on port {self.metrics_port} couldn't be started: {e}")
+        logger.info(f"Daemon started for {', '.join(self.schedules)}")
+        loops = [asyncio.create_task(self._source_loop(schedule)) for schedule in self.schedules.values()]
+        try:
+            await self.stopping.wait()
+        finally:
+            self.stop()
+            await self._shutdown()
+            await asyncio.gather(*loops, return_exceptions=True)
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            logger.info("Daemon stopped")
+
+
+async def run_daemon(names: Optional[List[str]] = None):
+    await Daemon(names).run()
@@ -1,34 +1,43 @@
+import asyncio
+import logging
 import feedparser
+from pathlib import Path
 
+from common.conditional_get import get_validator_cache
+from common.http_client import close_session
+from common.logging_setup import setup_logging
+from common.metrics import FEED_PARSE_SECONDS, timed
+from common.seen_store import get_seen_store
 
-def get_all_links_of_articles_until_lastsaved_met():
+
+logger = logging.getLogger(__name__)
+
+
+async def get_all_links_of_articles_until_lastsaved_met():
     # here the rss feed is being taken to be parsed | tutaj bierzemy rss feed do dalniejszego parsowania 
     url = "https://www.darkreading.com/rss.xml"
-    feed = feedparser.parse(url)
-    
-    article_links = []
-    for entry in feed.entries:
-        if 'link' in entry:
-            article_links.append(entry.link)
-    
+    # the feed is downloaded with the shared async client (conditionally), feedparser only parses it
+    response = await get_validator_cache().fetch(url)
+    if response.unchanged:
+        return []
+    with timed(FEED_PARSE_SECONDS):
+        feed = feedparser.parse(response.body)
+
+        article_links = []
+        for entry in feed.entries:
+            if 'link' in entry:
+                article_links.append(entry.link)
     
-    # getting the last saved link met | pobieranie ostatniego zapisanego linku
-    with open("darkreading/lastsaved_articlelink.txt", "r") as file:
-        lastsaved_articlelink = file.read()
     
-    collected_links_list = []
-    
-    for link in article_links:
-        if link == lastsaved_articlelink:
-            break
-        
-        collected_links_list.append(link)
-
-    if collected_links_list:
-        lastsaved_articlelink = collected_links_list[0]
+    # only the links never collected before are taken, wherever they are in the list | bierzemy tylko linki, ktorych jeszcze nie widzielismy
+    collected_links_list = get_seen_store().collect_new_links(
+        'darkreading',
+        article_links,
+        legacy_lastsaved_file=Path(__file__).parent / 'lastsaved_articlelink.txt',
+    )
 
-    with open("darkreading/lastsaved_articlelink.txt", "w") as file:
-        file.write(lastsaved_articlelink)
+    # the feed/page was processed fine, so next time it's skipped unless it changes
+    get_validator_cache().commit(response)
 
     for link in collected_links_list:
         print(link)
@@ -37,7 +46,15 @@ def get_all_links_of_articles_until_lastsaved_met():
 
 
 
+async def _run_standalone():
+    try:
+        return await get_all_links_of_articles_until_lastsaved_met()
+    finally:
+        await close_session()
+
+
 if __name__ == "__main__":
-    get_all_links_of_articles_until_lastsaved_met()
+    setup_logging()
+    asyncio.run(_run_standalone())
 
 
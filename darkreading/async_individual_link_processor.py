@@ -1,87 +1,126 @@
 from pprint import pprint
-from bs4 import BeautifulSoup
 import asyncio
-import random
-from playwright.async_api import async_playwright, expect, Playwright
 from playwright_stealth import stealth_async, StealthConfig
 import logging
 from datetime import datetime
 
+from common.browser_pool import BrowserProfile, RoutePolicy, get_browser_pool, close_browser_pool
+from common.cloudflare_clearance import get_clearance_manager
+from common.html_cache import cache_html, cached_html
+from common.http_client import MAX_CONNECTIONS_PER_HOST
+from common.logging_setup import setup_logging
+from common.parsing import Selectors, parse_document
+from common.politeness import get_politeness_scheduler
+from common.pipeline import ListSink, run_pipeline
+from common.settings import DATA_DIR
+from common.storage import is_article
+from common.tiered_fetch import TieredFetcher
+from common.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+
+# name of the source in the article store and the html cache
+SOURCE = 'darkreading'
+
+# max concurrent browser renders - it used to be 1 (with a 30-40 s sleep after every article) because every article solved cloudflare's check from scratch,
+# now the check is solved once in the persistent context and the clearance is reused, most articles don't even need the browser
+SEMAPHORE_LIMIT = 2
+
+# compiled once at import instead of on every article
+SELECTORS = Selectors(
+    creation_date='p[data-testid="contributors-date"]',
+    article_title='span[data-testid="article-title"]',
+    article_header_summary='p[data-testid="article-summary"]',
+    article_base='div[data-module="content"]',
+)
+
+
+async def render_article(url):
+    """Render the article in a leased browser page and return its html, None if it didn't load"""
+    # a page rendered recently enough is taken from the html cache, no browser needed
+    cached = await cached_html(url)
+    if cached is not None:
+        return cached
+    # the host's token bucket decides the pace (it used to be a fixed sleep after every article), the page is leased only once it's our turn
+    await get_politeness_scheduler().wait(url)
+    async with get_browser_pool().lease_page(BROWSER_PROFILE) as page:
+        try:
+            # no need to wait for the load event (or for anything to scroll into view), the title being in the dom is enough
+            with span('goto'):
+                await page.goto(url, wait_until='domcontentloaded')
+            with span('wait_for_selector'):
+                await page.locator('span[data-testid="article-title"]').wait_for(state='attached')
+            # the page got through cloudflare, its clearance lets the next articles go over plain http
+            with span('clearance_harvest'):
+                await get_clearance_manager().harvest(page, url)
+
+            # Get the page content
+            with span('page_content'):
+                content = await page.content()
+            await cache_html(SOURCE, url, content)
+            return content
+        except Exception as e:
+            logger.error(f"Error processing {url}: {str(e)}")
+            return None
 
-# THIS IS CONST VALUE DON'T TOUCH IT OR YOU WILL BREAK IT AAARRGH!!!!!!    I'll leave it this way for better days, when I'll be able to find faster concurrent solution while bypassing cloudflare at the same time on their page. For now, this configuration works, and SINCE IT WORKS -> dont touch it. Thank you love you. You absolutely can experiment with it by yourself, just remember this setup to be able to go back to working version after you fail (or maybe not, who knows please dont beat me up alright buddy I'll call the mossad for the help)
-SEMAPHORE_LIMIT = 1
 
+def parse_article(url, content):
+    """Extract the article out of the rendered html"""
+    tree = parse_document(content)
 
-async def process_article(url, semaphore, list_of_processed_articles):
-    async with semaphore: 
-        async with async_playwright() as p:
-            browser, context = await setup_browser_context(p)
-            page = await context.new_page()
-            await stealth_async(page)  
-            
-            try:
-                await page.goto(url)
+    
+    # Here you can add your specific parsing logic
+    # For example:
+    creation_date = SELECTORS.text('creation_date', tree)
+    article_title = SELECTORS.text('article_title', tree)
+    article_header_summary = SELECTORS.text('article_header_summary', tree)
+    article_base = SELECTORS.text('article_base', tree)
+    article_text = article_header_summary + '\n' + article_base
 
-                await expect(page.locator('span[data-testid="article-title"]')).to_be_in_viewport()
-                
-                # Get the page content
-                content = await page.content()
-                soup = BeautifulSoup(content, 'html.parser')
-
-                
-                # Here you can add your specific parsing logic
-                # For example:
-                creation_date = soup.select_one('p[data-testid="contributors-date"]').text.strip()
-                article_title = soup.select_one('span[data-testid="article-title"]').text.strip()
-                article_header_summary = soup.select_one('p[data-testid="article-summary"]').text.strip()
-                article_base = soup.select_one('div[data-module="content"]').text.strip()
-                article_text = article_header_summary + '\n' + article_base
-
-                article_dict_to_append = {
-                    'fetchingDate': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), # date of when WE fetched it
-                    'creationDate': creation_date, # date of when the article was published on the source page
-                    'author': 'Dark Reading',
-                    'authorLink': 'https://www.darkreading.com',
-                    'articleLink': url,
-                    'articleTitle': article_title,
-                    'articleText': article_text,
-                }
-
-                # debug
-                print(article_dict_to_append)
-
-                list_of_processed_articles.append(article_dict_to_append)
-            except Exception as e:
-                logging.error(f"Error processing {url}: {str(e)}")
-                return None
-            finally:
-                await browser.close()
-                await asyncio.sleep(random.uniform(30, 40))
-            
+    article_dict_to_append = {
+        'fetchingDate': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), # date of when WE fetched it
+        'creationDate': creation_date, # date of when the article was published on the source page
+        'author': 'Dark Reading',
+        'authorLink': 'https://www.darkreading.com',
+        'articleLink': url,
+        'articleTitle': article_title,
+        'articleText': article_text,
+    }
+
+    logger.debug(f"Parsed {url}: '{article_title}' ({creation_date}), {len(article_text)} chars of text")
+
+    return article_dict_to_append
+
+
+# most article pages are served complete to a plain GET, the browser is only the fallback for challenges and js-only pages
+TIERED_FETCHER = TieredFetcher(
+    SOURCE,
+    render=render_article,
+    is_complete=lambda html: SELECTORS.one('article_title', parse_document(html)) is not None,
+    browser_concurrency=SEMAPHORE_LIMIT,
+    use_clearance=True,
+)
+
+
+async def stream_articles(links, sink):
+    """Fetch (plain http first, the browser only if needed), parse and hand every article to the sink as soon as it's done"""
+    # the semaphore limit now only applies to the pages that have to be rendered, the plain http ones are paced by the politeness scheduler
+    return await run_pipeline(links, fetch=TIERED_FETCHER.fetch, parse=parse_article, sink=sink, fetch_workers=MAX_CONNECTIONS_PER_HOST, parse_workers=1)
 
 
 async def process_articles(links):
-    semaphore = asyncio.Semaphore(SEMAPHORE_LIMIT)
-    
-    async with async_playwright() as p:
-        browser, context = await setup_browser_context(p)
-        tasks = []
-        list_of_processed_articles = []
-        
-        for link in links:
-            task = asyncio.create_task(process_article(link, semaphore, list_of_processed_articles))
-            tasks.append(task)
-        
-        await asyncio.gather(*tasks, return_exceptions=True)
-        await browser.close()
-        return list_of_processed_articles
+    sink = ListSink()
+    await stream_articles(links, sink)
+    return [result for result in sink.results if is_article(result)]
     
 
-async def setup_browser_context(playwright: Playwright):
-    browser = await playwright.chromium.launch(
+BROWSER_PROFILE = BrowserProfile(
+    name='darkreading',
+    launch_options=dict(
         headless=True,
         channel='chrome',
-        slow_mo=750,
         # if we'd ever need to use proxy -> uncomment below
         # proxy={
         #     "server": f"http://{proxy_dict['proxyaddr']}:{proxy_dict['proxyport']}",
@@ -99,23 +138,21 @@ async def setup_browser_context(playwright: Playwright):
             '--disable-infobars',
             '--disable-notifications',
             '--disable-popup-blocking',
-        ]
-    )
-
-    context = await browser.new_context(
+        ],
+    ),
+    context_options=dict(
         locale='en-US',
         user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         no_viewport=True,  
         ignore_https_errors=True,  
-    )
-
-    # some selenium-like features
-    await context.add_init_script("""
+    ),
+    init_scripts=[
+        # some selenium-like features
+        """
         delete window.__proto__.webdriver;
-    """)
-
-    # Disable `navigator.webdriver` (mimic undetectable-chromedriver behavior) (sometimes it helps, don't really mind why?? please, i dont know why as well im not that autistic, and since in this case it helped, as the proud true OG programmer-engineer, please, i beg you, dont touch it alright. thank you darling my love)
-    await context.add_init_script("""
+        """,
+        # Disable `navigator.webdriver` (mimic undetectable-chromedriver behavior) (sometimes it helps, don't really mind why?? please, i dont know why as well im not that autistic, and since in this case it helped, as the proud true OG programmer-engineer, please, i beg you, dont touch it alright. thank you darling my love)
+        """
         Object.defineProperty(navigator, 'webdriver', {
             get: () => false,
         });
@@ -131,9 +168,14 @@ async def setup_browser_context(playwright: Playwright):
                 query: Promise.resolve({ state: 'granted' })
             }),
         });
-    """)
-
-    return browser, context
+        """,
+    ],
+    page_setup=stealth_async,
+    # one long lived context, so the cloudflare clearance (and the rest of the cookies) survive between articles and runs
+    persistent_dir=DATA_DIR / 'browser_profiles' / 'darkreading',
+    # no images, fonts, css, ads or trackers - only the html and the scripts (cloudflare's included) are loaded
+    route_policy=RoutePolicy(),
+)
 
 
 def test_article():
@@ -146,8 +188,14 @@ def test_article():
         'https://www.darkreading.com/cyberattacks-data-breaches/bumblebee-malware-trojanized-vmware-utility'
     ]
     
+    async def _run():
+        try:
+            return await process_articles(links)
+        finally:
+            await close_browser_pool()
+
     # Run the async function
-    results = asyncio.run(process_articles(links))
+    results = asyncio.run(_run())
     
     # Print results
     for result in results:
@@ -155,4 +203,5 @@ def test_article():
             pprint(result)
 
 if __name__ == "__main__":
+    setup_logging()
     test_article()
\ No newline at end of file
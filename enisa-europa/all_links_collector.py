@@ -1,55 +1,18 @@
-import requests
-from bs4 import BeautifulSoup
-import functools
-import time
-
-
-# ---LOGGER SETUP ------------------------------------------------------------
+import aiohttp
+import asyncio
 import logging
+from pathlib import Path
 
-logging.basicConfig(
-    level=logging.DEBUG,  # Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-    format='%(asctime)s - %(levelname)s - %(message)s',  # Log message format
-    handlers=[
-        logging.FileHandler("app.log", encoding='utf-8'),  # Write logs to a file
-        logging.StreamHandler()  # Print logs to the console
-    ]
-)
-
-logger = logging.getLogger(__name__)
-# -----------------------------------------------------------------------------
+from common.conditional_get import get_validator_cache
+from common.http_client import close_session
+from common.logging_setup import setup_logging
+from common.metrics import FEED_PARSE_SECONDS, timed
+from common.parsing import Selectors, parse_document
+from common.retry import async_retry
+from common.seen_store import get_seen_store
 
 
-# ---RETRY DECORATOR ----------------------------------------------------------
-def retry(exceptions=(Exception,), max_attempts=2, delay=1):
-    """
-    Retry decorator that retries the decorated function only when specific exceptions occur.
-    
-    Args:
-        exceptions: Tuple of exception classes that should trigger retry
-        max_attempts: Maximum number of retry attempts
-        delay: Delay between retries in seconds
-    """
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            attempts = 0
-            while attempts <= max_attempts:
-                try:
-                    return func(*args, **kwargs)
-                except exceptions as e:
-                    attempts += 1
-                    if attempts > max_attempts:
-                        logger.error(f"Failed after {max_attempts} attempts: {e}")
-                        raise
-                    logger.warning(f"Attempt {attempts} failed with {e.__class__.__name__}: {e}. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                except Exception as e:
-                    # For any other exceptions, don't retry
-                    logger.error(f"Failed with non-retryable exception: {e}")
-                    raise
-        return wrapper
-    return decorator
+logger = logging.getLogger(__name__)
 
 
 # custom exception
@@ -58,39 +21,35 @@ class AbsentAnchorElementException(Exception):
 
 
 
-# MAIN FUNCTION 
-@retry(exceptions=(AbsentAnchorElementException,), max_attempts=2, delay=1)
-def get_all_links_of_articles_until_lastsaved_met():
-    # here using simple requests is sufficient 
-    url = "https://www.enisa.europa.eu/news"
-    
-    # fetching the the content
+# compiled once at import instead of on every run
+SELECTORS = Selectors(
+    articles_container='body > main > section > div:nth-child(1) > div > div.flex.w-full.flex-col.gap-size-09',
+    article='div.flex.flex-col',
+    link='a',
+)
 
-    try:
-        response = requests.get(url)
-    except requests.RequestException as e:
-        logger.error(f"Request failed: {e}")
-        raise
-    logger.debug("Page loaded successfully, proceeding to parse HTML content.")
 
-    soup = BeautifulSoup(html_content, "html.parser")
+@timed(FEED_PARSE_SECONDS)
+def extract_article_links(html):
+    """Pull the article links out of the html of the news list"""
+    tree = parse_document(html)
 
     logger.debug("HTML content parsed successfully.")
 
     unfiltered_article_links = []
 
-    articles_container = soup.select_one('body > main > section > div:nth-child(1) > div > div.flex.w-full.flex-col.gap-size-09')    # XPath is not the best choice, but I can't see an option to locate it by other means for now, so I'll leave it as it is for now
+    articles_container = SELECTORS.required('articles_container', tree)    # XPath is not the best choice, but I can't see an option to locate it by other means for now, so I'll leave it as it is for now
 
     logger.debug(f"Articles container found: {articles_container is not None}")
 
-    articles = articles_container.select('div.flex.flex-col')
+    articles = SELECTORS.all('article', articles_container)
 
     logger.debug(f"Number of articles found: {len(articles)}")
     
     for article in articles:
-        link_element = article.select_one('a')
+        link_element = SELECTORS.one('link', article)
         logger.debug(f"Link element found: {link_element is not None}")
-        if link_element:
+        if link_element is not None:
             link = link_element.get('href')
             unfiltered_article_links.append(link)
         else:
@@ -105,29 +64,40 @@ def get_all_links_of_articles_until_lastsaved_met():
             if full_link not in article_links:
                 article_links.append(full_link)
 
+    return article_links
 
+
+# MAIN FUNCTION 
+@async_retry(exceptions=(AbsentAnchorElementException,), max_attempts=2, delay=1)
+async def get_all_links_of_articles_until_lastsaved_met():
+    # here a plain http request is sufficient 
+    url = "https://www.enisa.europa.eu/news"
     
-    # getting the last saved link met | pobieranie ostatniego zapisanego linku
-    with open("nask/lastsaved_articlelink.txt", "r") as file:
-        lastsaved_articlelink = file.read()
-    
-    collected_links_list = []
-    
-    for link in article_links:
-        if link == lastsaved_articlelink:
-            break
-        
-        collected_links_list.append(link)
+    # fetching the the content
 
-    if collected_links_list:
-        lastsaved_articlelink = collected_links_list[0]
+    try:
+        response = await get_validator_cache().fetch(url)
+    except aiohttp.ClientError as e:
+        logger.error(f"Request failed: {e}")
+        raise
+    if response.unchanged:
+        return []
+    logger.debug("Page loaded successfully, proceeding to parse HTML content.")
+
+    article_links = extract_article_links(response.text())
+
+    # only the links never collected before are taken, wherever they are in the list | bierzemy tylko linki, ktorych jeszcze nie widzielismy
+    collected_links_list = get_seen_store().collect_new_links(
+        'enisa-europa',
+        article_links,
+        legacy_lastsaved_file=Path(__file__).parent / 'lastsaved_articlelink.txt',
+    )
 
-    with open("enisa-europa/lastsaved_articlelink.txt", "w") as file:
-        file.write(lastsaved_articlelink)
+    # the feed/page was processed fine, so next time it's skipped unless it changes
+    get_validator_cache().commit(response)
 
     for link in collected_links_list:
         print(link)
-        time.sleep(0.5)
 
     return collected_links_list
 
@@ -136,7 +106,15 @@ def get_all_links_of_articles_until_lastsaved_met():
 
 
 
+async def _run_standalone():
+    try:
+        return await get_all_links_of_articles_until_lastsaved_met()
+    finally:
+        await close_session()
+
+
 if __name__ == "__main__":
-    get_all_links_of_articles_until_lastsaved_met()
+    setup_logging()
+    asyncio.run(_run_standalone())
 
 
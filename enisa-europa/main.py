@@ -1,29 +1,38 @@
 from . import all_links_collector
 from . import async_individual_link_processor
-import csv
 import asyncio
 
+from common.html_cache import reparse_from_cache
+from common.logging_setup import setup_logging
+from common.pipeline import ArticleSink
+
 
 async def main():
-    collected_links_list = all_links_collector.get_all_links_of_articles_until_lastsaved_met()
-    final_list = await async_individual_link_processor.process_links_async(collected_links_list)
-    
-    # saving into the csv for now since we don't have a database yet
-    # TODO: save into the database as a superstructure to the existing logic with saving to the csv
-
-    csv_file = "output.csv"
-
-    if final_list:
-        with open(csv_file, mode='a', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=final_list[0].keys())
-            writer.writeheader()
-            for data in final_list:
-                print(f'row data: {data}')
-                writer.writerow(data)
-    else:
+    collected_links_list = await all_links_collector.get_all_links_of_articles_until_lastsaved_met()
+    # every article is saved into the database (and the csv export) as soon as it's parsed
+    sink = ArticleSink('enisa-europa')
+    processor = async_individual_link_processor.AsyncLinkProcessor()
+    await processor.stream_links(collected_links_list, sink)
+
+    if not sink.saved:
         print("No data to save")
+    # the links this sweep found new, the daemon learns the publishing rate of the source from them
+    return {'new_links': len(collected_links_list), 'articles': sink.saved}
+
+
+async def reparse():
+    """Extract the articles again out of every cached page, without any request (e.g. after a selector fix)"""
+    sink = ArticleSink('enisa-europa', csv_export=False)
+    stats = await reparse_from_cache('enisa-europa', async_individual_link_processor.AsyncLinkProcessor().parse_html, sink)
+    print(f"Reparsed {stats['urls']} cached pages, {sink.saved} articles saved")
+
+
+# no `backfill()` on purpose: the link extractor still carries nask's selectors and finds nothing on enisa's pages,
+# a backfill would only walk the whole archive for nothing - the orchestrator reports the source as unsupported
+
 
 
 if __name__ == "__main__":
+    setup_logging()
     asyncio.run(main())
 
@@ -1,10 +1,94 @@
-from thehackernews import main as thehackernews_main
-from thecyberwire import main as thecyberwire_main
-from darkreading import main as darkreading_main
+import argparse
 import asyncio
+import logging
+import os
+from datetime import datetime
 
+import daemon
+import orchestrator
+from common.logging_setup import setup_logging
+from common.metrics import write_metrics_file
 
-asyncio.run(darkreading_main.main())
 
+logger = logging.getLogger(__name__)
 
 
+def page_range(text):
+    """'A-B' (or a single page 'A') into (A, B)"""
+    first, _, last = text.partition('-')
+    try:
+        first_page, last_page = int(first), int(last or first)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a page range like 1-500, got '{text}'")
+    if not 1 <= first_page <= last_page:
+        raise argparse.ArgumentTypeError(f"invalid page range '{text}'")
+    return first_page, last_page
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the scrapers of all sources together in a single process")
+    parser.add_argument(
+        '--sources',
+        nargs='+',
+        choices=list(orchestrator.SOURCES),
+        default=list(orchestrator.SOURCES),
+        help="sources to sweep (all of them by default)",
+    )
+    parser.add_argument(
+        '--reparse-from-cache',
+        action='store_true',
+        help="don't fetch anything, extract the articles again out of the pages in the html cache",
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help="stay resident and sweep every source on its own interval (instead of one sweep per cron tick)",
+    )
+    parser.add_argument(
+        '--backfill',
+        action='store_true',
+        help="walk the archive pages of the sources (the ones that have one) instead of sweeping the newest articles",
+    )
+    parser.add_argument(
+        '--pages',
+        type=page_range,
+        default=(1, 1000),
+        help="archive pages to backfill, e.g. 1-500 (default: 1-1000, the walk stops at the end of the archive anyway)",
+    )
+    parser.add_argument(
+        '--since',
+        type=lambda text: datetime.strptime(text, '%Y-%m-%d'),
+        default=None,
+        help="backfill only back to this date (YYYY-MM-DD)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # one queue fed log for the whole process, written by a background thread so the event loop never waits on it
+    setup_logging()
+
+    if args.daemon:
+        asyncio.run(daemon.run_daemon(args.sources))
+        return
+
+    backfill = None
+    if args.backfill:
+        backfill = {'first_page': args.pages[0], 'last_page': args.pages[1], 'since': args.since}
+        # a backfill is bulk work, the regular sweeps on this machine get the cpu first (windows has no niceness)
+        if hasattr(os, 'nice'):
+            try:
+                os.nice(10)
+            except OSError as e:
+                logger.warning(f"Couldn't lower the priority of the backfill: {e}")
+
+    results = asyncio.run(orchestrator.run_all(args.sources, reparse=args.reparse_from_cache, backfill=backfill))
+    # a one-shot run has no endpoint to scrape, its metrics are left for the node exporter's textfile collector
+    write_metrics_file()
+    for result in results:
+        print(f"{result['source']}: {result['status']} ({result['elapsed']:.1f}s)" + (f" - {result['error']}" if result['error'] else ''))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,17 @@
-import requests
-from bs4 import BeautifulSoup
-import functools
-import time
-from playwright.sync_api import sync_playwright
-
-
-# ---LOGGER SETUP ------------------------------------------------------------
+import asyncio
 import logging
+from pathlib import Path
 
-logging.basicConfig(
-    level=logging.DEBUG,  # Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-    format='%(asctime)s - %(levelname)s - %(message)s',  # Log message format
-    handlers=[
-        logging.FileHandler("app.log", encoding='utf-8'),  # Write logs to a file
-        logging.StreamHandler()  # Print logs to the console
-    ]
-)
+from common.browser_pool import BrowserProfile, get_browser_pool, close_browser_pool
+from common.logging_setup import setup_logging
+from common.metrics import COLLECTOR_FETCH_SECONDS, FEED_PARSE_SECONDS, outcome_of, timed
+from common.parsing import Selectors, parse_document
+from common.politeness import get_politeness_scheduler
+from common.retry import async_retry
+from common.seen_store import get_seen_store
 
-logger = logging.getLogger(__name__)
-# -----------------------------------------------------------------------------
 
-
-# ---RETRY DECORATOR ----------------------------------------------------------
-def retry(exceptions=(Exception,), max_attempts=2, delay=1):
-    """
-    Retry decorator that retries the decorated function only when specific exceptions occur.
-    
-    Args:
-        exceptions: Tuple of exception classes that should trigger retry
-        max_attempts: Maximum number of retry attempts
-        delay: Delay between retries in seconds
-    """
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            attempts = 0
-            while attempts <= max_attempts:
-                try:
-                    return func(*args, **kwargs)
-                except exceptions as e:
-                    attempts += 1
-                    if attempts > max_attempts:
-                        logger.error(f"Failed after {max_attempts} attempts: {e}")
-                        raise
-                    logger.warning(f"Attempt {attempts} failed with {e.__class__.__name__}: {e}. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                except Exception as e:
-                    # For any other exceptions, don't retry
-                    logger.error(f"Failed with non-retryable exception: {e}")
-                    raise
-        return wrapper
-    return decorator
+logger = logging.getLogger(__name__)
 
 
 # custom exception
@@ -59,45 +20,35 @@ class AbsentAnchorElementException(Exception):
 
 
 
-# MAIN FUNCTION 
-@retry(exceptions=(AbsentAnchorElementException,), max_attempts=2, delay=1)
-def get_all_links_of_articles_until_lastsaved_met():
-    # here using simple requests is sufficient 
-    url = "https://nask.pl/aktualnosci"
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False)
-        context = browser.new_context()
-        page = context.new_page()
-        try:
-            page.goto(url)
-            page.wait_for_load_state("networkidle")
-        except Exception as e:
-            logger.critical(f"Failed to load page {url}: {e}")
-            raise AbsentAnchorElementException(f"Failed to load page {url}: {e}") from e
-
-        html_content = page.content()
-        browser.close()
+# compiled once at import instead of on every run
+SELECTORS = Selectors(
+    articles_container='body > main > section > div:nth-child(1) > div > div.flex.w-full.flex-col.gap-size-09',
+    article='div.flex.flex-col',
+    link='a',
+)
 
-    logger.debug("Page loaded successfully, proceeding to parse HTML content.")
 
-    soup = BeautifulSoup(html_content, "html.parser")
+@timed(FEED_PARSE_SECONDS)
+def extract_article_links(html):
+    """Pull the article links out of the html of the news list"""
+    tree = parse_document(html)
 
     logger.debug("HTML content parsed successfully.")
 
     unfiltered_article_links = []
 
-    articles_container = soup.select_one('body > main > section > div:nth-child(1) > div > div.flex.w-full.flex-col.gap-size-09')    # XPath is not the best choice, but I can't see an option to locate it by other means for now, so I'll leave it as it is for now
+    articles_container = SELECTORS.required('articles_container', tree)    # XPath is not the best choice, but I can't see an option to locate it by other means for now, so I'll leave it as it is for now
 
     logger.debug(f"Articles container found: {articles_container is not None}")
 
-    articles = articles_container.select('div.flex.flex-col')
+    articles = SELECTORS.all('article', articles_container)
 
     logger.debug(f"Number of articles found: {len(articles)}")
     
     for article in articles:
-        link_element = article.select_one('a')
+        link_element = SELECTORS.one('link', article)
         logger.debug(f"Link element found: {link_element is not None}")
-        if link_element:
+        if link_element is not None:
             link = link_element.get('href')
             unfiltered_article_links.append(link)
         else:
@@ -112,29 +63,63 @@ def get_all_links_of_articles_until_lastsaved_met():
             if full_link not in article_links:
                 article_links.append(full_link)
 
+    return article_links
 
-    
-    # getting the last saved link met | pobieranie ostatniego zapisanego linku
-    with open("nask/lastsaved_articlelink.txt", "r") as file:
-        lastsaved_articlelink = file.read()
-    
-    collected_links_list = []
-    
-    for link in article_links:
-        if link == lastsaved_articlelink:
-            break
-        
-        collected_links_list.append(link)
 
-    if collected_links_list:
-        lastsaved_articlelink = collected_links_list[0]
+# the list of news is rendered by js, so the page is leased from the shared browser pool
+BROWSER_PROFILE = BrowserProfile(
+    name='nask',
+    launch_options=dict(headless=True),
+)
+
+
+def archive_page_url(page: int) -> str:
+    return "https://nask.pl/aktualnosci" if page == 1 else f"https://nask.pl/aktualnosci?page={page}"
+
+
+async def get_archive_page_links(page: int):
+    """Article links of one archive page (page 1 is the newest one), empty past the end of the archive"""
+    url = archive_page_url(page)
+    await get_politeness_scheduler().wait(url)
+    async with get_browser_pool().lease_page(BROWSER_PROFILE) as browser_page:
+        response = await browser_page.goto(url)
+        if response is not None and response.status in (404, 410):
+            return []
+        await browser_page.wait_for_load_state("networkidle")
+        html_content = await browser_page.content()
+    return extract_article_links(html_content)
+
+
+# MAIN FUNCTION 
+@async_retry(exceptions=(AbsentAnchorElementException,), max_attempts=2, delay=1)
+async def get_all_links_of_articles_until_lastsaved_met():
+    url = "https://nask.pl/aktualnosci"
+    await get_politeness_scheduler().wait(url)
+    async with get_browser_pool().lease_page(BROWSER_PROFILE) as page:
+        with timed(COLLECTOR_FETCH_SECONDS) as stage:
+            try:
+                await page.goto(url)
+                await page.wait_for_load_state("networkidle")
+            except Exception as e:
+                logger.critical(f"Failed to load page {url}: {e}")
+                stage.outcome = outcome_of(e)
+                raise AbsentAnchorElementException(f"Failed to load page {url}: {e}") from e
+
+            html_content = await page.content()
+
+    logger.debug("Page loaded successfully, proceeding to parse HTML content.")
 
-    with open("sekurak/lastsaved_articlelink.txt", "w") as file:
-        file.write(lastsaved_articlelink)
+    article_links = extract_article_links(html_content)
+
+    # only the links never collected before are taken, wherever they are in the list | bierzemy tylko linki, ktorych jeszcze nie widzielismy
+    collected_links_list = get_seen_store().collect_new_links(
+        'nask',
+        article_links,
+        legacy_lastsaved_file=Path(__file__).parent / 'lastsaved_articlelink.txt',
+    )
 
     for link in collected_links_list:
         print(link)
-        time.sleep(0.5)
 
     return collected_links_list
 
@@ -143,7 +128,15 @@ def get_all_links_of_articles_until_lastsaved_met():
 
 
 
+async def _run_standalone():
+    try:
+        return await get_all_links_of_articles_until_lastsaved_met()
+    finally:
+        await close_browser_pool()
+
+
 if __name__ == "__main__":
-    get_all_links_of_articles_until_lastsaved_met()
+    setup_logging()
+    asyncio.run(_run_standalone())
 
 
@@ -2,22 +2,23 @@ import aiohttp
 import asyncio
 import random
 import logging
-from typing import List, Dict, Optional, Any
-from bs4 import BeautifulSoup
+from typing import Iterable, List, Dict, Optional, Any
 from datetime import datetime
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(lineno)d - %(message)s',
-    handlers=[
-        logging.FileHandler("processor.log", encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+from common.html_cache import cache_html, cached_html
+from common.http_client import get_session, close_session, MAX_CONNECTIONS_PER_HOST
+from common.logging_setup import setup_logging
+from common.metrics import ARTICLE_FETCH_SECONDS, RETRIES, timed
+from common.parsing import Selectors, parse_document
+from common.pipeline import ListSink, run_pipeline
+from common.politeness import get_politeness_scheduler
+from common.tracing import span
 
 logger = logging.getLogger(__name__)
 
+# name of the source in the article store and the html cache
+SOURCE = 'nask'
+
 # User agents list for rotation
 USER_AGENTS = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -26,6 +27,15 @@ USER_AGENTS = [
     'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Mobile/15E148 Safari/604.1'
 ]
 
+# compiled once at import instead of on every page (the tailwind ones are long)
+SELECTORS = Selectors(
+    creation_date='span.text-tiny.text-theme-text-secondary.md\\:text-small:nth-child(1)',
+    article_title='h1.mb-size-04.text-h2.text-theme-text',
+    article_pretext='p.text-medium.text-theme-text-secondary',
+    article_maintext='div.inner-post',
+)
+
+
 class AsyncLinkProcessor:
     def __init__(self, 
                  proxy: Optional[str] = None, 
@@ -38,27 +48,36 @@ class AsyncLinkProcessor:
         self.timeout = timeout
         self.max_retries = max_retries
         self.retry_delay = retry_delay
+        # picked once per processor, so all requests of a run look like they come from the same browser
+        self.headers = {}
+        if self.use_random_user_agent:
+            self.headers['User-Agent'] = random.choice(USER_AGENTS)
         
     async def _get_session(self) -> aiohttp.ClientSession:
-        """Create and return an aiohttp session with configured options"""
-        headers = {}
-        if self.use_random_user_agent:
-            headers['User-Agent'] = random.choice(USER_AGENTS)
-            
-        return aiohttp.ClientSession(
-            headers=headers,
-            timeout=aiohttp.ClientTimeout(total=self.timeout)
-        )
+        """Return the process wide pooled session (it's shared, so it must not be closed here)"""
+        return await get_session()
     
     async def fetch_url(self, url: str, session: aiohttp.ClientSession) -> Optional[str]:
-        """Fetch a URL with retries"""
+        """Fetch a URL with retries, a fresh copy from the html cache is returned without any request"""
+        cached = await cached_html(url)
+        if cached is not None:
+            return cached
         for attempt in range(self.max_retries):
+            if attempt:
+                RETRIES.inc(source=SOURCE, stage='article_fetch')
             try:
                 proxy = self.proxy
-                async with session.get(url, proxy=proxy) as response:
-                    if response.status == 200:
-                        return await response.text()
-                    logger.warning(f"Received status code {response.status} for {url}")
+                # the pace per host is up to the shared scheduler, not to the number of workers
+                await get_politeness_scheduler().wait(url)
+                with timed(ARTICLE_FETCH_SECONDS, tier='http') as stage, span('http_get', attempt=attempt + 1) as attributes:
+                    async with session.get(url, proxy=proxy, headers=self.headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                        attributes['status'] = response.status
+                        if response.status == 200:
+                            html = await response.text()
+                            await cache_html(SOURCE, url, html)
+                            return html
+                        stage.outcome = attributes['outcome'] = 'non_200'
+                        logger.warning(f"Received status code {response.status} for {url}")
                     
             except asyncio.TimeoutError:
                 logger.warning(f"Timeout fetching {url} (attempt {attempt+1}/{self.max_retries})")
@@ -66,30 +85,34 @@ class AsyncLinkProcessor:
                 logger.error(f"Error fetching {url}: {str(e)} (attempt {attempt+1}/{self.max_retries})")
                 
             if attempt < self.max_retries - 1:
-                await asyncio.sleep(self.retry_delay)
+                with span('retry_sleep'):
+                    await asyncio.sleep(self.retry_delay)
                 
         return None
     
     async def process_link(self, url: str, session: aiohttp.ClientSession) -> Dict[str, Any]:
         """Process a single link and return the results"""
-        html = await self.fetch_url(url, session)
-        if not html:
-            return {"url": url, "success": False, "error": "Failed to fetch content"}
-        
-        logger.info('Successfully fetched content, processing HTML...')
-            
+        # the standalone path, the pipeline times the fetch and the parse as phases of their own
+        with span('process_link', url=url):
+            html = await self.fetch_url(url, session)
+            if not html:
+                return {"url": url, "success": False, "error": "Failed to fetch content"}
+
+            logger.info('Successfully fetched content, processing HTML...')
+
+            return self.parse_html(url, html)
+
+    def parse_html(self, url: str, html: str) -> Any:
+        """Extract the article(s) out of a fetched page, a failure dict is returned if the page doesn't look as expected"""
         # Parsing the content
         try:
-            soup = BeautifulSoup(html, 'html.parser')
-
-            creation_date = soup.select_one('span.text-tiny.text-theme-text-secondary.md\\:text-small:nth-child(1)').text.strip()
-            print(creation_date)
-            article_title = soup.select_one('h1.mb-size-04.text-h2.text-theme-text').text.strip()
-            print(article_title)
-            article_pretext = soup.select_one('p.text-medium.text-theme-text-secondary').text.strip()
-            print(article_pretext)
-            article_maintext = soup.select_one('div.inner-post').text.strip()
-            print(article_maintext)
+            tree = parse_document(html)
+
+            creation_date = SELECTORS.text('creation_date', tree)
+            article_title = SELECTORS.text('article_title', tree)
+            article_pretext = SELECTORS.text('article_pretext', tree)
+            article_maintext = SELECTORS.text('article_maintext', tree)
+            logger.debug(f"Parsed {url}: '{article_title}' ({creation_date}), {len(article_pretext) + len(article_maintext)} chars of text")
             article_text = article_pretext + "\n\n" + article_maintext
 
 
@@ -113,19 +136,22 @@ class AsyncLinkProcessor:
             logger.exception(f"Error processing {url}: {str(e), }")
             return {"url": url, "success": False, "error": str(e)}
     
-    async def process_links(self, urls: List[str], max_concurrent: int = 3) -> List[Dict[str, Any]]:  # you can change the max_concurrent to any number you want here
+    async def stream_links(self, urls: Iterable[str], sink: Any, max_concurrent: int = MAX_CONNECTIONS_PER_HOST) -> Dict[str, int]:
+        """Stream the links through fetch -> parse -> sink stages, every result reaches the sink as soon as it's parsed"""
+        session = await self._get_session()
+        return await run_pipeline(
+            urls,
+            fetch=lambda url: self.fetch_url(url, session),
+            parse=self.parse_html,
+            sink=sink,
+            fetch_workers=max_concurrent,  # This limits concurrent requests
+        )
+
+    async def process_links(self, urls: List[str], max_concurrent: int = MAX_CONNECTIONS_PER_HOST) -> List[Dict[str, Any]]:  # you can change the max_concurrent to any number you want here
         """Process multiple links concurrently with a limit on concurrent requests"""
-        results = []
-        semaphore = asyncio.Semaphore(max_concurrent)
-        
-        async def bounded_process_link(url):
-            async with semaphore:  # This limits concurrent execution
-                return await self.process_link(url, session)
-        
-        async with await self._get_session() as session:
-            tasks = [bounded_process_link(url) for url in urls]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-        return results
+        sink = ListSink()
+        await self.stream_links(urls, sink, max_concurrent=max_concurrent)
+        return sink.results
 
 # Main function to process links
 async def process_links_async(
@@ -151,14 +177,21 @@ def process_links(
     use_random_user_agent: bool = True
 ) -> List[Dict[str, Any]]:
     """Synchronous wrapper for async link processing"""
-    return asyncio.run(process_links_async(
-        urls, 
-        proxy=proxy,
-        use_random_user_agent=use_random_user_agent
-    ))
+    async def _run():
+        try:
+            return await process_links_async(
+                urls, 
+                proxy=proxy,
+                use_random_user_agent=use_random_user_agent
+            )
+        finally:
+            await close_session()
+
+    return asyncio.run(_run())
 
 # Example usage
 if __name__ == "__main__":
+    setup_logging()
     urls_to_process = [
         "https://nask.pl/aktualnosci/fakty-nie-mity-nask-i-umb-wspolnie-przeciw-dezinformacji-medycznej",
         "https://nask.pl/aktualnosci/szkoly-coraz-blizej-technologicznej-rewolucji-znamy-oferty-na-szkolne-laboratoria-przyszlosci"
@@ -0,0 +1,152 @@
+import asyncio
+import importlib
+import logging
+import time
+from typing import Dict, List, Optional, Any
+
+from common.browser_pool import close_browser_pool
+from common.dedup import assign_clusters
+from common.http_client import close_session
+from common.keyword_index import update_keyword_index
+from common.locks import overlap_lock
+from common.metrics import SWEEP_SECONDS, current_source
+from common.tiered_fetch import log_escalation_stats
+from common.tracing import flush_spans
+from common.vector_index import update_vector_index
+
+
+logger = logging.getLogger(__name__)
+
+
+# every source package exposes an async `main()` in its `main` module (and an async `reparse()` that works off the html cache)
+# the ones with a paginated archive also have an async `backfill(first_page, last_page, since)`
+# time budget is the max wall time (in seconds) one sweep of the source is allowed to take
+# darkreading gets the biggest one since it's slowed down on purpose to get through cloudflare
+# interval (+- jitter) is how often the daemon sweeps the source at first, in seconds; it then adapts the interval
+# to how often the source actually publishes, but never goes outside min_interval..max_interval
+SOURCES: Dict[str, Dict[str, Any]] = {
+    'darkreading': {
+        'module': 'darkreading.main', 'time_budget': 45 * 60,
+        'interval': 60 * 60, 'jitter': 5 * 60, 'min_interval': 30 * 60, 'max_interval': 6 * 60 * 60,
+    },
+    'thehackernews': {
+        'module': 'thehackernews.main', 'time_budget': 20 * 60,
+        'interval': 20 * 60, 'jitter': 2 * 60, 'min_interval': 10 * 60, 'max_interval': 3 * 60 * 60,
+    },
+    'thecyberwire': {
+        'module': 'thecyberwire.main', 'time_budget': 10 * 60,
+        'interval': 2 * 60 * 60, 'jitter': 10 * 60, 'min_interval': 60 * 60, 'max_interval': 12 * 60 * 60,
+    },
+    'sekurak': {
+        'module': 'sekurak.main', 'time_budget': 10 * 60,
+        'interval': 30 * 60, 'jitter': 3 * 60, 'min_interval': 15 * 60, 'max_interval': 6 * 60 * 60,
+    },
+    'nask': {
+        'module': 'nask.main', 'time_budget': 10 * 60,
+        'interval': 2 * 60 * 60, 'jitter': 10 * 60, 'min_interval': 60 * 60, 'max_interval': 24 * 60 * 60,
+    },
+    'enisa-europa': {
+        'module': 'enisa-europa.main', 'time_budget': 10 * 60,  # the dash in the dir name makes a plain `import` impossible
+        'interval': 2 * 60 * 60, 'jitter': 10 * 60, 'min_interval': 60 * 60, 'max_interval': 24 * 60 * 60,
+    },
+}
+
+
+async def run_source(name: str,
+                     time_budget: Optional[float] = None,
+                     reparse: bool = False,
+                     backfill: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Run one source pipeline (or its reparse from the html cache, or a backfill of its archive with the `backfill` kwargs)
+    with its own time budget, never letting its failure escape. A backfill has no time budget, it's resumable anyway.
+    A sweep of a source that's still being swept (by this process or another one, e.g. cron next to the daemon) is skipped.
+    """
+    # a backfill runs for hours next to the regular sweeps, it only excludes other backfills of the source
+    with overlap_lock(name if backfill is None else f"{name}.backfill") as acquired:
+        if not acquired:
+            logger.warning(f"[{name}] the previous sweep is still running, skipping this one")
+            return {'source': name, 'status': 'skipped', 'error': "previous sweep still running", 'elapsed': 0.0}
+        return await _run_source(name, time_budget, reparse, backfill)
+
+
+async def _run_source(name: str,
+                      time_budget: Optional[float],
+                      reparse: bool,
+                      backfill: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    source = SOURCES[name]
+    if backfill is None:
+        time_budget = time_budget if time_budget is not None else source['time_budget']
+    started = time.monotonic()
+    status = 'ok'
+    error = None
+    new_links = None
+    # every metric observed by the sweep (in all the tasks it spawns) is labelled with the source
+    source_token = current_source.set(name)
+
+    try:
+        module = importlib.import_module(source['module'])
+        if backfill is not None:
+            if not hasattr(module, 'backfill'):
+                logger.warning(f"[{name}] has no archive to backfill, skipping it")
+                return {'source': name, 'status': 'unsupported', 'error': "no backfill mode", 'elapsed': 0.0}
+            coroutine = module.backfill(**backfill)
+        else:
+            coroutine = module.reparse() if reparse else module.main()
+        outcome = await asyncio.wait_for(coroutine, timeout=time_budget)
+        # only a regular sweep reports the links it collected as new
+        if backfill is None and not reparse and isinstance(outcome, dict):
+            new_links = outcome.get('new_links')
+    except asyncio.TimeoutError:
+        status = 'timeout'
+        error = f"exceeded the time budget of {time_budget}s"
+        logger.error(f"[{name}] sweep {error}")
+    except Exception as e:
+        status = 'failed'
+        error = str(e)
+        logger.exception(f"[{name}] sweep failed: {e}")
+    finally:
+        current_source.reset(source_token)
+        flush_spans()
+
+    elapsed = time.monotonic() - started
+    SWEEP_SECONDS.observe(elapsed, source=name, status=status)
+    logger.info(f"[{name}] sweep finished with status '{status}' in {elapsed:.1f}s")
+    return {'source': name, 'status': status, 'error': error, 'elapsed': elapsed, 'new_links': new_links}
+
+
+_indexing_lock: Optional[asyncio.Lock] = None
+
+
+async def update_indexes():
+    """Bring the clusters and the search indexes up to date with the articles saved so far, one update at a time"""
+    global _indexing_lock
+    if _indexing_lock is None:
+        _indexing_lock = asyncio.Lock()
+    async with _indexing_lock:
+        # the same story from several sources ends up in one cluster, so downstream work can take each story once
+        await asyncio.to_thread(assign_clusters)
+        # only the new articles are vectorized, the index is ready for similarity search right after the sweep
+        await asyncio.to_thread(update_vector_index)
+        await asyncio.to_thread(update_keyword_index)
+
+
+async def run_all(names: Optional[List[str]] = None,
+                  reparse: bool = False,
+                  backfill: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Run the given sources (all of them by default) together on the current event loop"""
+    names = names or list(SOURCES)
+    unknown = [name for name in names if name not in SOURCES]
+    if unknown:
+        raise ValueError(f"Unknown sources: {', '.join(unknown)}")
+
+    started = time.monotonic()
+    try:
+        results = await asyncio.gather(*(run_source(name, reparse=reparse, backfill=backfill) for name in names))
+    finally:
+        # the browsers and the http session are shared by all sources, so they're only shut down once every source is done
+        log_escalation_stats()
+        await close_browser_pool()
+        await close_session()
+    await update_indexes()
+    logger.info(f"Full sweep of {len(names)} sources took {time.monotonic() - started:.1f}s")
+    return results
@@ -1,55 +1,18 @@
-import requests
-from bs4 import BeautifulSoup
-import functools
-import time
-
-
-# ---LOGGER SETUP ------------------------------------------------------------
+import asyncio
 import logging
+from pathlib import Path
 
-logging.basicConfig(
-    level=logging.DEBUG,  # Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
-    format='%(asctime)s - %(levelname)s - %(message)s',  # Log message format
-    handlers=[
-        logging.FileHandler("app.log", encoding='utf-8'),  # Write logs to a file
-        logging.StreamHandler()  # Print logs to the console
-    ]
-)
+from common.backfill import fetch_archive_page
+from common.conditional_get import get_validator_cache
+from common.http_client import close_session
+from common.logging_setup import setup_logging
+from common.metrics import FEED_PARSE_SECONDS, timed
+from common.parsing import Selectors, parse_document
+from common.retry import async_retry
+from common.seen_store import get_seen_store
 
-logger = logging.getLogger(__name__)
-# -----------------------------------------------------------------------------
 
-
-# ---RETRY DECORATOR ----------------------------------------------------------
-def retry(exceptions=(Exception,), max_attempts=2, delay=1):
-    """
-    Retry decorator that retries the decorated function only when specific exceptions occur.
-    
-    Args:
-        exceptions: Tuple of exception classes that should trigger retry
-        max_attempts: Maximum number of retry attempts
-        delay: Delay between retries in seconds
-    """
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            attempts = 0
-            while attempts <= max_attempts:
-                try:
-                    return func(*args, **kwargs)
-                except exceptions as e:
-                    attempts += 1
-                    if attempts > max_attempts:
-                        logger.error(f"Failed after {max_attempts} attempts: {e}")
-                        raise
-                    logger.warning(f"Attempt {attempts} failed with {e.__class__.__name__}: {e}. Retrying in {delay} seconds...")
-                    time.sleep(delay)
-                except Exception as e:
-                    # For any other exceptions, don't retry
-                    logger.error(f"Failed with non-retryable exception: {e}")
-                    raise
-        return wrapper
-    return decorator
+logger = logging.getLogger(__name__)
 
 
 # custom exception
@@ -57,52 +20,72 @@ class AbsentAnchorElementException(Exception):
     pass
 
 
-# MAIN FUNCTION 
-@retry(exceptions=(AbsentAnchorElementException,), max_attempts=2, delay=1)
-def get_all_links_of_articles_until_lastsaved_met():
-    # here using simple requests is sufficient 
-    url = "https://sekurak.pl"
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, "html.parser")
+# compiled once at import instead of on every run
+SELECTORS = Selectors(
+    anchor='div#content',
+    article='article.post',
+    link='h2.postTitle > a',
+)
 
 
-    anchor_element = soup.select_one('div#content')
-    if not anchor_element:
+@timed(FEED_PARSE_SECONDS)
+def extract_article_links(html):
+    """Pull the article links out of the html of an index page"""
+    tree = parse_document(html)
+
+
+    anchor_element = SELECTORS.one('anchor', tree)
+    if anchor_element is None:
         logger.critical("No anchor element found. Page isn't loaded as expected. Terminating...")
         raise AbsentAnchorElementException("No anchor element found. Page isn't loaded as expected. Terminating...")
-    else:
-        logger.info("Anchor element found. Proceeding with link extraction.")
-        logger.info(f"Anchor element content: {anchor_element.prettify()}")  # Log first 500 chars of the anchor element
+    # the anchor's markup used to be logged here, the whole front page at INFO on every run
+    logger.debug("Anchor element found. Proceeding with link extraction.")
     article_links = []
 
-    articles = soup.select('article.post')
+    articles = SELECTORS.all('article', tree)
 
 
     for article in articles:
-        link_element = article.select_one('h2.postTitle > a')
-        if link_element:
+        link_element = SELECTORS.one('link', article)
+        if link_element is not None:
             link = link_element.get('href')
             article_links.append(link)
         else:
             logger.warning(f"No link found in article")
-    
-    # getting the last saved link met | pobieranie ostatniego zapisanego linku
-    with open("sekurak/lastsaved_articlelink.txt", "r") as file:
-        lastsaved_articlelink = file.read()
-    
-    collected_links_list = []
-    
-    for link in article_links:
-        if link == lastsaved_articlelink:
-            break
-        
-        collected_links_list.append(link)
 
-    if collected_links_list:
-        lastsaved_articlelink = collected_links_list[0]
+    return article_links
+
+
+def archive_page_url(page: int) -> str:
+    # page 1 of the archive is the front page itself
+    return "https://sekurak.pl" if page == 1 else f"https://sekurak.pl/page/{page}/"
 
-    with open("sekurak/lastsaved_articlelink.txt", "w") as file:
-        file.write(lastsaved_articlelink)
+
+async def get_archive_page_links(page: int):
+    """Article links of one archive page (page 1 is the newest one), empty past the end of the archive"""
+    html = await fetch_archive_page(archive_page_url(page))
+    return extract_article_links(html) if html is not None else []
+
+
+# MAIN FUNCTION 
+@async_retry(exceptions=(AbsentAnchorElementException,), max_attempts=2, delay=1)
+async def get_all_links_of_articles_until_lastsaved_met():
+    # here a plain http request is sufficient 
+    url = "https://sekurak.pl"
+    response = await get_validator_cache().fetch(url)
+    if response.unchanged:
+        return []
+    article_links = extract_article_links(response.text())
+    
+    # only the links never collected before are taken, wherever they are in the list | bierzemy tylko linki, ktorych jeszcze nie widzielismy
+    collected_links_list = get_seen_store().collect_new_links(
+        'sekurak',
+        article_links,
+        legacy_lastsaved_file=Path(__file__).parent / 'lastsaved_articlelink.txt',
+    )
+
+    # the feed/page was processed fine, so next time it's skipped unless it changes
+    get_validator_cache().commit(response)
 
     for link in collected_links_list:
         print(link)
@@ -114,7 +97,15 @@ def get_all_links_of_articles_until_lastsaved_met():
 
 
 
+async def _run_standalone():
+    try:
+        return await get_all_links_of_articles_until_lastsaved_met()
+    finally:
+        await close_session()
+
+
 if __name__ == "__main__":
-    get_all_links_of_articles_until_lastsaved_met()
+    setup_logging()
+    asyncio.run(_run_standalone())
 
 
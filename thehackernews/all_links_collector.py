@@ -1,45 +1,52 @@
-import requests
+import asyncio
+import logging
 from bs4 import BeautifulSoup
 from lxml import etree
+from pathlib import Path
 
+from common.conditional_get import get_validator_cache
+from common.http_client import close_session
+from common.logging_setup import setup_logging
+from common.metrics import FEED_PARSE_SECONDS, timed
+from common.seen_store import get_seen_store
 
-def get_all_links_of_articles_until_lastsaved_met():
+
+logger = logging.getLogger(__name__)
+
+
+async def get_all_links_of_articles_until_lastsaved_met():
     # here the rss feed is being taken to be parsed | tutaj bierzemy rss feed do dalniejszego parsowania 
     url = "https://feeds.feedburner.com/TheHackersNews"
-    response = requests.get(url)
+    response = await get_validator_cache().fetch(url)
+    if response.unchanged:
+        return []
+    response_text = response.text()
     # parsing | parsowanie
 
     from bs4 import XMLParsedAsHTMLWarning
     import warnings
     warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
 
-    soup = BeautifulSoup(response.text, "lxml")
+    with timed(FEED_PARSE_SECONDS):
+        soup = BeautifulSoup(response_text, "lxml")
 
-    article_links = []
-    for item in soup.select('item'):
-        link_tag = item.find('link')
-        if link_tag and link_tag.next_sibling:
-            url = link_tag.next_sibling.strip()
-            article_links.append(url)
-    
+        article_links = []
+        for item in soup.select('item'):
+            link_tag = item.find('link')
+            if link_tag and link_tag.next_sibling:
+                link = link_tag.next_sibling.strip()
+                article_links.append(link)
     
-    # getting the last saved link met | pobieranie ostatniego zapisanego linku
-    with open("thehackernews/lastsaved_articlelink.txt", "r") as file:
-        lastsaved_articlelink = file.read()
     
-    collected_links_list = []
-    
-    for link in article_links:
-        if link == lastsaved_articlelink:
-            break
-        
-        collected_links_list.append(link)
-
-    if collected_links_list:
-        lastsaved_articlelink = collected_links_list[0]
+    # only the links never collected before are taken, wherever they are in the list | bierzemy tylko linki, ktorych jeszcze nie widzielismy
+    collected_links_list = get_seen_store().collect_new_links(
+        'thehackernews',
+        article_links,
+        legacy_lastsaved_file=Path(__file__).parent / 'lastsaved_articlelink.txt',
+    )
 
-    with open("thehackernews/lastsaved_articlelink.txt", "w") as file:
-        file.write(lastsaved_articlelink)
+    # the feed/page was processed fine, so next time it's skipped unless it changes
+    get_validator_cache().commit(response)
 
     for link in collected_links_list:
         print(link)
@@ -48,7 +55,15 @@ def get_all_links_of_articles_until_lastsaved_met():
 
 
 
+async def _run_standalone():
+    try:
+        return await get_all_links_of_articles_until_lastsaved_met()
+    finally:
+        await close_session()
+
+
 if __name__ == "__main__":
-    get_all_links_of_articles_until_lastsaved_met()
+    setup_logging()
+    asyncio.run(_run_standalone())
 
 
@@ -1,90 +1,125 @@
 from pprint import pprint
-from bs4 import BeautifulSoup
 import asyncio
-import random
-from playwright.async_api import async_playwright, expect, Playwright
 from playwright_stealth import stealth_async, StealthConfig
 import logging
 from datetime import datetime
 
+from common.browser_pool import BrowserProfile, RoutePolicy, get_browser_pool, close_browser_pool
+from common.html_cache import cache_html, cached_html
+from common.http_client import MAX_CONNECTIONS_PER_HOST
+from common.logging_setup import setup_logging
+from common.parsing import Selectors, parse_document
+from common.politeness import get_politeness_scheduler
+from common.pipeline import ListSink, run_pipeline
+from common.storage import is_article
+from common.tiered_fetch import TieredFetcher
+from common.tracing import span
 
-# a semaphore to set a limit to concurrent pages to be processed
-SEMAPHORE_LIMIT = 2 
+
+logger = logging.getLogger(__name__)
 
 
-async def process_article(context, url, semaphore, list_of_processed_articles):
-    async with semaphore: 
-        page = await context.new_page()
-        await stealth_async(page)  
-        
+# name of the source in the article store and the html cache
+SOURCE = 'thehackernews'
+
+# a limit of concurrent pages to be processed
+SEMAPHORE_LIMIT = 2 
+
+# compiled once at import instead of on every article
+SELECTORS = Selectors(
+    creation_date='span.author:nth-of-type(1)',
+    article_title='h1.story-title',
+    article_text='div.articlebody',
+)
+
+
+async def render_article(url):
+    """Render the article in a leased browser page and return its html, None if it didn't load"""
+    # a page rendered recently enough is taken from the html cache, no browser needed
+    cached = await cached_html(url)
+    if cached is not None:
+        return cached
+    # the host's token bucket decides the pace (it used to be a fixed sleep after every article), the page is leased only once it's our turn
+    await get_politeness_scheduler().wait(url)
+    async with get_browser_pool().lease_page(BROWSER_PROFILE) as page:
         try:
-            await page.goto(url)
+            # no need to wait for the load event (or for anything to scroll into view), the article body being in the dom is enough
+            with span('goto'):
+                await page.goto(url, wait_until='domcontentloaded')
+            with span('wait_for_selector'):
+                await page.locator('div#articlebody').wait_for(state='attached')
 
-            await expect(page.locator('div#articlebody')).to_be_in_viewport()
-            
             # Get the page content
-            content = await page.content()
-            soup = BeautifulSoup(content, 'html.parser')
+            with span('page_content'):
+                content = await page.content()
+            await cache_html(SOURCE, url, content)
+            return content
+        except Exception as e:
+            logger.error(f"Error processing {url}: {str(e)}")
+            return None
+
+
+def parse_article(url, content):
+    """Extract the article out of the rendered html"""
+    tree = parse_document(content)
             
-            # Here you can add your specific parsing logic
-            # For example:
-            creation_date = soup.select_one('span.author:nth-of-type(1)').text.strip()
-            article_title = soup.select_one('h1.story-title').text.strip()
-            article_text = soup.select_one('div.articlebody').text.strip()
+    # Here you can add your specific parsing logic
+    # For example:
+    creation_date = SELECTORS.text('creation_date', tree)
+    article_title = SELECTORS.text('article_title', tree)
+    article_text = SELECTORS.text('article_text', tree)
 
 
-            footer_markers = [
-                "Found this article interesting?",
-                "Follow us on Twitter",
-                "Follow us on LinkedIn"
-            ]
+    footer_markers = [
+        "Found this article interesting?",
+        "Follow us on Twitter",
+        "Follow us on LinkedIn"
+    ]
 
-            for marker in footer_markers:
-                if marker in article_text:
-                    article_text = article_text.split(marker)[0].strip()
-                    break
+    for marker in footer_markers:
+        if marker in article_text:
+            article_text = article_text.split(marker)[0].strip()
+            break
 
             
-            article_dict_to_append = {
-                'fetchingDate': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), # date of when WE fetched it
-                'creationDate': creation_date, # date of when the article was published on the source page
-                'author': 'The Hacker News',
-                'authorLink': 'https://thehackernews.com',
-                'articleLink': url,
-                'articleTitle': article_title,
-                'articleText': article_text,
-            }
-            list_of_processed_articles.append(article_dict_to_append)
-        except Exception as e:
-            logging.error(f"Error processing {url}: {str(e)}")
-            return None
-        finally:
-            await asyncio.sleep(random.uniform(1.5, 3))
-            await page.close()
+    article_dict_to_append = {
+        'fetchingDate': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), # date of when WE fetched it
+        'creationDate': creation_date, # date of when the article was published on the source page
+        'author': 'The Hacker News',
+        'authorLink': 'https://thehackernews.com',
+        'articleLink': url,
+        'articleTitle': article_title,
+        'articleText': article_text,
+    }
+    return article_dict_to_append
+
+
+# most article pages are served complete to a plain GET, the browser is only the fallback for challenges and js-only pages
+TIERED_FETCHER = TieredFetcher(
+    SOURCE,
+    render=render_article,
+    is_complete=lambda html: SELECTORS.one('article_text', parse_document(html)) is not None,
+    browser_concurrency=SEMAPHORE_LIMIT,
+)
+
+
+async def stream_articles(links, sink):
+    """Fetch (plain http first, the browser only if needed), parse and hand every article to the sink as soon as it's done"""
+    # the semaphore limit now only applies to the pages that have to be rendered, the plain http ones are paced by the politeness scheduler
+    return await run_pipeline(links, fetch=TIERED_FETCHER.fetch, parse=parse_article, sink=sink, fetch_workers=MAX_CONNECTIONS_PER_HOST)
 
 
 async def process_articles(links):
-    semaphore = asyncio.Semaphore(SEMAPHORE_LIMIT)
-    
-    async with async_playwright() as p:
-        browser, context = await setup_browser_context(p)
-        tasks = []
-        list_of_processed_articles = []
-        
-        for link in links:
-            task = asyncio.create_task(process_article(context, link, semaphore, list_of_processed_articles))
-            tasks.append(task)
-        
-        await asyncio.gather(*tasks, return_exceptions=True)
-        await browser.close()
-        return list_of_processed_articles
+    sink = ListSink()
+    await stream_articles(links, sink)
+    return [result for result in sink.results if is_article(result)]
     
 
-async def setup_browser_context(playwright: Playwright):
-    browser = await playwright.chromium.launch(
+BROWSER_PROFILE = BrowserProfile(
+    name='thehackernews',
+    launch_options=dict(
         headless=False,
         channel='chrome',
-        slow_mo=750,
         # if we'd ever need to use proxy -> uncomment below
         # proxy={
         #     "server": f"http://{proxy_dict['proxyaddr']}:{proxy_dict['proxyport']}",
@@ -107,29 +142,30 @@ async def setup_browser_context(playwright: Playwright):
             '--disable-notifications',
             '--disable-browser-side-navigation',
             # '--disable-features=IsolateOrigins,site-per-process',
-        ]
-    )
-
-    context = await browser.new_context(
+        ],
+    ),
+    context_options=dict(
         locale='en-US',
         user_agent=None,
         no_viewport=True,  # Set to your desired window size
         ignore_https_errors=True,  # Ignore certificate errors
-    )
-
-    # Adding experimental features similar to Selenium's options
-    await context.add_init_script("""
+    ),
+    init_scripts=[
+        # Adding experimental features similar to Selenium's options
+        """
         delete window.__proto__.webdriver;
-    """)
-
-    # Disable `navigator.webdriver` (mimic undetectable-chromedriver behavior)
-    await context.add_init_script("""
+        """,
+        # Disable `navigator.webdriver` (mimic undetectable-chromedriver behavior)
+        """
         Object.defineProperty(navigator, 'webdriver', {
             get: () => undefined
         });
-    """)
-
-    return browser, context
+        """,
+    ],
+    page_setup=stealth_async,
+    # no images, fonts, css, ads or trackers - only the html and the scripts (cloudflare's included) are loaded
+    route_policy=RoutePolicy(),
+)
 
 
 def test_article():
@@ -142,8 +178,14 @@ def test_article():
         'https://thehackernews.com/2025/05/researchers-uncover-malware-in-fake.html'
     ]
     
+    async def _run():
+        try:
+            return await process_articles(links)
+        finally:
+            await close_browser_pool()
+
     # Run the async function
-    results = asyncio.run(process_articles(links))
+    results = asyncio.run(_run())
     
     # Print results
     for result in results:
@@ -151,4 +193,5 @@ def test_article():
             pprint(result)
 
 if __name__ == "__main__":
+    setup_logging()
     test_article()
\ No newline at end of file
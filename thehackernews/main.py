@@ -1,27 +1,31 @@
 from . import all_links_collector
 from . import async_individual_link_processor
-import csv
 import asyncio
 
+from common.html_cache import reparse_from_cache
+from common.logging_setup import setup_logging
+from common.pipeline import ArticleSink
+
 async def main():
-    collected_links_list = all_links_collector.get_all_links_of_articles_until_lastsaved_met()
-    final_list = await async_individual_link_processor.process_articles(collected_links_list)
+    collected_links_list = await all_links_collector.get_all_links_of_articles_until_lastsaved_met()
+    # every article is saved into the database (and the csv export) as soon as it's parsed
+    sink = ArticleSink('thehackernews')
+    await async_individual_link_processor.stream_articles(collected_links_list, sink)
 
-    # saving into the csv for now since we don't have a database yet
-    # TODO: save into the database as a superstructure to the existing logic with saving to the csv
+    if not sink.saved:
+        print("No data to save")
+    # the links this sweep found new, the daemon learns the publishing rate of the source from them
+    return {'new_links': len(collected_links_list), 'articles': sink.saved}
 
-    csv_file = "output.csv"
 
-    if final_list:
-        with open(csv_file, mode='a', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=final_list[0].keys())
-            writer.writeheader()
-            for data in final_list:
-                writer.writerow(data)
-    else:
-        print("No data to save")
+async def reparse():
+    """Extract the articles again out of every cached page, without any request (e.g. after a selector fix)"""
+    sink = ArticleSink('thehackernews', csv_export=False)
+    stats = await reparse_from_cache('thehackernews', async_individual_link_processor.parse_article, sink)
+    print(f"Reparsed {stats['urls']} cached pages, {sink.saved} articles saved")
 
 
 if __name__ == "__main__":
+    setup_logging()
     asyncio.run(main())
 